@@ -0,0 +1,22 @@
+"""
+Benchmarks for the Python parsers: the GLR parser (glr_parser.Parser), the
+string and token based parser generators of parser_v2 ('v2'), their bytecode
+back end ('vm') and the memoizing string parser ('memo'), run on the grammars in the examples directory with
+inputs that are scaled up from the bundled examples.
+
+Usage (from the python directory):
+
+    python3 -m benchmarks [--scales 1 10] [--python2 python2] [--output results.json]
+                          [--compare results/<commit>.json]
+
+Every combination of engine, grammar and scale runs in its own worker process,
+which reports the table-build time, the parse time (lines/s and MB/s) and the
+peak memory of the process. parser_v2 is Python 2 code, so its workers run
+with the interpreter given by --python2. We only run the engines that can
+parse a grammar (see cases.py), benchmarks that fail are recorded with an
+error.
+
+The results are written as JSON, by default to benchmarks/results/ under the
+current commit, so that the numbers of two commits can be compared with
+--compare.
+"""
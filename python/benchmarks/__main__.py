@@ -0,0 +1,155 @@
+"""
+Runs the benchmarks, see the documentation of the package.
+"""
+
+import subprocess
+import tempfile
+import argparse
+import platform
+import shutil
+import json
+import time
+import yaml
+import sys
+import os
+
+from . import cases
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+worker_filename = os.path.join(benchmarks_dir, 'worker.py')
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=benchmarks_dir).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def prepare_grammar(grammar_filename, format, work_dir):
+    """
+    The workers of the Python 2 engines get YAML grammars converted to JSON,
+    so that we only parse YAML once and with the same library.
+    """
+    if format != 'yaml':
+        return grammar_filename
+    filename = os.path.join(work_dir, os.path.basename(os.path.dirname(grammar_filename))+'.json')
+    if not os.path.exists(filename):
+        with open(grammar_filename) as input:
+            grammar = yaml.safe_load(input.read())
+        with open(filename, 'w') as output:
+            json.dump(grammar, output)
+    return filename
+
+def run_worker(python, spec, work_dir, timeout):
+    spec_filename = os.path.join(work_dir, 'spec.json')
+    result_filename = os.path.join(work_dir, 'result.json')
+    with open(spec_filename, 'w') as output:
+        json.dump(spec, output)
+    if os.path.exists(result_filename):
+        os.remove(result_filename)
+    try:
+        process = subprocess.run([python, worker_filename, spec_filename, result_filename],
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except OSError as e:
+        return {'error' : 'cannot run {}: {}'.format(python, e)}
+    except subprocess.TimeoutExpired:
+        return {'error' : 'timed out after {} s'.format(timeout)}
+    if not os.path.exists(result_filename):
+        stderr = process.stderr.decode('utf-8', 'replace').strip().splitlines()
+        return {'error' : 'worker exited with status {}: {}'.format(
+            process.returncode, stderr[-1] if stderr else '')}
+    with open(result_filename) as input:
+        return json.load(input)
+
+def run_benchmarks(args):
+    work_dir = tempfile.mkdtemp(prefix='parsejoy-benchmarks-')
+    results = []
+    try:
+        for engine in args.engines:
+            format = cases.engines[engine]['format']
+            python = args.python3 if cases.engines[engine]['python'] == 'python3' else args.python2
+            for name in args.grammars:
+                grammar = cases.grammars[name]
+                if not engine in grammar['engines']:
+                    continue
+                for scale in args.scales:
+                    result = {'engine' : engine, 'grammar' : name, 'scale' : scale}
+                    input_filename = os.path.join(work_dir, '{}-{}.input'.format(name, scale))
+                    if not os.path.exists(input_filename):
+                        with open(input_filename, 'w') as output:
+                            output.write(grammar['input'](scale))
+                    spec = {
+                        'engine' : engine,
+                        'grammar' : prepare_grammar(grammar[format], format, work_dir),
+                        'input' : input_filename,
+                        'repeat' : args.repeat,
+                    }
+                    result.update(run_worker(python, spec, work_dir, args.timeout))
+                    print_result(result)
+                    results.append(result)
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+def print_result(result):
+    label = '{engine:<4} {grammar:<11} x{scale:<5}'.format(**result)
+    if 'error' in result:
+        print('{}  error: {}'.format(label, result['error']))
+        return
+    print('{}  {lines:7d} lines  build {build_time:7.3f} s  parse {parse_time:8.3f} s  '
+          '{lines_per_s:9.0f} lines/s  {mb_per_s:7.3f} MB/s  peak {memory:7.1f} MB  {status}'.format(
+              label, memory=result['peak_memory']/1024.0/1024.0,
+              status='accepted' if result['accepted'] else 'REJECTED', **result))
+
+def key(result):
+    return (result['engine'], result['grammar'], result['scale'])
+
+def compare(results, filename):
+    """
+    Print the parse speed of every benchmark relative to a previous run.
+    """
+    with open(filename) as input:
+        previous = json.load(input)
+    previous_results = dict([(key(result), result) for result in previous['results']])
+    print('\nCompared to {} ({}):'.format(filename, previous.get('commit')))
+    for result in results:
+        other = previous_results.get(key(result))
+        if other is None or 'error' in result or 'error' in other:
+            continue
+        print('{:<4} {:<11} x{:<5}  lines/s {:9.0f} -> {:9.0f} ({:+6.1f} %)  peak memory {:+6.1f} %'.format(
+            result['engine'], result['grammar'], result['scale'],
+            other['lines_per_s'], result['lines_per_s'],
+            100.0*(result['lines_per_s']/other['lines_per_s']-1),
+            100.0*(float(result['peak_memory'])/other['peak_memory']-1)))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks', description='Benchmark the Python parsers.')
+    parser.add_argument('--engines', nargs='+', choices=sorted(cases.engines), default=sorted(cases.engines))
+    parser.add_argument('--grammars', nargs='+', choices=sorted(cases.grammars), default=sorted(cases.grammars))
+    parser.add_argument('--scales', nargs='+', type=int, default=[1, 10])
+    parser.add_argument('--repeat', type=int, default=3, help='parse every input this many times, report the fastest')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds per benchmark')
+    parser.add_argument('--python2', default='python2', help='interpreter for parser_v2')
+    parser.add_argument('--python3', default=sys.executable, help='interpreter for the GLR parser')
+    parser.add_argument('--output', help='result filename, by default benchmarks/results/[commit].json')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    commit = current_commit()
+    results = run_benchmarks(args)
+
+    output_filename = args.output or os.path.join(benchmarks_dir, 'results', '{}.json'.format(commit))
+    if os.path.dirname(output_filename) and not os.path.exists(os.path.dirname(output_filename)):
+        os.makedirs(os.path.dirname(output_filename))
+    with open(output_filename, 'w') as output:
+        json.dump({
+            'commit' : commit,
+            'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform' : platform.platform(),
+            'results' : results,
+        }, output, indent=2, sort_keys=True)
+    print('\nResults written to {}'.format(output_filename))
+
+    if args.compare:
+        compare(results, args.compare)
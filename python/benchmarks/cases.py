@@ -0,0 +1,78 @@
+"""
+The grammars and inputs that we benchmark, and how we scale up the inputs.
+"""
+
+import os
+
+examples_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                            'examples')
+
+def example(*path):
+    return os.path.join(examples_dir, *path)
+
+def read(filename):
+    with open(filename) as input:
+        return input.read()
+
+def repeat(filename, separator=''):
+    """
+    Scale an input by repeating it, which keeps it valid for grammars that
+    accept a sequence of statements.
+    """
+    def scale(factor):
+        content = read(filename)
+        if separator:
+            content = content.rstrip('\n')
+        return separator.join([content]*factor)
+    return scale
+
+def nested(depth, separator='+'):
+    """
+    Scale an input by chaining copies of an expression that nests depth
+    parentheses, each followed by an operator. The calculator grammar tries
+    every level three times before it finds the right alternative, so
+    without a memo the parse time grows as 3**depth.
+    """
+    expression = '('*depth+'1'+'+1)'*depth
+    def scale(factor):
+        return separator.join([expression]*factor)
+    return scale
+
+# the grammars of each example by format: 'grm' grammars are read by the GLR
+# parser, 'yaml' grammars by parser_v2 (both back ends). We only list the
+# engines that can parse the example: parser_old does not know the $-prefixed
+# directives of the YAML grammars, only gospel has a .grm grammar, and the toy
+# grammar needs the $lua directive, which parser_v2 lacks. 'memo' is the
+# string parser of parser_v2 with memoize, which only pays off on the
+# pathological backtracking of the 'backtrack' input.
+grammars = {
+    'gospel' : {
+        'grm' : example('gospel', 'grammar.grm'),
+        'input' : repeat(example('gospel', 'program.gsp')),
+        'engines' : ['glr'],
+    },
+    'python' : {
+        'yaml' : example('python', 'grammar.yml'),
+        'input' : repeat(example('python', 'example.py')),
+        'engines' : ['v2', 'vm'],
+    },
+    'calculator' : {
+        'yaml' : example('calculator', 'grammar.yml'),
+        # the example is a single expression, so we chain copies of it
+        'input' : repeat(example('calculator', 'example.c'), separator='+'),
+        'engines' : ['v2', 'vm'],
+    },
+    'backtrack' : {
+        'yaml' : example('calculator', 'grammar.yml'),
+        'input' : nested(6),
+        'engines' : ['v2', 'memo'],
+    },
+}
+
+# the grammar format and interpreter of every engine
+engines = {
+    'glr' : {'format' : 'grm', 'python' : 'python3'},
+    'v2' : {'format' : 'yaml', 'python' : 'python2'},
+    'vm' : {'format' : 'yaml', 'python' : 'python2'},
+    'memo' : {'format' : 'yaml', 'python' : 'python2'},
+}
@@ -0,0 +1,141 @@
+"""
+Runs a single benchmark and writes its result as JSON. This is started by the
+benchmark runner in a fresh process, so that the peak memory we report belongs
+to this benchmark alone. It has to work with Python 2 and 3.
+
+Usage:
+
+    python worker.py [spec filename] [result filename]
+"""
+
+from __future__ import print_function
+
+import resource
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def peak_memory():
+    """
+    The peak resident set size of the process in bytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss*1024
+
+def load_json(filename):
+    with open(filename) as input:
+        return json.load(input)
+
+def build_glr(spec):
+    import glr_parser
+
+    with open(spec['grammar']) as input:
+        grammar = glr_parser.compile_grammar(input.read())
+    parser = glr_parser.Parser(grammar)
+
+    def parse(code):
+        accepted_stacks, longest_stacks = parser.run(code)
+        return len(accepted_stacks) > 0
+
+    return parse
+
+def build_v2(spec, bytecode=False, memoize=False):
+    import parser_v2
+
+    if bytecode:
+        # the bytecode back end does not recurse
+        string_generator = parser_v2.StringBytecodeGenerator
+        token_generator = parser_v2.TokenBytecodeGenerator
+    else:
+        sys.setrecursionlimit(100000)
+        string_generator = lambda grammar: parser_v2.StringParserGenerator(grammar, memoize=memoize)
+        token_generator = parser_v2.TokenParserGenerator
+    grammar = load_json(spec['grammar'])
+    if 'tokenizer' in grammar:
+        tokenizer = string_generator(grammar['tokenizer']).compile()
+        del grammar['tokenizer']
+        token_parser = token_generator(grammar).compile()
+    else:
+        tokenizer = string_generator(grammar).compile()
+        token_parser = None
+
+    def parse(code):
+        result = tokenizer(parser_v2.StringState(code), parser_v2.Context(0, 'root', None))
+        if result.pos != len(code):
+            return False
+        if token_parser is None:
+            return True
+        token_stream = parser_v2.TokenStream(result.tokens)
+        token_stream.build_linked_list()
+        token_parser(parser_v2.TokenState(token_stream), parser_v2.Context(0, 'root', None))
+        return True
+
+    return parse
+
+def build_vm(spec):
+    return build_v2(spec, bytecode=True)
+
+def build_memo(spec):
+    return build_v2(spec, memoize=True)
+
+engines = {
+    'glr' : build_glr,
+    'v2' : build_v2,
+    'vm' : build_vm,
+    'memo' : build_memo,
+}
+
+def run(spec):
+    with open(spec['input']) as input:
+        code = input.read()
+    result = {
+        'lines' : code.count('\n')+1,
+        'bytes' : len(code.encode('utf-8') if not isinstance(code, bytes) else code),
+        'baseline_memory' : peak_memory(),
+    }
+
+    start = time.time()
+    parse = engines[spec['engine']](spec)
+    result['build_time'] = time.time()-start
+
+    times = []
+    for i in range(spec.get('repeat', 1)):
+        start = time.time()
+        try:
+            accepted = parse(code)
+        except Exception as e:
+            # parser_v2 signals a failed parse with a ParserError
+            if not 'ParserError' in [c.__name__ for c in type(e).__mro__]:
+                raise
+            accepted = False
+        times.append(time.time()-start)
+    parse_time = min(times)
+
+    result.update({
+        'accepted' : accepted,
+        'parse_time' : parse_time,
+        'parse_times' : times,
+        'lines_per_s' : result['lines']/parse_time if parse_time else None,
+        'mb_per_s' : result['bytes']/parse_time/1024/1024 if parse_time else None,
+        'peak_memory' : peak_memory(),
+    })
+    return result
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: {} [spec filename] [result filename]\n".format(sys.argv[0]))
+        exit(-1)
+
+    spec = load_json(sys.argv[1])
+    try:
+        result = run(spec)
+    except Exception as e:
+        result = {'error' : '{}: {}'.format(e.__class__.__name__, e)}
+    with open(sys.argv[2], 'w') as output:
+        json.dump(result, output)
@@ -1,9 +1,27 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from array import array
+import tempfile
+import hashlib
+import gc
+import heapq
+import bisect
+import copy
 import codecs
+import pickle
+import warnings
 import yaml
 import time
 import sys
+import os
 import re
+import string
+
+from line_index import LineIndex
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 e_grammar = [
     ['S','E','$'],#0
@@ -13,26 +31,446 @@ e_grammar = [
     ['T','n'],#4
 ]
 
-def literal(value):
+class Literal(object):
+
+    """
+    A terminal that matches a literal string. In contrast to a closure, a
+    literal can be compared, hashed and pickled, which allows us to store
+    parse tables that contain it on disk.
+    """
+
+    def __init__(self, value):
+        self.value = value
 
-    def match(tokens):
-        if tokens[:len(value)] == value:
-            return tokens[:len(value)]
+    def __call__(self, tokens):
+        if tokens[:len(self.value)] == self.value:
+            return tokens[:len(self.value)]
         return None
 
-    return match
+    def __eq__(self, other):
+        return isinstance(other, Literal) and other.value == self.value
 
-def regex(pattern):
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(('literal', self.value))
+
+    def __repr__(self):
+        return 'literal({!r})'.format(self.value)
+
+class Regex(object):
 
-    expr = re.compile(pattern, re.MULTILINE|re.DOTALL)
+    """
+    A terminal that matches a regular expression at the beginning of the
+    input. Like a literal, it is a serializable descriptor.
+    """
 
-    def match(tokens):
-        i = 0
-        match = re.match(expr, tokens)
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.expr = re.compile(pattern, re.MULTILINE|re.DOTALL)
+
+    def __call__(self, tokens):
+        match = self.expr.match(tokens)
         if match:
             return match[0]
         return None
-    return match
+
+    def __getstate__(self):
+        return {'pattern': self.pattern}
+
+    def __setstate__(self, state):
+        self.__init__(state['pattern'])
+
+    def __eq__(self, other):
+        return isinstance(other, Regex) and other.pattern == self.pattern
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(('regex', self.pattern))
+
+    def __repr__(self):
+        return 'regex({!r})'.format(self.pattern)
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+regex_categories = {
+    sre_parse.CATEGORY_DIGIT : r'\d', sre_parse.CATEGORY_NOT_DIGIT : r'\D',
+    sre_parse.CATEGORY_SPACE : r'\s', sre_parse.CATEGORY_NOT_SPACE : r'\S',
+    sre_parse.CATEGORY_WORD : r'\w', sre_parse.CATEGORY_NOT_WORD : r'\W',
+}
+
+regex_repeats = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None))
+
+def regex_character(op, av):
+    """
+    Return the pattern of an item of a parsed regular expression that
+    matches a single character, or None if the item is no such item.
+    """
+    def char(c):
+        return re.escape(chr(c))
+
+    if op == sre_parse.LITERAL:
+        return char(av)
+    elif op == sre_parse.NOT_LITERAL:
+        return '[^{}]'.format(char(av))
+    elif op == sre_parse.ANY:
+        return '.'
+    elif op == sre_parse.IN:
+        parts = []
+        for set_op, set_av in av:
+            if set_op == sre_parse.NEGATE:
+                parts.insert(0, '^')
+            elif set_op == sre_parse.LITERAL:
+                parts.append(char(set_av))
+            elif set_op == sre_parse.RANGE:
+                parts.append('{}-{}'.format(char(set_av[0]), char(set_av[1])))
+            elif set_op == sre_parse.CATEGORY and set_av in regex_categories:
+                parts.append(regex_categories[set_av])
+            else:
+                raise ValueError(set_op)
+        return '[{}]'.format(''.join(parts))
+    return None
+
+class PrefixMatcher(object):
+
+    """
+    Tells whether the rest of a string from a position on is a prefix of a
+    string that a regular expression can match, i.e. whether the expression
+    could still match there once more input is appended to the string.
+
+    We run a nondeterministic automaton of the parsed expression and cache
+    the sets of states that it reaches by character, which makes up a
+    deterministic automaton as we go. This takes linear time, where a regular
+    expression for the prefixes backtracks exponentially on ambiguous
+    patterns, such as layout made of comments and newlines. The automaton
+    may accept more than the prefixes: we skip assertions, let
+    back-references match anything and loosen long bounded repeats.
+    """
+
+    # bounded repeats up to this length are unrolled, longer ones loosened
+    max_unroll = 16
+
+    # we drop the cached transitions once there are this many
+    max_cached = 4096
+
+    def __init__(self, pattern, flags=re.MULTILINE|re.DOTALL):
+        self.epsilon = []
+        self.transitions = []
+        self.tests = {}
+        start = self.new_state()
+        try:
+            parsed = sre_parse.parse(pattern, flags)
+            self.build(parsed, parsed.state.flags & ~re.VERBOSE, start)
+        except (ValueError, re.error):
+            # we could not translate the pattern, so it could always match
+            self.epsilon, self.transitions = [[]], [[(None, 0)]]
+        self.start = self.closure([start])
+        self.cache = {}
+
+    def new_state(self):
+        self.epsilon.append([])
+        self.transitions.append([])
+        return len(self.epsilon)-1
+
+    def build(self, items, flags, state):
+        """
+        Add the states of the items after the given state and return the
+        state that the last of them ends in.
+        """
+        for op, av in items:
+            state = self.build_item(op, av, flags, state)
+        return state
+
+    def build_item(self, op, av, flags, state):
+        character = regex_character(op, av)
+        if character is not None:
+            test = self.tests.get((character, flags))
+            if test is None:
+                test = self.tests[(character, flags)] = re.compile(character, flags)
+            end = self.new_state()
+            self.transitions[state].append((test, end))
+            return end
+        elif op == sre_parse.BRANCH:
+            return self.build_branches(av[1], flags, state)
+        elif op == sre_parse.SUBPATTERN:
+            return self.build(av[3], (flags | av[1]) & ~av[2], state)
+        elif op in regex_repeats:
+            low, high, items = av
+            for i in range(min(low, self.max_unroll)):
+                state = self.build(items, flags, state)
+            if high == sre_parse.MAXREPEAT or high > self.max_unroll:
+                loop = self.new_state()
+                self.epsilon[state].append(loop)
+                self.epsilon[self.build(items, flags, loop)].append(loop)
+                return loop
+            for i in range(high-low):
+                end = self.new_state()
+                self.epsilon[state].append(end)
+                self.epsilon[self.build(items, flags, state)].append(end)
+                state = end
+            return state
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            return self.build(av, flags, state)
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            return state
+        elif op == sre_parse.GROUPREF:
+            end = self.new_state()
+            self.epsilon[state].append(end)
+            self.transitions[end].append((None, end))
+            return end
+        elif op == sre_parse.GROUPREF_EXISTS:
+            return self.build_branches([av[1], av[2] or ()], flags, state)
+        raise ValueError(op)
+
+    def build_branches(self, branches, flags, state):
+        end = self.new_state()
+        for items in branches:
+            branch = self.new_state()
+            self.epsilon[state].append(branch)
+            self.epsilon[self.build(items, flags, branch)].append(end)
+        return end
+
+    def closure(self, states):
+        result = set(states)
+        stack = list(states)
+        while stack:
+            for target in self.epsilon[stack.pop()]:
+                if not target in result:
+                    result.add(target)
+                    stack.append(target)
+        return frozenset(result)
+
+    def step(self, states, c):
+        return self.closure([target for state in states
+                             for test, target in self.transitions[state]
+                             if test is None or test.match(c)])
+
+    def match(self, input, pos=0):
+        states = self.start
+        cache = self.cache
+        for i in range(pos, len(input)):
+            key = (states, input[i])
+            next_states = cache.get(key)
+            if next_states is None:
+                if len(cache) >= self.max_cached:
+                    cache.clear()
+                next_states = cache[key] = self.step(states, input[i])
+            if not next_states:
+                return False
+            states = next_states
+        return True
+
+def terminal_pattern(terminal):
+    """
+    Return the regular expression of a literal or regex terminal, or None if
+    the terminal is a function.
+    """
+    if isinstance(terminal, Regex):
+        return terminal.pattern
+    elif isinstance(terminal, Literal):
+        return re.escape(terminal.value)
+    elif isinstance(terminal, str):
+        return re.escape(terminal)
+    return None
+
+def common_first_character(pattern, other, flags=re.MULTILINE|re.DOTALL):
+    """
+    Return a character that strings of both regular expressions can start
+    with, or None if there is none. We try the characters that the patterns
+    name (including the ends of their ranges) and the printable ASCII ones,
+    which finds a common character of two character sets unless they only
+    share characters of a unicode category.
+    """
+    characters = set(string.printable+'\0\u00e9\uffff')
+
+    def collect(items):
+        for op, av in items:
+            if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL):
+                characters.add(chr(av))
+            elif op == sre_parse.RANGE:
+                characters.update([chr(av[0]), chr(av[1])])
+            elif op == sre_parse.IN:
+                collect(av)
+            elif op == sre_parse.BRANCH:
+                for branch in av[1]:
+                    collect(branch)
+            elif op == sre_parse.SUBPATTERN:
+                collect(av[3])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+                collect(av[2])
+            elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+                collect(av)
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                collect(av[1])
+            elif op == sre_parse.GROUPREF_EXISTS:
+                collect(av[1])
+                collect(av[2] or ())
+
+    for p in (pattern, other):
+        try:
+            collect(sre_parse.parse(p, flags))
+        except (ValueError, re.error):
+            pass
+    starts, other_starts = PrefixMatcher(pattern, flags), PrefixMatcher(other, flags)
+    for c in sorted(characters):
+        if starts.match(c) and other_starts.match(c):
+            return c
+    return None
+
+def literal(value):
+    return Literal(value)
+
+def regex(pattern):
+    return Regex(pattern)
+
+class TerminalMatcher(object):
+
+    """
+    Matches all terminals of an LR state at a given position of the input in
+    a single call and without slicing the input.
+
+    Literal terminals are stored in a trie. Regular expressions are combined
+    into a single pattern, in which every terminal is an optional lookahead
+    with its own named group, so one pattern.match(input, pos) tells us the
+    match of every terminal. Expressions that cannot be combined (e.g.
+    because they use backreferences or inline flags) are matched one by one.
+    The '\\0' terminal matches at the end of the input.
+
+    If symbol_ids is given, matches report the ID of a terminal instead of
+    the terminal itself.
+
+    For streams, partial_matches() tells which terminals could still match
+    differently once more input arrives.
+    """
+
+    def __init__(self, terminals, symbol_ids=None):
+        self.trie = {}
+        self.end_terminals = []
+        self.regexes = []
+        self.prefix_regexes = []
+        self.callables = []
+        self.pattern = None
+        self.groups = []
+        for terminal in terminals:
+            key = symbol_ids[terminal] if symbol_ids is not None else terminal
+            if isinstance(terminal, Regex):
+                self.regexes.append((terminal, key))
+                self.prefix_regexes.append((PrefixMatcher(terminal.pattern), key))
+            elif isinstance(terminal, Literal):
+                self.add_literal(key, terminal.value)
+            elif callable(terminal):
+                self.callables.append((terminal, key))
+            elif isinstance(terminal, str):
+                if terminal == '\0':
+                    self.end_terminals.append(key)
+                self.add_literal(key, terminal)
+        self.combine_regexes()
+
+    def add_literal(self, key, value):
+        if not value:
+            return
+        node = self.trie
+        for c in value:
+            node = node.setdefault(c, {})
+        node.setdefault(None, []).append(key)
+
+    def combine_regexes(self):
+        alternatives = []
+        separate_regexes = []
+        for regex, key in self.regexes:
+            if re.search(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)', regex.pattern):
+                separate_regexes.append((regex, key))
+                continue
+            name = '_t{}'.format(len(self.groups))
+            self.groups.append((name, key))
+            alternatives.append('(?:(?=(?P<{}>{})))?'.format(name, regex.pattern))
+        if alternatives:
+            try:
+                self.pattern = re.compile(''.join(alternatives), re.MULTILINE|re.DOTALL)
+            except re.error:
+                self.pattern = None
+                self.groups = []
+                separate_regexes = self.regexes
+        self.regexes = separate_regexes
+
+    def match(self, input, pos):
+        """
+        Return a list of (terminal or terminal ID, semantic value, end
+        position) tuples for all terminals that match at the given position.
+        Empty matches of regular expressions are not reported, as they cannot
+        be shifted.
+        """
+        matches = []
+        n = len(input)
+        if pos >= n:
+            for terminal in self.end_terminals:
+                matches.append((terminal, '\0', pos))
+            return matches
+        node = self.trie
+        j = pos
+        while j < n:
+            node = node.get(input[j])
+            if node is None:
+                break
+            j += 1
+            terminals = node.get(None)
+            if terminals:
+                value = input[pos:j]
+                for terminal in terminals:
+                    matches.append((terminal, value, j))
+        if self.pattern is not None:
+            match = self.pattern.match(input, pos)
+            for name, terminal in self.groups:
+                value = match.group(name)
+                if value:
+                    matches.append((terminal, value, pos+len(value)))
+        for regex, key in self.regexes:
+            match = regex.expr.match(input, pos)
+            if match and match.group(0):
+                matches.append((key, match.group(0), match.end()))
+        for terminal, key in self.callables:
+            value = terminal(input[pos:])
+            if value:
+                matches.append((key, value, pos+len(value)))
+        return matches
+
+    def partial_matches(self, input, pos, mask=None):
+        """
+        Return the terminals (or terminal IDs) whose matches at the given
+        position may change if more input is appended: the literals that the
+        rest of the input is a proper prefix of, the regular expressions that
+        could match beyond its end (see PrefixMatcher) and all callables,
+        which we cannot look into. If mask is given, we only check the
+        terminal IDs that are set in it.
+        """
+        partial = []
+        n = len(input)
+        node = self.trie
+        j = pos
+        while j < n and node is not None:
+            node = node.get(input[j])
+            j += 1
+        if node is not None and j == n:
+            stack = [child for c, child in node.items() if c is not None]
+            while stack:
+                child = stack.pop()
+                for c, grandchild in child.items():
+                    if c is None:
+                        partial.extend(grandchild)
+                    else:
+                        stack.append(grandchild)
+        partial.extend([key for prefix, key in self.prefix_regexes
+                        if (mask is None or mask >> key & 1) and prefix.match(input, pos)])
+        partial.extend([key for terminal, key in self.callables])
+        if mask is not None:
+            partial = [key for key in partial if mask >> key & 1]
+        return partial
 
 grammar_grammar = [
     ['S', 'ows', '[]rules', 'ows', '\0'],
@@ -42,9 +480,9 @@ grammar_grammar = [
     ['[]args',],
     ['[]args', '(', 'arglist', ')'],
     ['arglist',],
-    ['arglist', 'arglist', ',', '|arg'],
+    ['arglist', 'arglist', ',', 'ows', '|arg'],
     ['arglist', '|arg'],
-    ['|arg', regex(r'[a-z]+')],
+    ['|arg', regex(r'[a-z]+(=("(\\.|[^\"])*"|[^,\)\s\"]+))?')],
     ['patterns', 'alternatives'],
     ['patterns', '[]patternlist'],
     ['alternatives', '[]alternativelist'],
@@ -81,8 +519,8 @@ grammar_grammar = [
     ['newline', '\n'],
     ['newline-or-end', 'newline'],
     ['newline-or-end', '\0'],
-    ['ows'],
-    ['ows', 'ws'],
+    ['ows', {'layout' : True}],
+    ['ows', 'ws', {'layout' : True}],
     ['ws', 'ws', 'wsc'],
     ['ws', 'wsc'],
     ['wsc', 'comment',],
@@ -119,7 +557,7 @@ gospel_grammar = [
 ]
 
 grammar_program = r"""
-Sub(foo,bar,baz)->bar;
+Sub(left,priority=2)->bar;
 
 baz -> bum; # comment
 
@@ -215,92 +653,1840 @@ e_grammar = [
     ['e','b']
 ]
 
+# bump this whenever the layout of the cached tables changes
+CACHE_VERSION = 9
+
+class GrammarError(ValueError):
+    pass
+
+class MemoryLimitExceeded(MemoryError):
+    pass
+
+class ParseLimitExceeded(RuntimeError):
+
+    """
+    Raised when a parse exceeds its reduction budget or time limit (see
+    ParseLimits). It tells which limit was hit at which position and holds
+    the best result so far: the accepted stack nodes and the nodes of the
+    furthest level that the parser reached.
+    """
+
+    def __init__(self, limit, pos, accepted_stacks, longest_stacks):
+        super(ParseLimitExceeded, self).__init__(
+            "The parse exceeded its {} limit at position {}".format(limit, pos))
+        self.limit = limit
+        self.pos = pos
+        self.accepted_stacks = accepted_stacks
+        self.longest_stacks = longest_stacks
+
+def reachable_non_terminals(grammar):
+    """
+    Return the non-terminals that can be reached from the start symbol (the
+    non-terminal of the first rule) of a grammar.
+    """
+    rules = defaultdict(list)
+    for rule in grammar:
+        rules[rule[0]].append(rule)
+    reachable = set([grammar[0][0]])
+    non_terminals_to_examine = [grammar[0][0]]
+    while non_terminals_to_examine:
+        for rule in rules[non_terminals_to_examine.pop()]:
+            for symbol in rule[1:]:
+                if isinstance(symbol, str) and symbol in rules and not symbol in reachable:
+                    reachable.add(symbol)
+                    non_terminals_to_examine.append(symbol)
+    return reachable
+
+def resident_memory():
+    """
+    Return the resident memory of the process in bytes, or None if we cannot
+    tell. Where there is no /proc, we can only get the peak resident memory.
+    """
+    try:
+        with open('/proc/self/statm') as input:
+            return int(input.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+def grammar_fingerprint(grammar):
+    """
+    Return a content hash of the grammar that we use as the key for cached
+    parse tables. Terminals are hashed via their repr, so grammars that
+    contain arbitrary callables (whose repr is not stable) cannot be cached
+    and we return None for them.
+    """
+    hasher = hashlib.sha256()
+    hasher.update('{}\n'.format(CACHE_VERSION).encode('utf-8'))
+    for rule in grammar:
+        for symbol in rule:
+            if callable(symbol) and not isinstance(symbol, (Literal, Regex)):
+                return None
+        hasher.update(repr(rule).encode('utf-8'))
+        hasher.update(b'\n')
+    return hasher.hexdigest()
+
+class TableCache(object):
+
+    """
+    A directory of compiled parse tables (and compiled grammars), keyed by
+    a content hash. Entries are pickled, so a warm start costs little more
+    than unpickling the tables.
+
+    If no directory is given we use $PARSEJOY_CACHE_DIR or ~/.cache/parsejoy.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get('PARSEJOY_CACHE_DIR',
+                os.path.join(os.path.expanduser('~'), '.cache', 'parsejoy'))
+        self.directory = directory
+
+    def path(self, key, kind):
+        return os.path.join(self.directory, '{}.{}'.format(key, kind))
+
+    def load(self, key, kind='tables'):
+        path = self.path(key, kind)
+        try:
+            with open(path, 'rb') as input:
+                return pickle.load(input)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, AttributeError, ImportError,
+                pickle.UnpicklingError) as e:
+            # a broken entry, or one that an incompatible version of Python or
+            # of the parser wrote, is a cache miss that gets overwritten
+            warnings.warn("Ignoring cache entry {}: {!r}".format(path, e), RuntimeWarning)
+            return None
+
+    def store(self, key, value, kind='tables'):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as output:
+                pickle.dump(value, output, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path(key, kind))
+        except OSError:
+            # the cache is an optimization, we can live without it
+            pass
+
+class PackedNode(object):
+
+    """
+    One derivation of a symbol or intermediate node of the parse forest. The
+    forest is binarised: left is the first child of the derivation and right
+    either its last child or an intermediate node that stands for all the
+    remaining children.
+    """
+
+    __slots__ = ('rule', 'left', 'right')
+
+    def __init__(self, rule, left, right):
+        self.rule = rule
+        self.left = left
+        self.right = right
+
+    @property
+    def children(self):
+        if self.left is None:
+            return ()
+        children = [self.left]
+        right = self.right
+        while isinstance(right, IntermediateNode):
+            packed = right.packed[0]
+            children.append(packed.left)
+            right = packed.right
+        if right is not None:
+            children.append(right)
+        return tuple(children)
+
+class Shift(object):
+
+    """
+    How the positions of the nodes of an incremental parse move when it is
+    spliced onto a reparse (see ParseSession.splice()): the nodes from the
+    sync point on move by delta, and the forest nodes that start before it
+    and end behind it start at the new position of the stack node that they
+    started at (positions). Every node of an incremental session refers to the shift
+    of the session and only catches up with it when its position is read,
+    so that the part of the previous parse that is reused moves in constant
+    time. A shift that applies links to the shift of the session that the
+    nodes move on to.
+    """
+
+    __slots__ = ('sync', 'delta', 'positions', 'next')
+
+    def __init__(self):
+        self.sync = None
+        self.delta = 0
+        self.positions = None
+        self.next = None
+
+class ForestNode(object):
+
+    __slots__ = ('_start', '_end', 'packed', 'shift')
+
+    def __init__(self, start, end, shift=None):
+        self._start = start
+        self._end = end
+        self.packed = []
+        self.shift = shift
+
+    @property
+    def start(self):
+        if self.shift is not None and self.shift.next is not None:
+            self.catch_up()
+        return self._start
+
+    @start.setter
+    def start(self, start):
+        self.catch_up()
+        self._start = start
+
+    @property
+    def end(self):
+        if self.shift is not None and self.shift.next is not None:
+            self.catch_up()
+        return self._end
+
+    @end.setter
+    def end(self, end):
+        self.catch_up()
+        self._end = end
+
+    def catch_up(self):
+        """
+        Apply the shifts that the node has missed to its positions.
+        """
+        shift = self.shift
+        if shift is None:
+            return
+        start, end = self._start, self._end
+        while shift.next is not None:
+            if shift.sync is not None and end >= shift.sync:
+                start = start+shift.delta if start >= shift.sync else shift.positions.get(start, start)
+                end += shift.delta
+            shift = shift.next
+        self._start, self._end, self.shift = start, end, shift
+
+    def replace(self, other):
+        """
+        Turn the node into a copy of the given node of the same kind, so that
+        the nodes that refer to it refer to the derivations of the other one.
+        """
+        self._start, self._end, self.shift = other._start, other._end, other.shift
+        self.packed = list(other.packed)
+
+    def add_derivation(self, rule, left, right):
+        """
+        Add a derivation to the node, unless it has it already. Returns True
+        if the derivation is new.
+        """
+        for packed in self.packed:
+            if packed.rule == rule and packed.left == left and packed.right == right:
+                return False
+        self.packed.append(PackedNode(rule, left, right))
+        return True
+
+    @property
+    def is_ambiguous(self):
+        return len(self.packed) > 1
+
+class IntermediateNode(ForestNode):
+
+    """
+    Stands for the children of a rule from position dot onwards, for all
+    derivations that share them.
+    """
+
+    __slots__ = ('rule', 'dot')
+
+    def __init__(self, rule, dot, start, end, shift=None):
+        self._start = start
+        self._end = end
+        self.packed = []
+        self.shift = shift
+        self.rule = rule
+        self.dot = dot
+
+    def __repr__(self):
+        return 'IntermediateNode({}, {}, {}, {})'.format(self.rule, self.dot, self.start, self.end)
+
+class SymbolNode(ForestNode):
+
+    """
+    A node of the shared packed parse forest (SPPF) that stands for all the
+    derivations of a non-terminal over the input from start to end. There is
+    only one node per (symbol, start, end), all its derivations are kept as
+    packed nodes. Terminals are not wrapped in nodes but kept as strings.
+    """
+
+    __slots__ = ('symbol',)
+
+    def __init__(self, symbol, start, end, shift=None):
+        self._start = start
+        self._end = end
+        self.packed = []
+        self.shift = shift
+        self.symbol = symbol
+
+    @property
+    def children(self):
+        """
+        The children of the first derivation of the node, extracted lazily.
+        """
+        if not self.packed:
+            return ()
+        return self.packed[0].children
+
+    def derivations(self):
+        for packed in self.packed:
+            yield packed.rule, packed.children
+
+    def tree(self):
+        """
+        Extract a single parse tree as nested (symbol, children) tuples, in
+        which terminals are strings. For ambiguous nodes we pick the first
+        derivation.
+        """
+        trees = {}
+        stack = [(self, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if id(node) in trees:
+                continue
+            if expanded:
+                trees[id(node)] = (node.symbol, tuple([trees[id(child)] if isinstance(child, SymbolNode) else child
+                                                       for child in node.children]))
+                continue
+            stack.append((node, True))
+            for child in node.children:
+                if isinstance(child, SymbolNode) and not id(child) in trees:
+                    stack.append((child, False))
+        return trees[id(self)]
+
+    def __repr__(self):
+        return 'SymbolNode({!r}, {}, {})'.format(self.symbol, self.start, self.end)
+
+class StackNode(object):
+
+    """
+    A node of the graph-structured stack (GSS): the LR state that a stack is
+    in at a given input position. The edges of a node point to its parent
+    nodes, each labelled with the semantic value of the symbol that leads
+    from the parent to the node. Stacks that share a prefix share its nodes.
+    The parser reads pos directly, so the nodes that an incremental session
+    takes over from an earlier parse have to catch up with it first.
+    """
+
+    __slots__ = ('state', 'pos', 'edges', 'shift')
+
+    def __init__(self, state, pos, shift=None):
+        self.state = state
+        self.pos = pos
+        self.edges = []
+        self.shift = shift
+
+    def catch_up(self):
+        """
+        Apply the shifts that the node has missed to its position (see
+        Shift). Returns False if it is up to date already.
+        """
+        shift = self.shift
+        if shift is None or shift.next is None:
+            return False
+        pos = self.pos
+        while shift.next is not None:
+            if shift.sync is not None and pos >= shift.sync:
+                pos += shift.delta
+            shift = shift.next
+        self.pos, self.shift = pos, shift
+        return True
+
+    def position(self):
+        self.catch_up()
+        return self.pos
+
+    def get_edge(self, parent):
+        for edge in self.edges:
+            if edge[1] is parent:
+                return edge
+        return None
+
+    def add_edge(self, semantic_value, parent):
+        edge = (semantic_value, parent)
+        self.edges.append(edge)
+        return edge
+
+    def __repr__(self):
+        return 'StackNode({}, {}, {} edges)'.format(self.state, self.pos, len(self.edges))
+
+class ParserStats(object):
+
+    """
+    Counts what the parser does while it parses, so that we can see which
+    states and rules of a grammar drive the cost of parsing an input. Pass
+    it to Parser.run() or Parser.stream(), without it the parser does not
+    count anything.
+
+    We record the number of live stack heads of every level (step), the
+    stack heads and reductions of every state, the reductions by every rule
+    and the ambiguities that they produce, i.e. the forest nodes that get
+    a further derivation, for all the rules that compete in them. Besides,
+    we count the path enumerations of reductions and the paths found, the
+    merges of reductions into existing stack nodes, the stack heads pruned
+    by limits, and the calls of the terminal matchers and how many of them
+    found a terminal.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.heads = array('i')
+        self.state_heads = [0]*len(parser.shift_masks)
+        self.state_reductions = [0]*len(parser.shift_masks)
+        self.rule_reductions = [0]*len(parser.grammar)
+        self.rule_ambiguities = [0]*len(parser.grammar)
+        self.ambiguous_nodes = 0
+        self.path_enumerations = 0
+        self.paths = 0
+        self.merges = 0
+        self.pruned_heads = 0
+        self.matcher_calls = 0
+        self.matcher_hits = 0
+
+    def count_level(self, frontier):
+        self.heads.append(len(frontier))
+        state_heads = self.state_heads
+        for state in frontier:
+            state_heads[state] += 1
+
+    def count_matches(self, matches):
+        self.matcher_calls += 1
+        if matches:
+            self.matcher_hits += 1
+
+    def count_reduction(self, state, rule):
+        self.state_reductions[state] += 1
+        self.rule_reductions[rule] += 1
+
+    def count_ambiguity(self, node):
+        if len(node.packed) == 2:
+            self.ambiguous_nodes += 1
+            self.rule_ambiguities[node.packed[0].rule] += 1
+        self.rule_ambiguities[node.packed[-1].rule] += 1
+
+    def report(self):
+        """
+        Return the totals as a dict, with the counts of the states and rules
+        (by their string form) that did anything.
+        """
+        heads = self.heads
+        return {
+            'steps' : len(heads),
+            'heads' : {
+                'mean' : float(sum(heads))/len(heads) if heads else 0.0,
+                'max' : max(heads) if heads else 0,
+                'total' : sum(heads),
+            },
+            'reductions' : sum(self.rule_reductions),
+            'path_enumerations' : self.path_enumerations,
+            'paths' : self.paths,
+            'merges' : self.merges,
+            'pruned_heads' : self.pruned_heads,
+            'ambiguous_nodes' : self.ambiguous_nodes,
+            'matcher_calls' : self.matcher_calls,
+            'matcher_hit_rate' : float(self.matcher_hits)/self.matcher_calls if self.matcher_calls else 0.0,
+            'states' : dict([(state, {'heads' : heads, 'reductions' : reductions})
+                             for state, (heads, reductions)
+                             in enumerate(zip(self.state_heads, self.state_reductions))
+                             if heads or reductions]),
+            'rules' : dict([(self.parser.rule_as_str(rule), {'reductions' : reductions, 'ambiguities' : ambiguities})
+                            for rule, (reductions, ambiguities)
+                            in enumerate(zip(self.rule_reductions, self.rule_ambiguities))
+                            if reductions or ambiguities]),
+        }
+
+    def heatmap(self, width=40, limit=20):
+        """
+        Return the rules with the most ambiguities, one per line with a bar
+        that shows their share, as a string.
+        """
+        rules = sorted([(ambiguities, rule) for rule, ambiguities in enumerate(self.rule_ambiguities)
+                        if ambiguities], reverse=True)[:limit]
+        if not rules:
+            return 'no ambiguities\n'
+        most = rules[0][0]
+        lines = []
+        for ambiguities, rule in rules:
+            bar = '#'*max(1, int(round(float(ambiguities)/most*width)))
+            lines.append('{:8d} {:<{}} {}'.format(ambiguities, bar, width, self.parser.rule_as_str(rule)))
+        return '\n'.join(lines)+'\n'
+
+class ParseLimits(object):
+
+    """
+    Limits on the work of a parse, which bound its latency on pathological
+    inputs. Pass it to Parser.run() or Parser.stream().
+
+    * max_heads -- keep at most this many stack heads per level, the best
+      ones by rank(session, node, pos) (higher is better). By default we
+      prefer the heads that can shift one of the terminals that match, and
+      among them those with the most edges.
+    * max_reductions -- stop after this many reductions in total, counting
+      the reduction paths that the filters discard as well.
+    * time_limit -- stop after this many seconds (from the start of the
+      parse, so for a stream including the time spent waiting for input).
+      We check it between levels and every time_check_interval reductions.
+
+    The parse stops with a ParseLimitExceeded error when it exceeds one of
+    the last two, while a beam of heads only makes it give up on parses.
+    """
+
+    def __init__(self, max_heads=None, rank=None, max_reductions=None, time_limit=None):
+        self.max_heads = max_heads
+        if rank is not None:
+            self.rank = rank
+        self.max_reductions = max_reductions
+        self.time_limit = time_limit
+
+    @staticmethod
+    def rank(session, node, pos):
+        can_shift = session.parser.shift_masks[node.state] & session.get_terminal_matches(pos)[0]
+        return can_shift != 0, len(node.edges)
+
+class ParseSession(object):
+
+    """
+    A single parse of an input that is passed in chunks to feed(). The parser
+    advances the frontier of the stack graph as far as the input seen so far
+    allows, and finish() marks the end of the input and returns the accepted
+    stack nodes and the nodes of the furthest level, as Parser.run does.
+
+    A level is only processed once `window` characters following its position
+    have arrived and none of the terminals that its stack nodes can shift or
+    that decide its reductions could still match differently when more input
+    arrives (see TerminalMatcher.partial_matches). The session only keeps the
+    input from the lowest pending position on, which also means that regular
+    expressions cannot look behind that position.
+
+    If on_complete is given, it is called with the forest nodes of the
+    committed prefix of the input in order: whenever the stack graph narrows
+    down to a single stack, the nodes on it belong to every parse that is
+    still possible. If symbols is given, only nodes of these symbols are
+    handed out, otherwise all maximal new ones.
+
+    If release is set, the forest nodes of the committed prefix are emptied
+    once they have been handed to on_complete (apart from those on the stack,
+    which later reductions look at). So on_complete has to process a node
+    right away, and the forest that finish() returns only holds what was
+    parsed since the last commit. As the stack graph only holds the nodes of
+    the stacks that are still alive, the memory of such a parse grows with
+    the nesting depth and the ambiguity of the input, not with its size.
+
+    If memory_limit is given, the parse stops with a MemoryLimitExceeded
+    error once the resident memory of the process exceeds that many bytes.
+
+    If stats (a ParserStats) is given, we count what the parser does in it,
+    limits (a ParseLimits) bound the work that it does.
+
+    An incremental session keeps its whole input and records a checkpoint
+    whenever the stack graph narrows down to a single node, so that it can be
+    reparsed after an edit (see reparse()). The positions of its nodes follow
+    the shift of the session (see Shift).
+    """
+
+    default_window = 1024
+
+    # the number of levels after which we check the memory limit again
+    memory_check_interval = 1024
+
+    # the number of reductions after which we check the time limit again
+    time_check_interval = 256
+
+    def __init__(self, parser, on_complete=None, symbols=None, window=None,
+                 incremental=False, release=False, memory_limit=None, stats=None,
+                 limits=None):
+        self.parser = parser
+        self.debug = parser.debug
+        self.stats = stats
+        self.limits = limits
+        self.reductions_left = None
+        self.deadline = None
+        self.time_check = self.time_check_interval
+        if limits is not None:
+            self.reductions_left = limits.max_reductions
+            if limits.time_limit is not None:
+                self.deadline = time.time()+limits.time_limit
+        self.on_complete = on_complete
+        self.symbols = set(symbols) if symbols is not None else None
+        self.window = max(1, window if window is not None else self.default_window)
+        self.buffer = ''
+        self.offset = 0
+        self.shift = Shift() if incremental else None
+        self.levels = {0 : {0 : StackNode(0, 0, self.shift)}}
+        self.positions = [0]
+        self.terminal_matches = {}
+        self.accepted_stacks = []
+        self.longest_stacks = []
+        self.committed = 0
+        self.finished = False
+        self.resync = None
+        if release and incremental:
+            raise ValueError("an incremental session cannot release its forest")
+        self.release = release
+        if memory_limit is not None and resident_memory() is None:
+            raise ValueError("cannot measure the memory of the process")
+        self.memory_limit = memory_limit
+        self.memory_check = self.memory_check_interval
+        self.checkpoints = [StackNode(0, 0, self.shift)] if incremental else None
+
+    @property
+    def end(self):
+        return self.offset+len(self.buffer)
+
+    def feed(self, chunk):
+        if self.finished:
+            raise ValueError("cannot feed input to a finished parse")
+        self.buffer += chunk
+        self.advance(False)
+        self.trim()
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self.advance(True)
+        return self.accepted_stacks, self.longest_stacks
+
+    def advance(self, final):
+        """
+        Process the pending levels in the order of their positions, as far as
+        the buffered input allows.
+
+        The stack graph and the parse forest are acyclic, but the cyclic
+        garbage collector scans the growing forest over and over again. If
+        the parser was created with disable_gc, we pause it until we return.
+        This affects the whole process, including on_complete and other
+        threads.
+        """
+        if not self.parser.disable_gc or not gc.isenabled():
+            self.parse_levels(final)
+            return
+        gc.disable()
+        try:
+            self.parse_levels(final)
+        finally:
+            gc.enable()
+
+    def parse_levels(self, final):
+        levels = self.levels
+        positions = self.positions
+        while positions:
+            pos = positions[0]
+            if not final and not self.is_settled(pos):
+                break
+            heapq.heappop(positions)
+            frontier = levels.pop(pos)
+
+            if self.debug:
+                print("{} stack heads at position {}".format(len(frontier), pos))
+
+            self.reduce_stack_heads(frontier, pos)
+
+            accepted = frontier.pop(-1, None)
+            if accepted is not None and pos == self.end:
+                self.accepted_stacks.append(accepted)
+
+            if frontier:
+                self.longest_stacks = list(frontier.values())
+
+            if self.limits is not None:
+                self.check_limits(frontier, pos)
+
+            if self.stats is not None:
+                self.stats.count_level(frontier)
+
+            self.shift_stack_heads(frontier)
+            self.terminal_matches.pop(pos, None)
+
+            if self.on_complete is not None:
+                self.commit()
+
+            if self.memory_limit is not None:
+                self.memory_check -= 1
+                if not self.memory_check:
+                    self.memory_check = self.memory_check_interval
+                    self.check_memory(pos)
+
+            if self.checkpoints is not None and len(positions) == 1:
+                level = levels[positions[0]]
+                if len(level) == 1:
+                    node = next(iter(level.values()))
+                    # the reductions of the level still add to the node
+                    checkpoint = StackNode(node.state, node.pos, self.shift)
+                    checkpoint.edges = list(node.edges)
+                    self.checkpoints.append(checkpoint)
+                    if self.resync is not None and self.splice(node):
+                        return
+
+    def check_limits(self, frontier, pos):
+        """
+        Check the time limit and prune the stack heads of the level to the
+        best ones if there are more than the limits allow.
+        """
+        limits = self.limits
+        if self.deadline is not None and time.time() > self.deadline:
+            self.exceed_limit('time', pos)
+        max_heads = limits.max_heads
+        if max_heads is None or len(frontier) <= max_heads:
+            return
+        nodes = sorted(frontier.values(), key=lambda node: limits.rank(self, node, pos), reverse=True)
+        for node in nodes[max_heads:]:
+            del frontier[node.state]
+        if self.stats is not None:
+            self.stats.pruned_heads += len(nodes)-max_heads
+
+    def exceed_limit(self, limit, pos):
+        raise ParseLimitExceeded(limit, pos, self.accepted_stacks, self.longest_stacks)
+
+    def check_memory(self, pos):
+        memory = resident_memory()
+        if memory > self.memory_limit:
+            raise MemoryLimitExceeded(
+                "The parser uses {:.1f} MB of memory at position {}, the limit is {:.1f} MB".format(
+                    memory/1024.0/1024.0, pos, self.memory_limit/1024.0/1024.0))
+
+    def trim(self):
+        """
+        Drop the input before the lowest pending position. To keep the cost
+        of copying linear, we only do so once it makes up half the buffer.
+        """
+        if self.checkpoints is not None:
+            return
+        keep = self.positions[0] if self.positions else self.end
+        drop = keep-self.offset
+        if drop > 0 and drop*2 >= len(self.buffer):
+            self.buffer = self.buffer[drop:]
+            self.offset += drop
+
+    def match(self, matcher, pos):
+        offset = self.offset
+        if not offset:
+            matches = matcher.match(self.buffer, pos)
+        else:
+            matches = [(terminal, value, end+offset)
+                       for terminal, value, end in matcher.match(self.buffer, pos-offset)]
+        if self.stats is not None:
+            self.stats.count_matches(matches)
+        return matches
+
+    def get_terminal_matches(self, pos):
+        """
+        Return the terminals that match at the given position as a bit mask
+        of their IDs and the matches themselves. This is determined once per
+        level.
+        """
+        terminal_matches = self.terminal_matches.get(pos)
+        if terminal_matches is None:
+            mask = 0
+            matches = self.match(self.parser.terminal_matcher, pos)
+            for terminal, value, end in matches:
+                mask |= 1 << terminal
+            terminal_matches = self.terminal_matches[pos] = (mask, matches)
+        return terminal_matches
+
+    def is_settled(self, pos):
+        """
+        Check whether more input cannot change the terminals that matter at
+        the given position: those that the stack nodes of the level can shift
+        and those that the reductions look at, which include everything that
+        the nodes created by the reductions can shift (see Parser.decisive_mask).
+        """
+        if pos+self.window > self.end:
+            return False
+        parser = self.parser
+        mask = parser.decisive_mask
+        for state in self.levels[pos]:
+            mask |= parser.shift_masks[state]
+        return not parser.terminal_matcher.partial_matches(self.buffer, pos-self.offset, mask)
+
+    def can_reduce(self, rule, i):
+        """
+        Check whether any terminal of the lookahead set of the rule matches at
+        position i.
+        """
+        return self.parser.lookaheads[rule] & self.get_terminal_matches(i)[0] != 0
+
+    def get_paths(self, node, length, first_edge=None):
+        """
+        Enumerate the paths of the given length that start at the given node
+        by walking the stack graph depth-first. If first_edge is given, only
+        paths starting with that edge are considered.
+
+        Yields (ancestor, values, starts) tuples, where values are the semantic
+        values along the path from left to right and starts their positions.
+        """
+        if length == 0:
+            yield node, (), ()
+            return
+        if first_edge is not None:
+            edges = [first_edge]
+        else:
+            edges = node.edges
+        stack = [(edge, length, (), ()) for edge in edges]
+        while stack:
+            edge, remaining, values, starts = stack.pop()
+            semantic_value, parent = edge
+            values = (semantic_value,) + values
+            starts = (parent.pos,) + starts
+            remaining -= 1
+            if remaining == 0:
+                yield parent, values, starts
+            else:
+                for parent_edge in parent.edges:
+                    stack.append((parent_edge, remaining, values, starts))
+
+    def shift_stack_heads(self, frontier):
+        """
+        Shift all terminals that match at the nodes of the frontier. The new
+        nodes are added to the level of the position right after the matched
+        terminal, where nodes with the same state are merged.
+
+        If we already matched all terminals at the position of the level, we
+        pick the ones that a node can shift from these matches instead of
+        matching its terminals again.
+        """
+        levels = self.levels
+        positions = self.positions
+        matchers = self.parser.matchers
+        shift_masks = self.parser.shift_masks
+        goto_base = self.parser.goto_base
+        goto_next = self.parser.goto_next
+        for node in frontier.values():
+            if self.debug:
+                print(node.pos, "---", node.state, node.edges)
+
+            matcher = matchers[node.state]
+            if matcher is None:
+                continue
+
+            terminal_matches = self.terminal_matches.get(node.pos)
+            if terminal_matches is not None:
+                shift_mask = shift_masks[node.state]
+                if not shift_mask & terminal_matches[0]:
+                    continue
+                matches = [match for match in terminal_matches[1] if shift_mask >> match[0] & 1]
+            else:
+                matches = self.match(matcher, node.pos)
+
+            for terminal, semantic_value, j in matches:
+                # the matcher only reports terminals that the state can shift
+                state = goto_next[goto_base[node.state]+terminal]
+
+                if self.debug:
+                    print("Shifting:", semantic_value, "to state", state)
+
+                level = levels.get(j)
+                if level is None:
+                    level = levels[j] = {}
+                    heapq.heappush(positions, j)
+                target = level.get(state)
+                if target is None:
+                    target = level[state] = StackNode(state, j, self.shift)
+                target.add_edge(semantic_value, node)
+
+    def make_derivation(self, rule, values, starts, pos, intermediates):
+        """
+        Turn the children of a reduction into the (left, right) pair of a
+        binarised derivation, sharing the intermediate nodes for common
+        suffixes of the children between all reductions of the level.
+        """
+        n = len(values)
+        if n <= 2:
+            if n == 2:
+                return values
+            if n == 1:
+                return values[0], None
+            return None, None
+        right = values[-1]
+        for k in range(n-2, 0, -1):
+            key = (rule, k, starts[k])
+            intermediate = intermediates.get(key)
+            if intermediate is None:
+                intermediate = intermediates[key] = IntermediateNode(rule, k, starts[k], pos, self.shift)
+            intermediate.add_derivation(rule, values[k], right)
+            right = intermediate
+        return values[0], right
+
+    def reduce_stack_heads(self, frontier, pos):
+        """
+        Perform all possible reductions on the nodes of the frontier, a dict
+        of the stack nodes at position pos keyed by their state. Reductions
+        either create new nodes in the frontier or new edges between existing
+        nodes. For a new edge we only need to perform the reductions whose
+        paths go through it.
+
+        The semantic value of a reduction is the parse forest node for the
+        reduced non-terminal and its span, which is shared by all reductions
+        that produce it. Different derivations of it are packed into the node.
+
+        The tables contain right-nulled reductions (as in RNGLR): a rule whose
+        remaining symbols are nullable is reduced without waiting for them,
+        and their null forests (see null_node) are added to the derivation.
+        So a reduction never has to go through an edge between two nodes of
+        the same level: for a new edge we only need to perform the reductions
+        of its node that start with it, and none at all for the edges of
+        reductions that pop no symbols, which yield the null forest of the
+        non-terminal.
+
+        Reductions are filtered by the follow restrictions, priorities and
+        associativity of their rules (see Parser). Reject rules do not create
+        anything but remove the node of their non-terminal and span once the
+        level is reduced (see prune_rejected).
+
+        A level with a single node is reduced like a plain LR parser would do
+        it for as long as possible (see reduce_deterministic).
+        """
+        parser = self.parser
+        lookahead = parser.lookahead
+        symbol_nodes = {}
+        intermediates = {}
+        if lookahead and len(frontier) == 1:
+            reductions = deque(self.reduce_deterministic(frontier, pos, symbol_nodes, intermediates))
+            if not reductions:
+                return
+        else:
+            reductions = deque([(node, None, False) for node in frontier.values()])
+        start_symbol = parser.start_symbol
+        symbols = parser.symbols
+        rule_symbols = parser.rule_symbols
+        reduce_offsets = parser.reduce_offsets
+        reduce_rules = parser.reduce_rules
+        reduce_lengths = parser.reduce_lengths
+        reduce_nulls = parser.reduce_nulls
+        goto_base = parser.goto_base
+        goto_next = parser.goto_next
+        backreferences = parser.backreferences
+        excluded_children = parser.excluded_children
+        reject_rules = parser.reject_rules
+        lookaheads = parser.lookaheads
+        follow_masks = parser.follow_masks
+        matched_terminals = self.get_terminal_matches(pos)[0]
+        rejected = set()
+        stats = self.stats
+        budget = self.reductions_left
+        deadline = self.deadline
+        time_check = self.time_check
+        # (node, first edge of the paths, only reductions that pop nothing?)
+        while reductions:
+            node, first_edge, nulled = reductions.popleft()
+            if node.state == -1:
+                continue
+            for k in range(reduce_offsets[node.state], reduce_offsets[node.state+1]):
+                reduce_rule = reduce_rules[k]
+                reduce_length = reduce_lengths[k]
+                if reduce_length == 0:
+                    if first_edge is not None:
+                        continue
+                elif nulled:
+                    continue
+                if lookahead and not lookaheads[reduce_rule] & matched_terminals:
+                    continue
+                if follow_masks[reduce_rule] & matched_terminals:
+                    continue
+                non_terminal = rule_symbols[reduce_rule]
+                if self.debug:
+                    print("\nReducing with rule",self.parser.rule_as_str(reduce_rule))
+                paths = list(self.get_paths(node, reduce_length, first_edge))
+                if stats is not None:
+                    stats.path_enumerations += 1
+                    stats.paths += len(paths)
+                nulls = reduce_nulls[k]
+                references = backreferences.get(reduce_rule)
+                excluded = excluded_children.get(reduce_rule)
+                for ancestor, values, starts in paths:
+                    # the limits count every path, even if the filters discard it
+                    if budget is not None:
+                        budget -= 1
+                        if budget < 0:
+                            self.reductions_left = budget
+                            self.exceed_limit('reductions', pos)
+                    if deadline is not None:
+                        time_check -= 1
+                        if not time_check:
+                            time_check = self.time_check_interval
+                            if time.time() > deadline:
+                                self.exceed_limit('time', pos)
+                    if reduce_length == 0:
+                        semantic_value = self.null_node(non_terminal, pos, symbol_nodes, intermediates)
+                    else:
+                        if nulls:
+                            values += tuple([self.null_node(symbol, pos, symbol_nodes, intermediates)
+                                             for symbol in nulls])
+                            starts += (pos,)*len(nulls)
+                        if references is not None and not self.same_alternatives(references, values):
+                            continue
+                        if excluded is not None and self.has_excluded_children(excluded, values):
+                            continue
+                        key = (non_terminal, ancestor.pos)
+                        if reduce_rule in reject_rules:
+                            rejected.add(key)
+                            continue
+                        semantic_value = symbol_nodes.get(key)
+                        if semantic_value is None:
+                            semantic_value = symbol_nodes[key] = SymbolNode(symbols[non_terminal], ancestor.pos, pos, self.shift)
+                        left, right = self.make_derivation(reduce_rule, values, starts, pos, intermediates)
+                        if semantic_value.add_derivation(reduce_rule, left, right) and semantic_value.is_ambiguous:
+                            if self.debug:
+                                print("Competing interpretations for", semantic_value)
+                            if stats is not None:
+                                stats.count_ambiguity(semantic_value)
+                    if stats is not None:
+                        stats.count_reduction(node.state, reduce_rule)
+                    if non_terminal == start_symbol: #this is the end state
+                        new_state = -1
+                    else:
+                        new_state = goto_next[goto_base[ancestor.state]+non_terminal]
+                    target = frontier.get(new_state)
+                    if target is None:
+                        target = frontier[new_state] = StackNode(new_state, pos, self.shift)
+                        target.add_edge(semantic_value, ancestor)
+                        reductions.append((target, None, reduce_length == 0))
+                        continue
+                    if stats is not None:
+                        stats.merges += 1
+                    if target.get_edge(ancestor) is not None:
+                        # the edge carries the forest node we just added to
+                        continue
+                    edge = target.add_edge(semantic_value, ancestor)
+                    if reduce_length:
+                        reductions.append((target, edge, False))
+        self.reductions_left = budget
+        self.time_check = time_check
+        if rejected:
+            self.prune_rejected(frontier, rejected, symbol_nodes, intermediates)
+
+    def has_excluded_children(self, excluded, values):
+        """
+        Check whether all derivations of the first or the last child of a
+        reduction are excluded by the priority or associativity of the rule.
+        excluded are the sets of rules excluded for both children.
+        """
+        for child, rules in ((values[0], excluded[0]), (values[-1], excluded[1])):
+            if rules and isinstance(child, SymbolNode) and child.packed:
+                for packed in child.packed:
+                    if not packed.rule in rules:
+                        break
+                else:
+                    return True
+        return False
+
+    def prune_rejected(self, frontier, rejected, symbol_nodes, intermediates):
+        """
+        Remove the forest nodes of the level that a reject rule matched, given
+        by their (non-terminal, start) keys, and everything built on them: the
+        derivations that contain them, the forest nodes that are left without
+        derivations and the stack edges that carry any of those. Stack nodes
+        that are left without edges are removed from the frontier.
+        """
+        dead = set([id(symbol_nodes[key]) for key in rejected if key in symbol_nodes])
+        if not dead:
+            return
+        nodes = list(intermediates.values())+list(symbol_nodes.values())
+        changed = True
+        while changed:
+            changed = False
+            for node in nodes:
+                if id(node) in dead:
+                    continue
+                packed = [p for p in node.packed if not id(p.left) in dead and not id(p.right) in dead]
+                if len(packed) != len(node.packed):
+                    node.packed = packed
+                    changed = True
+                    if not packed:
+                        dead.add(id(node))
+        removed = set()
+        changed = True
+        while changed:
+            changed = False
+            for state, node in list(frontier.items()):
+                edges = [edge for edge in node.edges
+                         if not id(edge[0]) in dead and not id(edge[1]) in removed]
+                if len(edges) != len(node.edges):
+                    node.edges = edges
+                    changed = True
+                    if not edges:
+                        removed.add(id(node))
+                        del frontier[state]
+
+    def null_node(self, symbol, pos, symbol_nodes, intermediates):
+        """
+        Return the null forest of the nullable non-terminal with the given ID
+        at the given position: the node for its empty span with a derivation
+        for each of its rules whose symbols are all nullable. Like any other
+        forest node, it is shared by all reductions of the level.
+        """
+        key = (symbol, pos)
+        node = symbol_nodes.get(key)
+        if node is not None:
+            return node
+        parser = self.parser
+        node = symbol_nodes[key] = SymbolNode(parser.symbols[symbol], pos, pos, self.shift)
+        for rule, nulls in parser.null_rules[symbol]:
+            values = [self.null_node(null, pos, symbol_nodes, intermediates) for null in nulls]
+            left, right = self.make_derivation(rule, values, [pos]*len(values), pos, intermediates)
+            node.add_derivation(rule, left, right)
+        return node
+
+    def reduce_deterministic(self, frontier, pos, symbol_nodes, intermediates):
+        """
+        Perform the reductions of a level that has a single stack node like a
+        plain LR parser: as long as the terminals that match at the position
+        call for exactly one action in the state of the node and that action
+        is a reduction along a single path of the stack graph, we reduce and
+        continue with the new node. We skip the path enumeration and work
+        lists of the generalized algorithm, but create the same stack nodes
+        and forest nodes as it would.
+
+        As several terminals can match at a position, whether a state acts
+        deterministically is decided by its shift mask and the lookahead sets
+        of its reductions for the terminals that actually match.
+
+        Returns the reductions that the generalized algorithm has to perform,
+        as (node, first edge, nulled) tuples.
+        """
+        parser = self.parser
+        shift_masks = parser.shift_masks
+        lookaheads = parser.lookaheads
+        rule_symbols = parser.rule_symbols
+        reduce_offsets = parser.reduce_offsets
+        reduce_rules = parser.reduce_rules
+        reduce_lengths = parser.reduce_lengths
+        reduce_nulls = parser.reduce_nulls
+        goto_base = parser.goto_base
+        goto_next = parser.goto_next
+        backreferences = parser.backreferences
+        excluded_children = parser.excluded_children
+        follow_masks = parser.follow_masks
+        rejectable = parser.rejectable
+        matched_terminals = self.get_terminal_matches(pos)[0]
+        node = next(iter(frontier.values()))
+        nulled = False
+        while True:
+            state = node.state
+            if state == -1:
+                return ()
+            reduction = None
+            for k in range(reduce_offsets[state], reduce_offsets[state+1]):
+                if nulled and reduce_lengths[k]:
+                    continue
+                reduce_rule = reduce_rules[k]
+                if lookaheads[reduce_rule] & matched_terminals and not follow_masks[reduce_rule] & matched_terminals:
+                    if reduction is not None:
+                        return ((node, None, nulled),)
+                    reduction = k
+            if reduction is None:
+                return ()
+            if shift_masks[state] & matched_terminals:
+                return ((node, None, nulled),)
+            reduce_rule = reduce_rules[reduction]
+            if rule_symbols[reduce_rule] in rejectable:
+                # a reject rule may still remove what we would build
+                return ((node, None, nulled),)
+
+            n = reduce_lengths[reduction]
+            values = [None]*n
+            starts = [None]*n
+            ancestor = node
+            for i in range(n-1, -1, -1):
+                if len(ancestor.edges) != 1:
+                    return ((node, None, nulled),)
+                values[i], ancestor = ancestor.edges[0]
+                starts[i] = ancestor.pos
+
+            non_terminal = rule_symbols[reduce_rule]
+            if non_terminal == parser.start_symbol:
+                new_state = -1
+            else:
+                new_state = goto_next[goto_base[ancestor.state]+non_terminal]
+            if new_state in frontier:
+                return ((node, None, nulled),)
+            if self.debug:
+                print("\nReducing deterministically with rule", parser.rule_as_str(reduce_rule))
+            if n == 0:
+                semantic_value = self.null_node(non_terminal, pos, symbol_nodes, intermediates)
+            else:
+                for symbol in reduce_nulls[reduction]:
+                    values.append(self.null_node(symbol, pos, symbol_nodes, intermediates))
+                    starts.append(pos)
+                references = backreferences.get(reduce_rule)
+                if references is not None and not self.same_alternatives(references, values):
+                    return ()
+                excluded = excluded_children.get(reduce_rule)
+                if excluded is not None and self.has_excluded_children(excluded, values):
+                    return ()
+                key = (non_terminal, ancestor.pos)
+                semantic_value = symbol_nodes.get(key)
+                if semantic_value is None:
+                    semantic_value = symbol_nodes[key] = SymbolNode(parser.symbols[non_terminal], ancestor.pos, pos, self.shift)
+                left, right = self.make_derivation(reduce_rule, values, starts, pos, intermediates)
+                semantic_value.add_derivation(reduce_rule, left, right)
+            if self.stats is not None:
+                self.stats.count_reduction(state, reduce_rule)
+            if self.reductions_left is not None:
+                self.reductions_left -= 1
+                if self.reductions_left < 0:
+                    self.exceed_limit('reductions', pos)
+            if self.deadline is not None:
+                self.time_check -= 1
+                if not self.time_check:
+                    self.time_check = self.time_check_interval
+                    if time.time() > self.deadline:
+                        self.exceed_limit('time', pos)
+            node = frontier[new_state] = StackNode(new_state, pos, self.shift)
+            node.add_edge(semantic_value, ancestor)
+            nulled = n == 0
+
+    def same_alternatives(self, references, values):
+        """
+        Check whether the back-references of a rule take the same alternative
+        as the groups that they refer to. references are (position, group
+        position) pairs, values the children of the reduction, and the
+        alternatives are told apart by the rules of their derivations.
+        """
+        for i, j in references:
+            rules = set([packed.rule for packed in values[j].packed])
+            for packed in values[i].packed:
+                if packed.rule in rules:
+                    break
+            else:
+                return False
+        return True
+
+    def commit(self):
+        """
+        If the stack graph consists of a single stack up to the committed
+        position, hand the new forest nodes on it to on_complete.
+        """
+        if len(self.positions) != 1:
+            return
+        level = self.levels[self.positions[0]]
+        if len(level) != 1:
+            return
+        node = next(iter(level.values()))
+        values = []
+        while node.pos > self.committed:
+            if len(node.edges) != 1:
+                return
+            value, node = node.edges[0]
+            values.append((value, node.pos))
+        for value, start in reversed(values):
+            if not self.emit(value, start):
+                return
+
+    def emit(self, value, start):
+        """
+        Hand the nodes of the given subtree that lie behind the committed
+        position to on_complete, from left to right. Returns False if we hit
+        an ambiguous node, as its children are not committed yet.
+
+        If the session releases its forest, we empty the committed nodes
+        below the given one, which is on the stack.
+        """
+        symbols = self.symbols
+        release = self.release
+        root = value
+        stack = [(value, start)]
+        while stack:
+            value, start = stack.pop()
+            if not isinstance(value, SymbolNode):
+                if symbols is None:
+                    end = start + (len(value) if value != '\0' else 0)
+                    self.committed = max(self.committed, end)
+                continue
+            if value.start == value.end:
+                continue
+            if value.end <= self.committed:
+                if release and value is not root:
+                    value.packed = []
+                continue
+            if value.start >= self.committed and (symbols is None or value.symbol in symbols):
+                self.on_complete(value)
+                self.committed = value.end
+                if release and value is not root:
+                    value.packed = []
+                continue
+            if value.is_ambiguous:
+                return False
+            children = []
+            pos = value.start
+            for child in value.children:
+                children.append((child, pos))
+                if isinstance(child, SymbolNode):
+                    pos = child.end
+                elif child != '\0':
+                    pos += len(child)
+            stack.extend(reversed(children))
+        return True
+
+    def reparse(self, edits):
+        """
+        Parse the input of this finished incremental session after applying
+        the given edits, a list of (offset, deleted length, inserted text)
+        tuples that are applied one after another. Returns a new finished
+        session.
+
+        We resume from the last checkpoint at least `window` characters before
+        the first edit, reusing the stack graph and the forest below it. After
+        the edits, we look for a checkpoint whose stack has the same states as
+        the stack of this session at the corresponding position: from there on,
+        the parse would be the same as before, so we stop and splice the
+        forest of this session onto the new stack instead (see splice()).
+
+        The stack graph, the forest and the checkpoints of this session behind
+        the sync point are taken over by the new session, so that later edits
+        are reparsed incrementally as well. Their positions are shifted by the
+        difference in length of the edited input lazily, when they are read
+        (see Shift). This session cannot be reparsed again afterwards.
+        """
+        if self.checkpoints is None or not self.finished:
+            raise ValueError("only finished incremental parses can be reparsed")
+        text = self.buffer
+        damage_start = damage_end = None
+        for offset, length, inserted in edits:
+            text = text[:offset] + inserted + text[offset+length:]
+            if damage_start is None:
+                damage_start, damage_end = offset, offset+len(inserted)
+                continue
+            if damage_end >= offset+length:
+                damage_end += len(inserted)-length
+            damage_start = min(damage_start, offset)
+            damage_end = max(damage_end, offset+len(inserted))
+        if damage_start is None:
+            damage_start = damage_end = len(text)
+
+        session = self.__class__(self.parser, window=self.window, incremental=True)
+        session.buffer = text
+        i = max(0, bisect.bisect_right(self.checkpoints, damage_start-self.window, key=StackNode.position)-1)
+        checkpoint = self.checkpoints[i]
+        # the stack below the checkpoint may still miss the shifts of earlier
+        # reparses, which the parser does not apply by itself
+        parents = [checkpoint]
+        seen = set()
+        while parents:
+            for value, parent in parents.pop().edges:
+                if not id(parent) in seen:
+                    seen.add(id(parent))
+                    parent.catch_up()
+                    parents.append(parent)
+        node = StackNode(checkpoint.state, checkpoint.pos, session.shift)
+        node.edges = list(checkpoint.edges)
+        session.levels = {node.pos : {node.state : node}}
+        session.positions = [node.pos]
+        # the checkpoints behind the last position are overwritten or invalid
+        session.checkpoints = self.checkpoints[:i+1]
+        if self.accepted_stacks:
+            session.resync = (self, node.pos, damage_end, len(text)-len(self.buffer))
+        session.finish()
+        if self.shift.next is None:
+            # nothing was spliced, the nodes that the new session reuses keep
+            # their positions
+            self.shift.next = session.shift
+        self.checkpoints = None
+        return session
+
+    def splice(self, node):
+        """
+        Check whether the stack graph below the given node, which is the only
+        node of its level, has the same shape and states as the stack graph of
+        the previous session at the corresponding position. If so, the rest of
+        the previous parse applies to the new input as well: we move the nodes
+        of the previous stack to the new positions and turn their values into
+        copies of the new ones, in place, so that the forest and the stack
+        graph of the previous parse behind them build on the new parse, and
+        accept the result.
+
+        This only touches the stacks at the sync point. The rest of the
+        previous parse follows the shift of the previous session, which we
+        fill in at the end. The previous stack replaces the new one, so we
+        drop the checkpoints of this session that lead to the new stack or to
+        nodes of the previous stack that it shares with the parse before the
+        resume point.
+        """
+        previous, resume, damage_end, delta = self.resync
+        if node.pos < damage_end:
+            return False
+        sync = node.pos-delta
+        checkpoints = previous.checkpoints
+        if sync > checkpoints[-1].position():
+            self.resync = None
+            return False
+        i = bisect.bisect_left(checkpoints, sync, key=StackNode.position)
+        old_node = checkpoints[i]
+        if old_node.pos != sync or old_node.state != node.state:
+            return False
+
+        positions = {}
+        paired = {}
+        values = {}
+        new_nodes = set()
+        new_values = set()
+        limit = node.pos
+        pairs = [(node, old_node)]
+        while pairs:
+            new, old = pairs.pop()
+            if new is old:
+                continue
+            if id(old) in paired:
+                if paired[id(old)][1] is not new:
+                    return False
+                continue
+            paired[id(old)] = (old, new)
+            new_nodes.add(id(new))
+            old.catch_up()
+            if new.state != old.state or len(new.edges) != len(old.edges):
+                return False
+            if positions.setdefault(old.pos, new.pos) != new.pos:
+                return False
+            limit = min(limit, new.pos+1)
+            if old.pos < resume and old.pos != new.pos:
+                limit = min(limit, old.pos)
+            for (new_value, new_parent), (old_value, old_parent) in zip(new.edges, old.edges):
+                if new_value is not old_value:
+                    if isinstance(old_value, ForestNode):
+                        if type(new_value) is not type(old_value):
+                            return False
+                        if values.setdefault(id(old_value), (old_value, new_value))[1] is not new_value:
+                            return False
+                        new_values.add(id(new_value))
+                        limit = min(limit, new.pos, old.pos)
+                    elif new_value != old_value:
+                        return False
+                pairs.append((new_parent, old_parent))
+        if any(key in new_nodes for key in paired) or any(key in new_values for key in values):
+            return False
+
+        # values of the previous stack from before the resume point are part
+        # of the new parse as well, which keeps referring to copies of them
+        copies = {}
+        for key, (old, new) in values.items():
+            if old.end <= resume:
+                copies[key] = copy.copy(old)
+        if copies:
+            start = min(value.end for value in copies.values())
+            seen = set()
+            nodes = [new for old, new in values.values()]
+            while nodes:
+                for packed in nodes.pop().packed:
+                    for child in (packed.left, packed.right):
+                        if not isinstance(child, ForestNode) or child.end < start:
+                            continue
+                        if id(child) in copies:
+                            if child is packed.left:
+                                packed.left = copies[id(child)]
+                            else:
+                                packed.right = copies[id(child)]
+                        elif not id(child) in seen:
+                            seen.add(id(child))
+                            nodes.append(child)
+
+        for old, new in values.values():
+            old.replace(new)
+        for old, new in paired.values():
+            old.pos = new.pos
+            old.shift = self.shift
+        shift = previous.shift
+        shift.sync = sync
+        shift.delta = delta
+        shift.positions = positions
+        shift.next = self.shift
+
+        for accepted in previous.accepted_stacks:
+            stack = StackNode(-1, self.end, self.shift)
+            stack.edges = list(accepted.edges)
+            self.accepted_stacks.append(stack)
+        self.longest_stacks = list(self.accepted_stacks)
+        kept = max(1, bisect.bisect_left(self.checkpoints, limit, key=StackNode.position))
+        self.checkpoints = self.checkpoints[:kept]+checkpoints[i:]
+        self.levels.clear()
+        del self.positions[:]
+        self.resync = None
+        return True
+
 class Parser(object):
 
-    def __init__(self, grammar, debug=False):
-        self.grammar = grammar
+    """
+    A GLR parser for the given grammar, a list of rules [non-terminal,
+    symbols...]. A rule may end with a dict of options, which declare
+    filters that prune ambiguous parses while parsing:
+
+    * 'priority' : n -- the first and the last child of the rule may not be
+      derived by a rule of their non-terminal with a lower priority, so
+      rules with a higher priority bind tighter.
+    * 'assoc' : 'left', 'right' or 'nonassoc' -- the last (for 'left'), the
+      first (for 'right') or both children may not be derived by the rule
+      itself or by a rule of the same non-terminal and priority.
+    * 'reject' : True -- the input that the rule matches is not a valid
+      derivation of its non-terminal (e.g. keywords that are no names).
+    * 'follow' : (terminals...) -- the non-terminal may not be followed by
+      any of the terminals.
+    * 'longest' : True -- the non-terminal may not be followed by a terminal
+      that could extend it, so it always matches as much as it can.
+    * 'layout' : True -- the non-terminal is layout (whitespace, comments),
+      which we scan as a single terminal instead of parsing it (see
+      expand_layout).
+    * 'backreferences' : ((position, group position),...) -- see
+      make_grammar.
+
+    The follow restrictions apply to all rules of the non-terminal. All
+    filters look at the terminals that match right after a reduction and at
+    the derivations of the children that exist when the rule is reduced.
+
+    With disable_gc, the parser pauses the cyclic garbage collector of the
+    process while it parses (see ParseSession.advance).
+    """
+
+    # the attributes that make up the parse tables, as stored in the cache
+    table_attributes = (
+        'non_terminals', 'rules_by_non_terminal', 'terminals', 'nullable',
+        'first_sets', 'follow_sets', 'symbols', 'symbol_ids', 'start_symbol',
+        'rule_symbols', 'rule_lengths', 'reduce_offsets', 'reduce_rules',
+        'reduce_lengths', 'reduce_nulls', 'null_rules', 'goto_base',
+        'goto_next', 'goto_check', 'shift_masks', 'lookaheads', 'follow_masks',
+        'matchers', 'terminal_matcher',
+    )
+
+    # the attributes of the LR(0) automaton, see automaton()
+    automaton_attributes = ('closures', 'states', 'state_index', 'transitions',
+                            'callable_transitions')
+
+    # the options that a rule of the grammar can end with
+    rule_option_names = ('backreferences', 'priority', 'assoc', 'reject', 'follow', 'longest',
+                         'layout')
+
+    session_class = ParseSession
+
+    def __init__(self, grammar, debug=False, cache=None, lookahead=True, disable_gc=False):
+        grammar = self.expand_layout(grammar)
+        # a rule may end with a dict of options, which we keep apart from it
+        self.grammar = [rule[:-1] if isinstance(rule[-1], dict) else rule for rule in grammar]
+        self.rule_options = dict([(i, rule[-1]) for i, rule in enumerate(grammar)
+                                  if isinstance(rule[-1], dict)])
+        self.backreferences = dict([(i, options['backreferences'])
+                                    for i, options in self.rule_options.items()
+                                    if 'backreferences' in options])
         self.debug = debug
-        self.generate_states_and_transitions()
+        self.lookahead = lookahead
+        self.disable_gc = disable_gc
+        for i, options in self.rule_options.items():
+            for name in options:
+                if not name in self.rule_option_names:
+                    raise GrammarError("Unknown option {} of rule {}".format(name, self.rule_as_str(i)))
+        self.fingerprint = grammar_fingerprint(grammar)
+        if cache is None or self.fingerprint is None:
+            self.generate_states_and_transitions()
+        else:
+            tables = cache.load(self.fingerprint)
+            if tables is not None:
+                for name in self.table_attributes:
+                    setattr(self, name, tables[name])
+            else:
+                self.generate_states_and_transitions()
+                cache.store(self.fingerprint, dict([(name, getattr(self, name))
+                                                   for name in self.table_attributes]))
+        self.check_layout()
+        self.index_filters()
+        # the terminals that can decide a reduction: those of the lookahead
+        # sets and follow restrictions, which include all terminals that a
+        # state reached by a reduction can shift
+        self.decisive_mask = 0
+        for mask in self.lookaheads:
+            self.decisive_mask |= mask
+        for mask in self.follow_masks:
+            self.decisive_mask |= mask
+
+    def expand_layout(self, grammar):
+        """
+        Replace the rules of every layout non-terminal with a rule that
+        matches it as a single regular expression terminal, and a rule for
+        the empty string if it is nullable. Both may not be followed by the
+        terminal, so the layout always matches as much as it can. The text of
+        the layout becomes the only child of its node.
+
+        This saves a shift and a reduction per character of the layout, as
+        well as the ambiguities of splitting it into its parts. The rules
+        that only the layout used are dropped. As the layout is greedy, no
+        terminal that follows it may start like it (see check_layout).
+        """
+        self.layout_terminals = {}
+        rules = defaultdict(list)
+        layout = []
+        for rule in grammar:
+            options = rule[-1] if isinstance(rule[-1], dict) else None
+            rules[rule[0]].append(rule[1:-1] if options is not None else rule[1:])
+            if options is not None and options.get('layout') and not rule[0] in layout:
+                layout.append(rule[0])
+        if not layout:
+            return grammar
+        expansions = {}
+        for non_terminal in layout:
+            pattern = self.layout_pattern(rules, non_terminal)
+            terminal = regex(pattern)
+            self.layout_terminals[non_terminal] = terminal
+            expansions[non_terminal] = [[non_terminal, terminal, {'follow' : (terminal,)}]]
+            if re.match(pattern, '', re.MULTILINE|re.DOTALL):
+                expansions[non_terminal].append([non_terminal, {'follow' : (terminal,)}])
+        expanded = []
+        for rule in grammar:
+            if rule[0] in expansions:
+                expanded.extend(expansions.pop(rule[0]))
+            elif not rule[0] in layout:
+                expanded.append(rule)
+        unused = reachable_non_terminals(grammar)-reachable_non_terminals(expanded)
+        return [rule for rule in expanded if not rule[0] in unused]
+
+    def check_layout(self):
+        """
+        Make sure that the greedy layout terminals do not change the language
+        of the grammar: if a terminal that can follow a layout non-terminal
+        could start with a character that the layout can start with, the
+        layout would swallow it, or its follow restriction would forbid it
+        after empty layout. The layout can only follow itself if it can be
+        empty.
+        """
+        for non_terminal, terminal in sorted(self.layout_terminals.items()):
+            for other in sorted(self.follow_sets[non_terminal], key=repr):
+                pattern = terminal_pattern(other)
+                if other == '\0' or pattern is None:
+                    continue
+                if other == terminal:
+                    if non_terminal in self.nullable:
+                        continue
+                    raise GrammarError("Layout {} can follow itself but cannot be empty, "
+                                       "so it cannot be scanned greedily".format(non_terminal))
+                c = common_first_character(terminal.pattern, pattern)
+                if c is not None:
+                    raise GrammarError("Layout {} can start like the terminal {} that follows it ({!r}), "
+                                       "so it cannot be scanned greedily".format(non_terminal, other, c))
+
+    def layout_pattern(self, rules, non_terminal, visiting=()):
+        """
+        Translate a layout non-terminal into a regular expression. This works
+        as long as it only refers to itself at the start or the end of its
+        rules, as a repetition.
+        """
+        if non_terminal in visiting:
+            raise GrammarError("Layout {} is not regular".format(visiting[0]))
+        visiting += (non_terminal,)
+        alternatives, prefixes, suffixes = [], [], []
+        for symbols in rules[non_terminal]:
+            if len(symbols) > 1 and symbols[0] == non_terminal:
+                suffixes.append(symbols[1:])
+            elif len(symbols) > 1 and symbols[-1] == non_terminal:
+                prefixes.append(symbols[:-1])
+            else:
+                alternatives.append(symbols)
+
+        def sequence(symbols):
+            parts = []
+            for symbol in symbols:
+                if symbol in rules:
+                    parts.append(self.layout_pattern(rules, symbol, visiting))
+                elif isinstance(symbol, Regex):
+                    parts.append('(?:{})'.format(symbol.pattern))
+                elif isinstance(symbol, Literal):
+                    parts.append(re.escape(symbol.value))
+                elif symbol == '\0':
+                    parts.append(r'\Z')
+                elif isinstance(symbol, str):
+                    parts.append(re.escape(symbol))
+                else:
+                    raise GrammarError("Layout {} uses the terminal {}, which is no literal or regex".format(
+                        visiting[0], symbol))
+            return ''.join(parts)
+
+        def choice(sequences):
+            # an empty alternative would always match first, so we make the
+            # others optional instead
+            patterns = [sequence(symbols) for symbols in sequences if symbols]
+            if not patterns:
+                return ''
+            pattern = '(?:{})'.format('|'.join(patterns))
+            if len(patterns) < len(sequences):
+                pattern += '?'
+            return pattern
+
+        pattern = choice(alternatives)
+        if prefixes:
+            pattern = choice(prefixes)+'*'+pattern
+        if suffixes:
+            pattern += choice(suffixes)+'*'
+        return pattern
+
+    def index_filters(self):
+        """
+        Index the priority, associativity and reject options of the rules:
+        excluded_children maps a rule to the sets of rules that may not derive
+        its first and its last child, reject_rules holds the reject rules and
+        rejectable the IDs of their non-terminals.
+        """
+        priorities = dict([(i, options['priority']) for i, options in self.rule_options.items()
+                           if 'priority' in options])
+        self.excluded_children = {}
+        for i, options in self.rule_options.items():
+            rule = self.grammar[i]
+            priority = options.get('priority')
+            assoc = options.get('assoc')
+            if (priority is None and assoc is None) or len(rule) == 1:
+                continue
+            excluded = []
+            for child, assocs in ((rule[1], ('right', 'nonassoc')), (rule[-1], ('left', 'nonassoc'))):
+                rules = set()
+                for r in self.rules_by_non_terminal.get(child, ()):
+                    child_priority = priorities.get(r)
+                    if priority is not None and child_priority is not None and child_priority < priority:
+                        rules.add(r)
+                    elif assoc in assocs and child == rule[0] and (
+                            r == i or (priority is not None and child_priority == priority)):
+                        rules.add(r)
+                excluded.append(frozenset(rules))
+            if excluded[0] or excluded[1]:
+                self.excluded_children[i] = tuple(excluded)
+        self.reject_rules = set()
+        for i, options in self.rule_options.items():
+            if options.get('reject'):
+                if len(self.grammar[i]) == 1:
+                    raise GrammarError("Reject rule {} is empty".format(self.rule_as_str(i)))
+                self.reject_rules.add(i)
+        self.rejectable = set([self.rule_symbols[i] for i in self.reject_rules])
+
+    def index_rules(self):
+        """
+        Build the non-terminal -> rules index and the closure of every
+        non-terminal once, so that the state builder never has to rescan the
+        grammar while generating states.
+
+        The closure of a non-terminal is the list of items (r, 0) that have to be
+        added to a state whenever the dot stands in front of that non-terminal.
+        """
+        self.non_terminals = set([rule[0] for rule in self.grammar])
+        self.rules_by_non_terminal = defaultdict(list)
+        for i, rule in enumerate(self.grammar):
+            self.rules_by_non_terminal[rule[0]].append(i)
+        self.closures = {}
+        for non_terminal, rules in self.rules_by_non_terminal.items():
+            # we grow the closure like the recursive builder did, as the
+            # iteration order of the sets decides the numbering of the states
+            closure = set(rules)
+            rules_to_examine = list(rules)
+            while rules_to_examine:
+                r = rules_to_examine.pop()
+                if len(self.grammar[r]) == 1:
+                    continue
+                first = self.grammar[r][1]
+                if first in self.non_terminals:
+                    new_rules = self.rules_by_non_terminal[first]
+                    rules_to_examine.extend([rr for rr in new_rules if not rr in closure])
+                    closure = closure | set(new_rules)
+            self.closures[non_terminal] = [(r, 0) for r in closure]
 
     def get_rules_for_non_terminal(self, non_terminal):
-        matching_rules = []
-        for i,rule in enumerate(self.grammar):
-            if rule[0] == non_terminal:
-                matching_rules.append(i)
-        return matching_rules
+        return list(self.rules_by_non_terminal.get(non_terminal, []))
 
     def get_closure(self, rule, pos):
-        closure = set()
-        rules_to_examine = []
         if pos >= len(self.grammar[rule])-1:
-            return closure
+            return []
         item = self.grammar[rule][pos+1]
         if item in self.non_terminals:
-            rules_for_non_terminal = self.get_rules_for_non_terminal(item)
             if self.debug:
-                print(item, rules_for_non_terminal)
-            closure = set(rules_for_non_terminal)
-            rules_to_examine = rules_for_non_terminal
-        while rules_to_examine:
-            r = rules_to_examine.pop()
-            if len(self.grammar[r]) == 1:
-                continue
-            if self.grammar[r][1] in self.non_terminals:
-                new_rules = self.get_rules_for_non_terminal(self.grammar[r][1])
-                rules_to_examine.extend([rr for rr in new_rules if not rr in closure])
-                closure = closure | set(new_rules)
-        return [(r,0) for r in closure]
+                print(item, self.rules_by_non_terminal[item])
+            return list(self.closures[item])
+        return []
 
-    def extend_state(self, state):
+    def add_state(self, kernel):
+        """
+        Add the state generated by the given kernel (a list of items) and
+        return its index. States are keyed by their kernel, as the kernel fully
+        determines the closed state.
         """
-        Group the rule by the symbol just before the dot. Then, for each of those
-        rules where we can move the dot further to the right, we create a new
-        state and repeat the process. We also create a transition from the current
-        state to the new state for the given terminal / non-terminal symbol that
-        we found.
+        i = len(self.states)
+        state = set(kernel)
+        for r, p in kernel:
+            state = state | set(self.get_closure(r, p))
+        self.state_index[frozenset(kernel)] = i
+        self.states.append(state)
+        return i
 
-        For the rules that are already fully reduced, we add a 'reduce' entry,
-        specifying the reduction that should take place.
+    def extend_state(self, j):
+        """
+        Group the rules of state j by the symbol just after the dot. Then, for
+        each of those rules where we can move the dot further to the right, we
+        look up (or create) the state with the advanced items as its kernel and
+        add a transition from the current state to it for the given terminal /
+        non-terminal symbol.
+
+        For the rules whose remaining symbols are all nullable, which includes
+        the rules that are already fully reduced, we add a 'reduce' entry with
+        the rule and the number of symbols to pop: the remaining symbols are
+        right-nulled and need not be derived from the stack (see RNGLR, Scott
+        and Johnstone 2006). Of the reductions that pop nothing we only keep
+        one per non-terminal, as they all yield its null forest.
+
+        Yields the index of every newly created state right after creating it,
+        so that it can be extended before we look at the next symbol.
         """
-        j = self.states.index(state)
         rules_by_symbol = defaultdict(list)
+        for r, p in self.states[j]:
+            rule = self.grammar[r]
+            if len(rule) > p+1:
+                rules_by_symbol[rule[p+1]].append((r,p+1))
         rules_to_reduce = []
-        for r, p in state:
-            if len(self.grammar[r]) > p+1:
-                symbol = self.grammar[r][p+1]
-                rules_by_symbol[symbol].append((r,p+1))
-            else:
-                rules_to_reduce.append(r)
+        nulled = set()
+        for r, p in sorted(self.states[j]):
+            rule = self.grammar[r]
+            if all([symbol in self.nullable for symbol in rule[p+1:]]):
+                if p == 0:
+                    if rule[0] in nulled:
+                        continue
+                    nulled.add(rule[0])
+                rules_to_reduce.append((r, p))
         if rules_to_reduce:
             self.transitions[j]['__reduce__'] = rules_to_reduce
-        for symbol, new_rules in rules_by_symbol.items():
+        for symbol, new_rules in list(rules_by_symbol.items()):
             if self.debug:
                 print(symbol, new_rules)
-            new_state = set(new_rules)
-            for rr in new_rules:
-                new_state = new_state | set(self.get_closure(*rr))
-            if self.debug:
-                print(new_state)
-            try:
-                i = self.states.index(new_state)
-            except ValueError:
-                i = len(self.states)
-                self.states.append(new_state)
-                self.extend_state(new_state)
-            self.transitions[j][symbol] = i
+            i = self.state_index.get(frozenset(new_rules))
+            if i is None:
+                i = self.add_state(new_rules)
+                if self.debug:
+                    print(self.states[i])
+                self.transitions[j][symbol] = i
+                yield i
+            else:
+                self.transitions[j][symbol] = i
         if self.debug:
             print(rules_by_symbol)
 
-    def generate_states_and_transitions(self):
-        self.non_terminals = set([rule[0] for rule in self.grammar])
+    def generate_automaton(self):
+        """
+        Generate the LR(0) automaton using an explicit stack of the states
+        that are being extended (see index_rules). We extend every new state
+        as soon as we find it, like a recursive builder would, so that the
+        states are numbered in the order of the original recursive version.
+        """
         self.states = list()
+        self.state_index = {}
         self.transitions = defaultdict(dict)
-        state_rules = []
-        state_rules.append((0,0))
-        state_rules.extend(self.get_closure(0, 0))
-        state = set(state_rules)
-        self.states.append(state)
-        self.extend_state(state)
+        self.add_state([(0,0)])
+        states_to_extend = [self.extend_state(0)]
+        while states_to_extend:
+            for i in states_to_extend[-1]:
+                states_to_extend.append(self.extend_state(i))
+                break
+            else:
+                states_to_extend.pop()
 
         # this is an optimization to reduce the number of transitions
         # we need to check...
@@ -311,6 +2497,30 @@ class Parser(object):
                 if callable(kv):
                     self.callable_transitions[k][kv] = v
 
+    def automaton(self):
+        """
+        Return the states, the transitions and the callable transitions of
+        the LR(0) automaton. The parser only keeps the automaton in debug
+        mode, as it needs none of it once the tables are encoded, so we
+        generate it again if it is gone, e.g. after the tables were loaded
+        from the cache.
+        """
+        if not 'states' in self.__dict__:
+            self.index_rules()
+            self.generate_automaton()
+        return self.states, self.transitions, self.callable_transitions
+
+    def generate_states_and_transitions(self):
+        """
+        Generate the LR(0) automaton and encode it in the parse tables.
+        Returns the states, the transitions and the callable transitions of
+        the automaton.
+        """
+        self.index_rules()
+        self.generate_lookaheads()
+        self.generate_automaton()
+        automaton = self.states, self.transitions, self.callable_transitions
+
         self.terminals = set()
 
         for tr in self.transitions.values():
@@ -318,161 +2528,332 @@ class Parser(object):
                 if not k in self.non_terminals and not callable(k) and k != '__reduce__':
                     self.terminals.add(k)
 
-        return self.states, self.transitions, self.callable_transitions
+        self.encode_tables()
+        self.generate_follow_masks()
+        self.generate_matchers()
 
-    def get_paths(self, node, depth):
-        if depth == 0:
-            return [[(tuple(),node)]]
-        paths = []
-        for sem_value,parent in node[2]:
-            parent_paths = self.get_paths(parent, depth-1)
-            for parent_path in parent_paths:
-                paths.append([(sem_value, node)]+parent_path)
-        return paths
+        if not self.debug:
+            for name in self.automaton_attributes:
+                delattr(self, name)
+        return automaton
 
-    def rule_as_str(self, i):
-        return u'{} \u2192 {}'.format(self.grammar[i][0],' '.join([str(s) for s in self.grammar[i][1:]]))
-
-    def get_stack_head(self, stack_heads, state):
-        for head in stack_heads:
-            if head[0] == state:
-                return head
-        return None
-
-    def shift_stack_heads(self, stack_heads_to_process, input):
-
-        new_stack_heads = []
-        while stack_heads_to_process:
-            stack_head = stack_heads_to_process.pop()
-            current_state, i, parents = stack_head
-            if self.debug:
-                print(i,"---", current_state, parents)
-            if i < len(input):
-                current_symbol = input[i:]
-            else:
-                current_symbol = '\0'
-
-            if self.debug:
-                print("\n\nShifting stack heads with state '{}'".format(current_symbol))
-
-            semantic_value = None
-            transition = None
-
-            for tr in self.callable_transitions[current_state]:
-                if callable(tr):
-                    tokens = tr(input[i:])
-                    if tokens:
-                        transition = self.transitions[current_state][tr]
-                        semantic_value = tokens
-            for tr in self.transitions[current_state]:
-                if callable(tr) or not tr in self.terminals:
-                    continue
-                if current_symbol[:len(tr)] == tr:
-                    transition = self.transitions[current_state][tr]
-                    semantic_value = current_symbol[:len(tr)]
-
-            if self.debug:
-                print(self.transitions[current_state], current_state, transition)
-
-            if semantic_value is not None:
-                il = len(semantic_value)
-
-                if semantic_value == '\0':
-                    il = 0
+    def encode_tables(self):
+        """
+        Intern the symbols of the grammar to dense integer IDs and store the
+        automaton in flat integer arrays, so that the parser only ever works
+        with integers. The symbols themselves are looked up in self.symbols
+        when we build the parse forest.
+
+        The reductions of state j are at the indexes reduce_offsets[j] to
+        reduce_offsets[j+1] of reduce_rules (the rule), reduce_lengths (the
+        number of symbols to pop) and reduce_nulls (the IDs of the right-nulled
+        symbols). null_rules lists the rules and children IDs of the null
+        forest of every nullable non-terminal ID. The shift and goto transitions are compressed by
+        row displacement: the row of state j starts at goto_base[j], so the
+        transition of state j for symbol s is goto_next[goto_base[j]+s] if
+        goto_check[goto_base[j]+s] == j (see goto()). We place the rows first
+        fit, the longest first, so that they fill each other's gaps.
+        """
+        self.symbols = []
+        self.symbol_ids = {}
+        for rule in self.grammar:
+            for symbol in rule:
+                if not symbol in self.symbol_ids:
+                    self.symbol_ids[symbol] = len(self.symbols)
+                    self.symbols.append(symbol)
+        for terminal in self.get_follow_terminals():
+            if not terminal in self.symbol_ids:
+                self.symbol_ids[terminal] = len(self.symbols)
+                self.symbols.append(terminal)
+        if not '\0' in self.symbol_ids:
+            self.symbol_ids['\0'] = len(self.symbols)
+            self.symbols.append('\0')
+        self.start_symbol = self.symbol_ids[self.grammar[0][0]]
+
+        self.rule_symbols = array('i', [self.symbol_ids[rule[0]] for rule in self.grammar])
+        self.rule_lengths = array('i', [len(rule)-1 for rule in self.grammar])
+
+        lookahead_masks = {}
+        for non_terminal, follow in self.follow_sets.items():
+            mask = 0
+            for terminal in follow:
+                mask |= 1 << self.symbol_ids[terminal]
+            lookahead_masks[non_terminal] = mask
+        self.lookaheads = [lookahead_masks[rule[0]] for rule in self.grammar]
+
+        self.null_rules = dict([(self.symbol_ids[non_terminal], []) for non_terminal in self.nullable])
+        for i, rule in enumerate(self.grammar):
+            if all([symbol in self.nullable for symbol in rule[1:]]):
+                self.null_rules[self.symbol_ids[rule[0]]].append(
+                    (i, tuple([self.symbol_ids[symbol] for symbol in rule[1:]])))
+
+        n = len(self.states)
+        self.reduce_offsets = array('i', [0])
+        self.reduce_rules = array('i')
+        self.reduce_lengths = array('i')
+        self.reduce_nulls = []
+        rows = []
+        for j in range(n):
+            transitions = self.transitions.get(j, {})
+            for r, p in transitions.get('__reduce__', ()):
+                self.reduce_rules.append(r)
+                self.reduce_lengths.append(p)
+                if p == 0:
+                    self.reduce_nulls.append(())
+                else:
+                    self.reduce_nulls.append(tuple([self.symbol_ids[symbol]
+                                                    for symbol in self.grammar[r][p+1:]]))
+            self.reduce_offsets.append(len(self.reduce_rules))
+            row = sorted([(self.symbol_ids[symbol], i) for symbol, i in transitions.items()
+                          if symbol != '__reduce__'])
+            rows.append((row, j))
+        rows.sort(key=lambda r: -len(r[0]))
+
+        # the terminals that every state can shift, as a bit mask of their IDs
+        self.shift_masks = [0]*n
+        for row, j in rows:
+            for symbol, i in row:
+                if not self.symbols[symbol] in self.non_terminals:
+                    self.shift_masks[j] |= 1 << symbol
+
+        self.goto_base = array('i', [0]*n)
+        self.goto_next = array('i')
+        self.goto_check = array('i')
+        # bit k of used is set if index k of goto_next is taken
+        used = 0
+        for row, j in rows:
+            if not row:
+                continue
+            first = row[0][0]
+            # bit k of collisions is set if the row collides with the rows
+            # placed so far when its first symbol goes to index k
+            collisions = 0
+            for symbol, i in row:
+                collisions |= used >> (symbol-first)
+            k = ((collisions+1) & ~collisions).bit_length()-1
+            base = k-first
+            size = base+row[-1][0]+1
+            if size > len(self.goto_next):
+                self.goto_next.extend([0]*(size-len(self.goto_next)))
+                self.goto_check.extend([-1]*(size-len(self.goto_check)))
+            for symbol, i in row:
+                used |= 1 << (base+symbol)
+                self.goto_next[base+symbol] = i
+                self.goto_check[base+symbol] = j
+            self.goto_base[j] = base
+
+    def goto(self, state, symbol):
+        """
+        Return the state that the given state transitions to for the given
+        symbol ID, or -1 if there is no such transition.
+        """
+        k = self.goto_base[state]+symbol
+        if 0 <= k < len(self.goto_check) and self.goto_check[k] == state:
+            return self.goto_next[k]
+        return -1
 
-                if self.debug:
-                    print("Shifting:", semantic_value)
-                new_stack_head = (transition, i+il, [(semantic_value,stack_head)])
-                existing_stack_head = self.get_stack_head(new_stack_heads, transition)
-                if existing_stack_head:
-                    existing_stack_head[2].append((semantic_value,stack_head))
+    def generate_matchers(self):
+        """
+        Build one terminal matcher per state for shifting, as well as one for
+        all terminals of the grammar that we use to check lookaheads. States
+        with the same set of terminals share a matcher. The matchers report
+        the IDs of the terminals.
+        """
+        matchers_by_terminals = {}
+
+        def get_matcher(terminals):
+            key = frozenset(terminals)
+            if not key in matchers_by_terminals:
+                matchers_by_terminals[key] = TerminalMatcher(terminals, self.symbol_ids)
+            return matchers_by_terminals[key]
+
+        self.matchers = [None]*len(self.states)
+        for j, transitions in self.transitions.items():
+            terminals = [symbol for symbol in transitions
+                         if symbol != '__reduce__' and not symbol in self.non_terminals]
+            if terminals:
+                self.matchers[j] = get_matcher(terminals)
+        all_terminals = set()
+        for rule in self.grammar:
+            all_terminals.update([symbol for symbol in rule[1:]
+                                  if not symbol in self.non_terminals])
+        all_terminals.update(self.get_follow_terminals())
+        all_terminals.add('\0')
+        self.terminal_matcher = get_matcher(all_terminals)
+
+    def generate_lookaheads(self):
+        """
+        Compute the nullable non-terminals as well as the FIRST and FOLLOW
+        sets of all non-terminals. The FOLLOW set of a non-terminal is the
+        (SLR) lookahead set of its rules: a reduction by a rule is only useful
+        if one of the terminals in it can be matched at the current position.
+        encode_tables stores the lookahead sets as bit masks of terminal IDs.
+
+        The end of the input is represented by the '\\0' terminal, which is
+        the only terminal that may follow the start symbol.
+        """
+        self.nullable = set()
+        self.first_sets = dict([(nt, set()) for nt in self.non_terminals])
+        changed = True
+        while changed:
+            changed = False
+            for rule in self.grammar:
+                non_terminal = rule[0]
+                first = self.first_sets[non_terminal]
+                n = len(first)
+                for symbol in rule[1:]:
+                    if symbol in self.non_terminals:
+                        first |= self.first_sets[symbol]
+                        if not symbol in self.nullable:
+                            break
+                    else:
+                        first.add(symbol)
+                        break
                 else:
-                    new_stack_heads.append(new_stack_head)
-        return new_stack_heads
-
-    def reduce_stack_heads(self, stack_heads_to_process, input):
-        new_stack_heads = []
-        while stack_heads_to_process:
-            stack_head = stack_heads_to_process.pop()
-            current_state, i, parents = stack_head
-            if not stack_head in new_stack_heads and i < len(input):
-                new_stack_heads.append(stack_head)
-            #if self.debug:
-            #    print("\n\nProcessing stack head:",stack_head)
-            #print("State:", current_state, "symbol:", input[i],"i:",i)
-            #we perform all possible reduce actions...
-            if '__reduce__' in self.transitions[current_state]:
-                reduce_rules = self.transitions[current_state]['__reduce__']
-                for reduce_rule in reduce_rules:
-                    non_terminal = self.grammar[reduce_rule][0]
-                    if self.debug:
-                        print("\nReducing with rule",self.rule_as_str(reduce_rule))
-                    reduce_length = len(self.grammar[reduce_rule])-1
-                    paths = self.get_paths(stack_head, reduce_length)
-                    for path in paths:
-                        sem_value, ancestor = path[-1]
-                        semantic_value = tuple((non_terminal,tuple([k[0] for k in path[::-1][1:]])))
-                        if non_terminal == 'S': #this is the end state
-                            new_state = -1
-                        else:
-                            new_state = self.transitions[ancestor[0]][non_terminal]
-                        existing_stack_head = self.get_stack_head(new_stack_heads, new_state)
-                        if existing_stack_head:
-                            #if self.debug:
-                            #    print(existing_stack_head)
-                            if not ancestor in [a[1] for a in existing_stack_head[2]]:
-                                existing_stack_head[2].append((semantic_value,ancestor))
-                                stack_heads_to_process.insert(0,existing_stack_head)
-                            else:
-                                other_ancestor = [a for a in existing_stack_head[2] if a[1] == ancestor][0]
-                                other_semantic_value = other_ancestor[0]
-                                if other_semantic_value != semantic_value:
-                                    if self.debug:
-                                        print("Competing interpretations!")
-                                        print(semantic_value,"vs.",other_semantic_value)
+                    if not non_terminal in self.nullable:
+                        self.nullable.add(non_terminal)
+                        changed = True
+                if len(first) != n:
+                    changed = True
+
+        self.follow_sets = dict([(nt, set()) for nt in self.non_terminals])
+        self.follow_sets[self.grammar[0][0]].add('\0')
+        changed = True
+        while changed:
+            changed = False
+            for rule in self.grammar:
+                trailer = set(self.follow_sets[rule[0]])
+                for symbol in reversed(rule[1:]):
+                    if symbol in self.non_terminals:
+                        follow = self.follow_sets[symbol]
+                        n = len(follow)
+                        follow |= trailer
+                        if len(follow) != n:
+                            changed = True
+                        if symbol in self.nullable:
+                            trailer = trailer | self.first_sets[symbol]
                         else:
-                            new_stack_head = (new_state, i, [(semantic_value, ancestor)])
-                            new_stack_heads.append(new_stack_head)
-                            stack_heads_to_process.insert(0,new_stack_head)
-        #if self.debug:
-        #    print(new_stack_heads)
-        return new_stack_heads
-
-    def run(self, input):
-        stack_heads =[
-            (0, 0,[])
-        ]
-        accepted_stacks = []
-        longest_index = 0
-        longest_stacks = []
-        output_stream = []
+                            trailer = set(self.first_sets[symbol])
+                    else:
+                        trailer = set([symbol])
 
-        while True:
+    def get_follow_terminals(self):
+        terminals = []
+        for i in sorted(self.rule_options):
+            terminals.extend(self.rule_options[i].get('follow', ()))
+        return terminals
 
-            if self.debug:
-                print("{} stack heads".format(len(stack_heads)))
-                print("\n".join([str(s) for s in stack_heads]))
-
-            new_stack_heads = self.reduce_stack_heads(stack_heads, input)
+    def get_first_terminals(self, symbols):
+        """
+        Return the terminals that a sequence of symbols can start with.
+        """
+        terminals = set()
+        for symbol in symbols:
+            if not symbol in self.non_terminals:
+                terminals.add(symbol)
+                break
+            terminals |= self.first_sets[symbol]
+            if not symbol in self.nullable:
+                break
+        return terminals
 
-            for stack_head in new_stack_heads:
-                if stack_head[1] == len(input) and stack_head[0] == -1:
-                    accepted_stacks.append(stack_head)
+    def get_extensions(self):
+        """
+        Return the terminals that can extend each non-terminal: those that
+        continue a left-recursive rule or that start the nullable rest of a
+        rule, as well as the extensions of a non-terminal that can end a rule.
+        """
+        first = self.get_first_terminals
+        extensions = dict([(nt, set()) for nt in self.non_terminals])
+        changed = True
+        while changed:
+            changed = False
+            for rule in self.grammar:
+                non_terminal, symbols = rule[0], rule[1:]
+                terminals = set()
+                if symbols and symbols[0] == non_terminal:
+                    terminals |= first(symbols[1:])
+                for i in range(len(symbols)-1, -1, -1):
+                    if symbols[i] in self.non_terminals:
+                        terminals |= extensions[symbols[i]]
+                    if not symbols[i] in self.nullable:
+                        break
+                    if i > 0:
+                        terminals |= first(symbols[i:])
+                extension = extensions[non_terminal]
+                if not terminals <= extension:
+                    extension |= terminals
+                    changed = True
+        return extensions
+
+    def generate_follow_masks(self):
+        """
+        Compute the follow restrictions of every rule from the 'follow' and
+        'longest' options of the rules of its non-terminal, as a bit mask of
+        the IDs of the terminals that must not match after a reduction.
 
-            stack_heads = self.shift_stack_heads(new_stack_heads, input)
+        As the restrictions are checked whenever a rule of the non-terminal is
+        reduced, a left-recursive rule could never continue it. So we do not
+        allow them, a restricted non-terminal has to wrap the repetition.
+        """
+        restrictions = defaultdict(set)
+        longest = set()
+        for i, options in self.rule_options.items():
+            restrictions[self.grammar[i][0]].update(options.get('follow', ()))
+            if options.get('longest'):
+                longest.add(self.grammar[i][0])
+        if longest:
+            extensions = self.get_extensions()
+            for non_terminal in longest:
+                restrictions[non_terminal] |= extensions[non_terminal]
+        for i, rule in enumerate(self.grammar):
+            if len(rule) > 1 and rule[1] == rule[0] and restrictions.get(rule[0]) and \
+                    self.get_first_terminals(rule[2:]) & restrictions[rule[0]]:
+                raise GrammarError("Left-recursive rule {} of a non-terminal with follow restrictions".format(
+                    self.rule_as_str(i)))
+        masks = {}
+        for non_terminal, terminals in restrictions.items():
+            mask = 0
+            for terminal in terminals:
+                mask |= 1 << self.symbol_ids[terminal]
+            masks[non_terminal] = mask
+        self.follow_masks = [masks.get(rule[0], 0) for rule in self.grammar]
 
-            for stack_head in stack_heads:
-                if stack_head[1] > longest_index:
-                    longest_index = stack_head[1]
-                    longest_stacks = []
+    def rule_as_str(self, i):
+        return u'{} \u2192 {}'.format(self.grammar[i][0],' '.join([str(s) for s in self.grammar[i][1:]]))
 
-                if stack_head[1] == longest_index:
-                    longest_stacks.append(stack_head)
+    def stream(self, on_complete=None, symbols=None, window=None, incremental=False,
+               release=False, memory_limit=None, stats=None, limits=None):
+        """
+        Start a push-style parse: pass the input to feed() of the returned
+        session in chunks as it arrives, and call finish() at its end.
+        """
+        return self.session_class(self, on_complete=on_complete, symbols=symbols,
+                                  window=window, incremental=incremental,
+                                  release=release, memory_limit=memory_limit,
+                                  stats=stats, limits=limits)
 
-            if not stack_heads:
-                break
+    def reparse(self, previous, edits):
+        """
+        Parse the input of a previous incremental session after applying the
+        given (offset, deleted length, inserted text) edits to it.
+        """
+        return previous.reparse(edits)
 
-        return accepted_stacks, longest_stacks
+    def run(self, input, stats=None, limits=None):
+        """
+        Parse the input, processing the levels of the stack graph in the order
+        of their input positions. Returns the accepted stack nodes and the
+        nodes of the furthest level that the parser reached. If stats (a
+        ParserStats) is given, we count what the parser does in it, limits (a
+        ParseLimits) bound the work that it does.
+
+        As the whole input is known, we do not need to check whether the
+        levels are settled before we process them.
+        """
+        session = self.session_class(self, stats=stats, limits=limits)
+        session.buffer = input
+        return session.finish()
 
 input_string = r"""
 
@@ -532,32 +2913,47 @@ def decode_escapes(s):
 
     return ESCAPE_SEQUENCE_RE.sub(decode_match, s)
 
-def expand_rule(rule, references=None):
-    base = []
-
-    if references is None:
-        references = {}
-
-    for i, element in enumerate(rule):
-        if isinstance(element, tuple):
-            ref, alternatives = element
-            expanded_rules = []
-            for alternative in alternatives:
-                references[ref] = alternative
-                for new_expanded_rule in expand_rule(rule[i+1:], references):
-                    fully_expanded_rule = rule[:i] + [alternative] + new_expanded_rule
-                    expanded_rules.append(fully_expanded_rule)
-            # we return a new set of rules
-            return expanded_rules
-        elif isinstance(element, int):
-            # this is a reference, we replace the element with the reference
-            rule[i] = references[element]
-    # we just return the original rule
-    return [rule]
+def make_options(args, name):
+    """
+    Turn the arguments of a .grm rule into its options dict (see Parser).
+    """
+    options = {}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if value.startswith('"'):
+            value = value[1:-1].replace('\\"', '"')
+        if key in ('left', 'right', 'nonassoc') and not value:
+            options['assoc'] = key
+        elif key in ('reject', 'longest', 'layout') and not value:
+            options[key] = True
+        elif key == 'priority' and value.isdigit():
+            options['priority'] = int(value)
+        elif key == 'follow' and value:
+            options['follow'] = options.get('follow', ())+(regex(value),)
+        else:
+            raise GrammarError("Invalid argument {} of rule {}".format(arg, name))
+    return options
 
 def make_grammar(ast):
+    """
+    Turn the AST of a .grm grammar into a list of rules. An alternative group
+    (a | b | c) becomes a helper non-terminal named after the group, with a
+    rule for every alternative, which all groups with the same alternatives
+    share. A back-reference \\N stands for the helper non-terminal of the
+    N-th group of the rule, and the rule gets an options dict that tells the
+    parser that both have to take the same alternative (see Parser).
+
+    The arguments of a rule set the options of all its alternatives: left,
+    right or nonassoc for the associativity, priority=N, reject, longest,
+    layout and follow=REGEX for a terminal that may not follow it. A value
+    in double quotes may contain commas, parentheses and spaces. Other
+    arguments raise a GrammarError.
+    """
     rules = []
+    helper_rules = []
+    helpers = set()
     for rule in ast['rules']:
+        options = make_options(rule['args'], rule['name'])
         alternatives =[]
         if 'patternlist' in rule:
             alternatives.append({'patternlist': rule['patternlist']})
@@ -566,6 +2962,9 @@ def make_grammar(ast):
         ref = 1
         for alternative in alternatives:
             parsed_rule = [rule['name']]
+            # the positions of the groups in the rule by their number
+            groups = {}
+            backreferences = []
             for pattern in alternative['patternlist']:
                 if 'literal' in pattern:
                     parsed_rule.append(literal(decode_escapes(pattern['literal']['literal-value'])))
@@ -576,43 +2975,142 @@ def make_grammar(ast):
                 elif 'end' in pattern:
                     parsed_rule.append('\0')
                 elif 'expr-alternatives' in pattern:
-                    parsed_rule.append((ref, [e['name'] for e in pattern['expr-alternatives']]))
+                    names = [e['name'] for e in pattern['expr-alternatives']]
+                    helper = '({})'.format('|'.join(names))
+                    if not helper in helpers:
+                        helpers.add(helper)
+                        helper_rules.extend([[helper, name] for name in names])
+                    groups[ref] = len(parsed_rule)-1
+                    parsed_rule.append(helper)
                     ref += 1
                 elif 'reference' in pattern:
-                    parsed_rule.append(int(pattern['reference']['reference-value']))
+                    reference = int(pattern['reference']['reference-value'])
+                    if not reference in groups:
+                        raise GrammarError("Unknown reference \\{} in rule {}".format(
+                            reference, rule['name']))
+                    backreferences.append((len(parsed_rule)-1, groups[reference]))
+                    parsed_rule.append(parsed_rule[groups[reference]+1])
                 else:
                     print(pattern)
                     exit(0)
-            expanded_rules = expand_rule(parsed_rule)
-            rules.extend(expanded_rules)
-    return rules
-
-def make_ast(semantic_value):
-
-    if not isinstance(semantic_value, tuple):
-        return
-
-    rule, children = semantic_value
-
-    if rule.startswith('[]'): # this is a list rule
-        # replace the node with a list of children
+            if backreferences or options:
+                rule_options = dict(options)
+                if backreferences:
+                    rule_options['backreferences'] = tuple(backreferences)
+                parsed_rule.append(rule_options)
+            rules.append(parsed_rule)
+    return rules + helper_rules
+
+# the kinds of AST nodes by the prefix of their rule names
+node_kinds = (
+    ('[]', 'list'),
+    ('{}', 'dict'),
+    ('.', 'key'),
+    (':', 'value'),
+    ('|', 'inline'),
+)
+
+def node_kind(symbol):
+    for prefix, kind in node_kinds:
+        if symbol.startswith(prefix):
+            return kind, symbol[len(prefix):]
+    return 'sequence', symbol
+
+def walk_forest(semantic_value, handler):
+    """
+    Walk the first derivation of a parse forest (or a tree of (symbol,
+    children) tuples) depth-first and report it to the handler as a stream
+    of events, without building anything:
+
+    * handler.start_node(kind, name) when we enter the node of a rule, where
+      kind is given by the prefix of the rule name (see node_kinds): 'list',
+      'dict', 'key', 'value', 'inline' or 'sequence' for rules without one.
+    * handler.value(value) for the first child of 'value' and 'inline'
+      nodes, which we do not descend into.
+    * handler.end_node() when we leave the node.
+
+    Terminals of the other nodes are skipped, as are the helper nodes of
+    alternative groups, whose child takes their place.
+    """
+    kinds = {}
+    stack = [(semantic_value, False)]
+    while stack:
+        value, entered = stack.pop()
+        if entered:
+            handler.end_node()
+            continue
+        if isinstance(value, SymbolNode):
+            symbol, children = value.symbol, value.children
+        elif isinstance(value, tuple):
+            symbol, children = value
+        else:
+            continue
+        if symbol.startswith('('):
+            stack.append((children[0], False))
+            continue
+        kind_and_name = kinds.get(symbol)
+        if kind_and_name is None:
+            kind_and_name = kinds[symbol] = node_kind(symbol)
+        kind, name = kind_and_name
+        handler.start_node(kind, name)
+        if kind in ('value', 'inline'):
+            if children:
+                handler.value(children[0])
+            handler.end_node()
+            continue
+        stack.append((None, True))
+        stack.extend([(child, False) for child in reversed(children)])
+
+class AstBuilder(object):
+
+    """
+    Builds the AST of a parse from the events of walk_forest: lists for
+    'list' and 'sequence' nodes (which are merged into their parent), dicts
+    for 'dict' and 'key' nodes and {name : value} for 'value' nodes.
+
+    Every list that we build is only ever merged into a single parent, so
+    the first one is extended in place, which keeps building the lists of
+    recursive rules linear.
+    """
+
+    def __init__(self):
+        self.stack = [('sequence', None, [])]
+
+    @property
+    def result(self):
+        results = self.stack[0][2]
+        return results[-1] if results else None
+
+    def start_node(self, kind, name):
+        self.stack.append((kind, name, []))
+
+    def value(self, value):
+        self.stack[-1][2].append(value)
+
+    def end_node(self):
+        kind, name, children = self.stack.pop()
+        self.stack[-1][2].append(getattr(self, 'build_'+kind)(name, children))
+
+    def build_list(self, name, children):
         l = []
-        for child in children:
-            v = make_ast(child)
+        for v in children:
+            if isinstance(v, dict) and len(v) == 1 and name in v:
+                v = v[name]
+                if not isinstance(v, list):
+                    l.extend(v)
+                    continue
             if isinstance(v, list):
-                l.extend(v)
-            elif isinstance(v, dict):
-                if len(v) == 1 and rule[2:] in v:
-                    l.extend(v[rule[2:]])
-                elif v:
-                    l.append(v)
+                if l:
+                    l.extend(v)
+                else:
+                    l = v
             elif v:
                 l.append(v)
-        return {rule[2:]: l}
-    elif rule.startswith('{}'): # this is a dict rule
+        return {name: l}
+
+    def build_dict(self, name, children):
         d = {}
-        for child in children:
-            dd = make_ast(child)
+        for dd in children:
             if isinstance(dd, dict):
                 d.update(dd)
             elif isinstance(dd, list):
@@ -620,87 +3118,94 @@ def make_ast(semantic_value):
                     if isinstance(dv, dict):
                         d.update(dv)
         return d
-    elif rule.startswith('.'): # this is a key rule
+
+    def build_key(self, name, children):
         d = {}
-        for child in children:
-            v = make_ast(child)
+        for v in children:
             if isinstance(v, dict):
-                if not rule[1:] in d:
-                    d[rule[1:]] = {}
-                d[rule[1:]].update(v)
+                if not name in d:
+                    d[name] = {}
+                d[name].update(v)
             elif v:
-                d[rule[1:]] = v
+                d[name] = v
         return d
-    elif rule.startswith(':') or rule.startswith('|'): # this is a value rule
+
+    def build_value(self, name, children):
+        if children:
+            return {name: children[0]}
+
+    def build_inline(self, name, children):
         if children:
-            if rule.startswith(':'):
-                return {rule[1:]: children[0]}
             return children[0]
-    else:
+
+    def build_sequence(self, name, children):
         l = []
-        for child in children:
-            v = make_ast(child)
+        for v in children:
             if isinstance(v, list):
-                l.extend(v)
+                if l:
+                    l.extend(v)
+                else:
+                    l = v
             elif v:
                 l.append(v)
         return l
 
+def make_ast(semantic_value):
+    builder = AstBuilder()
+    walk_forest(semantic_value, builder)
+    return builder.result
+
+def compile_grammar(source, cache=None):
+    """
+    Parse the source of a .grm grammar with grammar_grammar and turn it into
+    a list of grammar rules. With a cache, the compiled grammar is stored
+    under a hash of the source, so that a warm start neither builds the
+    tables for grammar_grammar nor parses the grammar source.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(grammar_fingerprint(grammar_grammar).encode('utf-8'))
+    hasher.update(source.encode('utf-8'))
+    key = hasher.hexdigest()
+    if cache is not None:
+        grammar = cache.load(key, kind='grammar')
+        if grammar is not None:
+            return grammar
+    parser = Parser(grammar_grammar, cache=cache)
+    stack_heads, longest_stacks = parser.run(source)
+    if not stack_heads:
+        context = position = ''
+        for stack_head in longest_stacks:
+            context = source[max(0, stack_head.pos-100):stack_head.pos]
+            position = ' in line {}, column {}'.format(*LineIndex(source).position(stack_head.pos))
+            break
+        raise GrammarError("Cannot parse grammar{}:\n...{}<---".format(position, context))
+    semantic_value = stack_heads[0].edges[0][0]
+    grammar = make_grammar(make_ast(semantic_value)[0])
+    if cache is not None:
+        cache.store(key, grammar, kind='grammar')
+    return grammar
+
+def load_grammar(filename, cache=None):
+    with open(filename) as input:
+        return compile_grammar(input.read(), cache=cache)
+
 if __name__ == '__main__':
-    parser = Parser(grammar_grammar, debug=False)
     import pprint
-    print("States:")
-    pprint.pprint([sorted(list(state)) for state in sorted(parser.states)])
-    print("Transitions:")
-    pprint.pprint(dict(parser.transitions))
-    for i in range(len(parser.grammar)):
-        print(i,":",parser.rule_as_str(i))
-
-    input_string = ['n','+','n','+','n','$']
-    input_string = ['(',')']
-    input_string = ['symbol','times','symbol','times','number', '+','symbol']
-    input_string = ['a','a','a','a','a','a','a']
-    input_string = ['b','+','b']
-    input_string = ['def','name','(','param',',','name',',','param',',','name','=','"','characters',
-                    '"', ',','keyword_param',',', ')',':','newline','indent','pass','newline','pass','dedent','newline',
-                    'name','=','number','newline','number', 'newline','funcdef']
-    input_string = grammar_program
+
+    # set PARSEJOY_NO_CACHE to rebuild the grammar and its tables on every run
+    cache = None if os.environ.get('PARSEJOY_NO_CACHE') else TableCache()
 
     with open(sys.argv[1]) as input:
         input_string = input.read()
 
-    #input_string = ['a','n','n','a']
-    #input_string = ['def','name','(',')',':','newline','indent','pass','dedent','newline']
-    #input_string = ['statement','newline', 'statement','newline', 'statement','newline', 'statement','newline']
-    # for i in range(18):
-    #    input_string = input_string+['+']+input_string[:3]
-    # print(len(input_string))
-    # input_string ='1+2+1+121'
     start = time.time()
-    n = 100
-    print(" ".join(input_string))
-    for i in range(n):
-        stack_heads, longest_stacks = parser.run(input_string)
-    stop = time.time()
-    print("{:.2f} MB/s".format(n*len(input_string)/(stop-start)/1024/1024))
-    print("Accepted stacks: {}".format(len(stack_heads)))
-
-    if len(stack_heads) == 0:
-
-        for stack_head in longest_stacks:
-            print("...", input_string[max(0, stack_head[1]-100):stack_head[1]],"<---")
-            break
-
+    try:
+        grammar = compile_grammar(input_string, cache=cache)
+    except GrammarError as ge:
+        print(ge)
         exit(-1)
-
-    semantic_value = stack_heads[0][2][0][0]
-    pprint.pprint(semantic_value)
-    ast = make_ast(semantic_value)[0]
-    grammar = make_grammar(ast)
-    print("grammar:")
-    pprint.pprint(grammar)
-
-    new_parser = Parser(grammar, debug=False)
+    new_parser = Parser(grammar, debug=False, cache=cache)
+    print("Loaded grammar and parse tables in {:.3f} s".format(time.time()-start))
 
     filename = sys.argv[2]
 
@@ -709,26 +3214,27 @@ if __name__ == '__main__':
 
     start = time.time()
     n = 100
-    print(" ".join(input_string))
     for i in range(n):
         stack_heads, longest_stacks = new_parser.run(content)
     stop = time.time()
-    print("{:.2f} MB/s".format(n*len(input_string)/(stop-start)/1024/1024))
+    print("{:.2f} MB/s, {:.0f} lines/s".format(n*len(content.encode('utf-8'))/(stop-start)/1024/1024,
+                                              n*(content.count('\n')+1)/(stop-start)))
     print("Accepted stacks: {}".format(len(stack_heads)))
 
-    exit(0)
-
     if len(stack_heads) == 0:
         print("cannot parse")
 
         for stack_head in longest_stacks:
-            print("...", content[max(0, stack_head[1]-100):stack_head[1]],"<---")
-            break        
+            print("line {}, column {}:".format(*LineIndex(content).position(stack_head.pos)))
+            print("...", content[max(0, stack_head.pos-100):stack_head.pos],"<---")
+            break
 
         exit(-1)
 
-    semantic_value = stack_heads[0][2][0][0]
-    pprint.pprint(semantic_value)
+    exit(0)
+
+    semantic_value = stack_heads[0].edges[0][0]
+    pprint.pprint(semantic_value.tree())
     ast = make_ast(semantic_value)
 
     print(yaml.dump(ast, indent=1))
@@ -0,0 +1,56 @@
+"""
+Compares the number of live stack heads per parse step of the GLR parser with
+and without lookahead filtering of reductions.
+
+Usage:
+
+    python3 heads_benchmark.py [grammar filename] [code filename]
+
+The grammar file is parsed with grammar_grammar, the code file (if given) with
+the grammar compiled from it.
+"""
+
+import time
+import sys
+
+from glr_parser import Parser, ParserStats, grammar_grammar, make_ast, make_grammar
+
+def measure(grammar, input, lookahead):
+    parser = Parser(grammar, lookahead=lookahead)
+    stats = ParserStats(parser)
+    start = time.time()
+    accepted_stacks, longest_stacks = parser.run(input, stats=stats)
+    stop = time.time()
+    report = stats.report()
+    result = dict(report['heads'])
+    result.update({
+        'accepted' : len(accepted_stacks),
+        'steps' : report['steps'],
+        'time' : stop-start,
+    })
+    return result, accepted_stacks
+
+def report(name, grammar, input):
+    print(name)
+    for lookahead in (False, True):
+        result, accepted_stacks = measure(grammar, input, lookahead)
+        print("  lookahead={!s:<5}  steps: {steps:5d}  live heads per step: "
+              "mean {mean:6.2f}, max {max:4d}, total {total:7d}  "
+              "accepted: {accepted}  {time:.3f} s".format(lookahead, **result))
+    return accepted_stacks
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: {} [grammar filename] [code filename]\n".format(sys.argv[0]))
+        exit(-1)
+
+    with open(sys.argv[1]) as input:
+        grammar_source = input.read()
+
+    accepted_stacks = report(sys.argv[1], grammar_grammar, grammar_source)
+
+    if len(sys.argv) > 2 and accepted_stacks:
+        grammar = make_grammar(make_ast(accepted_stacks[0].edges[0][0])[0])
+        with open(sys.argv[2]) as input:
+            report(sys.argv[2], grammar, input.read())
@@ -0,0 +1,46 @@
+"""
+Line and column lookup for positions in a string, shared by the parsers. It
+has to work with Python 2 and 3.
+"""
+
+import bisect
+import re
+
+class LineIndex(object):
+
+    """
+    The offsets at which the lines of a string start. We build it once per
+    input, so that the line and column of any position can be looked up
+    with a binary search instead of by splitting the input up to it. Lines
+    and columns are counted from 1.
+    """
+
+    def __init__(self, s):
+        starts = [0]
+        if not hasattr(s, 'find'):
+            #buffers have no find, but the re module can scan them (Python 2
+            #only scans strings and old-style buffers, so we copy them there)
+            try:
+                starts.extend([match.end() for match in re.finditer(b'\n', s)])
+            except TypeError:
+                starts.extend([match.end() for match in re.finditer(b'\n', s.tobytes())])
+        else:
+            newline = b'\n' if isinstance(s, (bytes, bytearray)) else '\n'
+            pos = s.find(newline)
+            while pos != -1:
+                starts.append(pos+1)
+                pos = s.find(newline, pos+1)
+        self.starts = starts
+
+    def line(self, pos):
+        return bisect.bisect_right(self.starts, pos)
+
+    def col(self, pos):
+        return pos-self.starts[self.line(pos)-1]+1
+
+    def position(self, pos):
+        """
+        Return the (line, column) tuple of the given position.
+        """
+        line = bisect.bisect_right(self.starts, pos)
+        return line, pos-self.starts[line-1]+1
@@ -6,6 +6,8 @@ import re
 import copy
 import pprint
 
+from line_index import LineIndex
+
 """
 For each possible rule path
 """
@@ -34,8 +36,10 @@ class Context(object):
 
 class State(object):
 
-    def __init__(self,s, pos=0):
+    def __init__(self,s, pos=0, line_index=None):
         self.s = s
+        # the line index of the input is shared by all copies of the state
+        self.line_index = line_index if line_index is not None else LineIndex(s)
         self.parent = None
         self.store = {}
         self.result = None
@@ -45,14 +49,14 @@ class State(object):
 
     @property
     def line(self):
-        return len(self.s[:self.pos].split("\n"))
+        return self.line_index.line(self.pos)
 
     @property
     def col(self):
-        return len(self.s[:self.pos].split("\n")[-1])+1
+        return self.line_index.col(self.pos)
 
     def copy(self,):
-        state = State(self.s, self.pos)
+        state = State(self.s, self.pos, self.line_index)
         state.parent = self
         state.store = copy.deepcopy(self.store)
         state.current_node = self.current_node
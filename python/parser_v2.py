@@ -3,9 +3,13 @@ import sys
 import os
 import time
 import re
-import copy
 import pprint
 import hashlib
+import heapq
+
+from collections import OrderedDict
+
+from line_index import LineIndex
 
 class ParserError(ValueError):
     pass
@@ -37,7 +41,8 @@ class TokenStream(object):
     def __init__(self,tokens):
         self.tokens = tokens
         self.current_token = None
-        self.consumed_tokens = []
+        #the consumed tokens as a chain (see chain_tokens), which copies share
+        self.consumed = None
         self.initialized = False
 
     def build_linked_list(self):
@@ -75,11 +80,15 @@ class TokenStream(object):
         self.current_token,token_id = add_token_list(self.tokens, None, None, None,0)
 
 
+    @property
+    def consumed_tokens(self):
+        return chain_since(self.consumed, None)
+
     def copy(self):
         stream = self.__class__(self.tokens)
         stream.current_token = self.current_token
         stream.initialized = self.initialized
-        stream.consumed_tokens = self.consumed_tokens[:]
+        stream.consumed = self.consumed
         return stream
 
     def advance(self, from_token = None, prefix=None, skip_ignored=True):
@@ -92,8 +101,8 @@ class TokenStream(object):
         if from_token:
             self.current_token = from_token
         if prefix:
-            self.consumed_tokens.extend(prefix)
-        self.consumed_tokens.append(self.current_token)
+            self.consumed = chain_tokens(self.consumed, prefix)
+        self.consumed = (self.current_token, self.consumed)
         self.current_token = self.current_token.get('next')
 
     def get(self, token_type=None, leafs_only=False, include_ignored=False):
@@ -132,34 +141,91 @@ class TokenStream(object):
     def current(self):
         pass
 
+def chain_tokens(chain, tokens):
+    """
+    Push tokens on a chain, an immutable linked list of (token, rest) pairs
+    with the last token first (None is the empty chain).
+    """
+    for token in tokens:
+        chain = (token, chain)
+    return chain
+
+def chain_since(chain, mark):
+    """
+    Return the tokens that were pushed on a chain since it was mark, in order.
+    """
+    tokens = []
+    while chain is not mark:
+        token, chain = chain
+        tokens.append(token)
+    tokens.reverse()
+    return tokens
+
 class State(object):
 
+    """
+    The emitted tokens of a state are a chain and its store holds immutable
+    values, so that a copy of a state shares both with it and parsers can
+    backtrack to any earlier state for free. To change the store, we replace
+    it with a new dict.
+    """
+
     def __init__(self):
         self.parent = None
         self.result = None
         self.store = {}
-        self.tokens = []
+        self.token_chain = None
+
+    @property
+    def tokens(self):
+        return chain_since(self.token_chain, None)
+
+    @tokens.setter
+    def tokens(self, tokens):
+        self.token_chain = chain_tokens(None, tokens)
+
+def starts_with(s, value, pos):
+    """
+    Check whether the input contains the value at the given position, without
+    copying the rest of the input.
+    """
+    if type(s) is type(value):
+        return s.startswith(value, pos)
+    #buffers and memory maps have no startswith, and a unicode value would
+    #make a str decode the whole input
+    return s[pos:pos+len(value)] == value
 
 class StringState(State):
 
-    def __init__(self, s, pos=0):
+    """
+    The state of a parse of a string. The input can be a str, a unicode
+    string, a buffer, a bytearray or a memory map, which we all match in
+    place. The re module cannot match memoryviews, so instead of copying
+    them, we ask for the object that they view.
+    """
+
+    def __init__(self, s, pos=0, line_index=None):
         super(StringState, self).__init__()
+        if isinstance(s, memoryview):
+            raise TypeError("Cannot parse a memoryview, pass the buffer, bytearray or memory map that it views")
         self.s = s
         self.pos = pos
+        # the line index of the input is shared by all copies of the state
+        self.line_index = line_index if line_index is not None else LineIndex(s)
 
     @property
     def line(self):
-        return len(self.s[:self.pos].split("\n"))
+        return self.line_index.line(self.pos)
 
     @property
     def col(self):
-        return len(self.s[:self.pos].split("\n")[-1])+1
+        return self.line_index.col(self.pos)
 
     def copy(self,):
-        state = self.__class__(self.s, self.pos)
+        state = self.__class__(self.s, self.pos, self.line_index)
         state.parent = self
-        state.store = copy.deepcopy(self.store)
-        state.tokens = self.tokens[:]
+        state.store = self.store
+        state.token_chain = self.token_chain
         return state
 
     def print_parse_tree(self, tokens=None, level=0):
@@ -182,19 +248,20 @@ class StringState(State):
         return old_pos
 
     def create_token(self, name, s, push=True, **opts):
+        line, col = self.line_index.position(self.pos)
         token = {
           'type' : name,
           's' : s,
-          'from' : {'p' :self.pos,'l' : self.line,'c' : self.col},
+          'from' : {'p' :self.pos,'l' : line,'c' : col},
         }
         if name.startswith('__'):
             token['ignore'] = True
         token.update(opts)
-        old_pos = self.advance(len(s))
-        token['to'] = {'p' : self.pos,'l' : self.line,'c' : self.col}
-        self.go_to(old_pos)
+        end = self.pos+len(s)
+        line, col = self.line_index.position(end)
+        token['to'] = {'p' : end,'l' : line,'c' : col}
         if push:
-            self.tokens.append(token)
+            self.token_chain = (token, self.token_chain)
         return token
 
     def go_to(self, pos):
@@ -225,7 +292,7 @@ class TokenState(State):
     def copy(self,):
         state = TokenState(self.s.copy())
         state.parent = self
-        state.tokens = self.tokens[:]
+        state.token_chain = self.token_chain
         return state
 
     def create_token(self, name, tokens, push=True, **opts):
@@ -235,7 +302,7 @@ class TokenState(State):
         }
         token.update(opts)
         if push:
-            self.tokens.append(token)
+            self.token_chain = (token, self.token_chain)
         return token
 
     def current_token(self):
@@ -274,7 +341,7 @@ class BaseParserGenerator(object):
 
     def compile_repeat(self, rule):
 
-        rule_parser = self._compile_rule(rule['repeat'])
+        rule_parser = self._compile_rule(rule['$repeat'])
 
         @self.parser('repeat',rule=rule, emit=False)
         def repeat_parser(state, context):
@@ -294,7 +361,7 @@ class BaseParserGenerator(object):
 
     def compile_optional(self, rule):
 
-        rule_parser = self._compile_rule(rule['optional'])
+        rule_parser = self._compile_rule(rule['$optional'])
 
         @self.parser('optional',rule=rule, emit=False)
         def optional_parser(state, context):
@@ -308,7 +375,7 @@ class BaseParserGenerator(object):
     def compile_or(self, rule):
 
         alternative_parsers = []
-        alternatives = rule['or']
+        alternatives = rule['$or']
         for i,alternative in enumerate(alternatives):
             alternative_parsers.append((alternative,self._compile_rule(alternative)))
 
@@ -333,7 +400,7 @@ class BaseParserGenerator(object):
 
     def compile_not(self, rule):
 
-        rule_parser = self._compile_rule(rule['not'])
+        rule_parser = self._compile_rule(rule['$not'])
 
         @self.parser('not',rule=rule, emit=False)
         def not_parser(state, context):
@@ -347,7 +414,7 @@ class BaseParserGenerator(object):
 
     def compile_and(self, rule):
 
-        rule_parser = self._compile_rule(rule['and'])
+        rule_parser = self._compile_rule(rule['$and'])
 
         @self.parser('and',rule=rule, emit=False)
         def and_parser(state, context):
@@ -393,7 +460,10 @@ class BaseParserGenerator(object):
         return self._compile_rule('start')
 
     def resolve_rule(self,name):
-        func = getattr(self,'compile_{}'.format(name.replace('-','_')))
+        #only names with a $ prefix refer to the built-in directives
+        if not name.startswith('$'):
+            raise AttributeError("Not a directive: {}".format(name))
+        func = getattr(self,'compile_{}'.format(name[1:].replace('-','_')))
         return func
 
     def rule_prefix(self,rule_name):
@@ -412,6 +482,9 @@ class BaseParserGenerator(object):
         if isinstance(rule, (str,unicode)):
             if rule in visited_rules:
                 return set([])
+            if rule.startswith('$'):
+                #directives like $eof or $indent do not constrain the next token
+                return set([None])
             visited_rules|=set([rule])
             if rule in self.grammar:
                 return get_prefixes(self.grammar[rule])
@@ -425,24 +498,28 @@ class BaseParserGenerator(object):
                 else:
                     prefixes |= subrule_prefixes
                     break
+            else:
+                #all elements of the sequence can be empty, so can the sequence
+                prefixes.add(None)
         elif isinstance(rule,dict) and len(rule) == 1:
             key,value = rule.items()[0]
-            if key == 'or':
+            if key == '$or':
                 for subrule in value:
                     prefixes |= get_prefixes(subrule)
-            elif key in ('and','repeat'):
+            elif key in ('$and','$repeat'):
                 prefixes |= get_prefixes(value)
-            elif key == 'not':
+            elif key == '$not':
                 #not sure if this is the right way to handle not
                 return set([None])
 #                prefixes |= {('not',prefix) for prefix in get_prefixes(value)}
-            elif key == 'optional':
+            elif key == '$optional':
                 prefixes |= set([None])
                 prefixes |= get_prefixes(value)
             else:
                 return self.rule_prefix(rule)
         else:
             raise ValueError("Invalid rule!")
+        return prefixes
 
 
     def _compile_rule(self, name_or_rule):
@@ -453,14 +530,13 @@ class BaseParserGenerator(object):
             name = name_or_rule
             if name in self.parsers:
                 return self.parsers[name]
-            try:
-                rule = self.grammar[name]
-            except KeyError:
+            if name.startswith('$') or not name in self.grammar:
                 try:
                     func = self.resolve_rule(name)
                     return func()
                 except AttributeError:
                     raise ParserError("Unknown rule: {}".format(name))
+            rule = self.grammar[name]
         else:
             rule = name_or_rule
 
@@ -519,28 +595,136 @@ class StringParserGenerator(BaseParserGenerator):
     """
     Generating an abstract syntax tree is done implictly by each rule
 
+    If memoize is True (or a list of rule names), we remember the outcome of
+    the named rules (or of the given ones) at every position of the input,
+    so that alternatives and $and/$not checks that try a rule again at the
+    same position get its result from the memo (packrat parsing). Rules that
+    depend on the indentation cannot be memoized. To bound the memory of the
+    memo, memo_window drops the outcomes at positions that lie more than
+    that many characters behind the farthest position reached.
     """
 
+    def __init__(self, grammar, memoize=False, memo_window=None):
+        super(StringParserGenerator, self).__init__(grammar)
+        self.memoize = memoize
+        self.memo_window = memo_window
+        self.rule_ids = {}
+        self.reset_memo()
+
+    def reset_memo(self):
+        self.memo = {}
+        self.memo_positions = []
+        self.farthest = 0
+
+    def compile(self, debug=True):
+        parser = super(StringParserGenerator, self).compile(debug)
+        if not self.memoize:
+            return parser
+
+        def memoized_parser(state, context):
+            #every parse has a memo of its own, which we drop when it returns
+            self.reset_memo()
+            try:
+                return parser(state, context)
+            finally:
+                self.reset_memo()
+
+        return memoized_parser
+
+    def uses_indent(self, rule, visited=None):
+        if visited is None:
+            visited = set()
+        if isinstance(rule,(str,unicode)):
+            if rule == '$indent':
+                return True
+            if rule in visited or not rule in self.grammar:
+                return False
+            visited.add(rule)
+            return self.uses_indent(self.grammar[rule], visited)
+        elif isinstance(rule,(list,tuple)):
+            return any(self.uses_indent(subrule, visited) for subrule in rule)
+        elif isinstance(rule,dict):
+            return any(self.uses_indent(subrule, visited) for subrule in rule.values())
+        return False
+
+    def get_memo_id(self, name, rule):
+        """
+        Return the integer ID under which we memoize the outcomes of a rule,
+        or None if we don't.
+        """
+        if not self.memoize or rule != name or not name in self.grammar:
+            return None
+        if self.memoize is not True and not name in self.memoize:
+            return None
+        if self.uses_indent(name):
+            if self.memoize is not True:
+                raise ParserError("Rule {} depends on the indentation and cannot be memoized".format(name))
+            return None
+        return self.rule_ids.setdefault(name, len(self.rule_ids))
+
+    def remember(self, pos, rule_id, outcome):
+        window = self.memo_window
+        if window is not None:
+            end = outcome[0] if isinstance(outcome, tuple) else pos
+            if end > self.farthest:
+                self.farthest = end
+                positions = self.memo_positions
+                while positions and positions[0] < end-window:
+                    del self.memo[heapq.heappop(positions)]
+            if pos < self.farthest-window:
+                return
+        outcomes = self.memo.get(pos)
+        if outcomes is None:
+            outcomes = self.memo[pos] = {}
+            if window is not None:
+                heapq.heappush(self.memo_positions, pos)
+        outcomes[rule_id] = outcome
+
     def parser(self,name,rule=None, emit=True):
 
         def dec(f):
 
+            rule_id = self.get_memo_id(name, rule)
+
             def decorated_function(state, context, *args, **kwargs):
                 new_context = Context(context.level+1,name,context)
                 #print("{}{} {}:{}".format(" "*new_context.level,new_context.name,state.line,state.col))
-                i = len(state.tokens)
 
                 result = f(state, new_context, *args, **kwargs)
                 if emit:
                     #this rule was successful, we can create a node in the parse tree for it
-                    children = result.tokens[i:]
-                    result.tokens = result.tokens[:i]
-                    new_token = state.create_token(name,state.value[:result.pos-state.pos],push=False)
-                    result.tokens.append(new_token)
+                    children = chain_since(result.token_chain, state.token_chain)
+                    new_token = state.create_token(name,state.s[state.pos:result.pos],push=False)
                     if children:
                         new_token['c'] = children
+                    if result is state:
+                        result = state.copy()
+                    result.token_chain = (new_token, state.token_chain)
                 return result
-            return decorated_function
+
+            if rule_id is None:
+                return decorated_function
+
+            def memoized_function(state, context, *args, **kwargs):
+                pos = state.pos
+                outcomes = self.memo.get(pos)
+                if outcomes is not None and rule_id in outcomes:
+                    outcome = outcomes[rule_id]
+                    if isinstance(outcome, ParserError):
+                        raise outcome
+                    end, tokens = outcome
+                    new_state = state.copy()
+                    new_state.token_chain = chain_tokens(state.token_chain, tokens)
+                    new_state.go_to(end)
+                    return new_state
+                try:
+                    result = decorated_function(state, context, *args, **kwargs)
+                except ParserError as pe:
+                    self.remember(pos, rule_id, pe)
+                    raise
+                self.remember(pos, rule_id, (result.pos, chain_since(result.token_chain, state.token_chain)))
+                return result
+            return memoized_function
 
         return dec
 
@@ -549,10 +733,11 @@ class StringParserGenerator(BaseParserGenerator):
             return set([rule])
         elif isinstance(rule,dict) and len(rule) == 1:
             key,value = rule.items()[0]
-            if key == 'literal':
+            if key == '$literal':
                 return set([value])
-            elif key == 'regex':
+            elif key == '$regex':
                 return set([('regex',value)])
+            return set([None])
         else:
             raise ValueError
 
@@ -560,7 +745,7 @@ class StringParserGenerator(BaseParserGenerator):
 
         @self.parser('eof',rule='eof', emit=True)
         def eof_parser(state, context):
-            if state.value != '':
+            if state.pos < len(state.s):
                 raise ParserError("Expected EOF")
             return state
 
@@ -568,6 +753,8 @@ class StringParserGenerator(BaseParserGenerator):
 
     def compile_indent(self):
 
+        indent_regex = re.compile(r'[ \t]*')
+
         @self.parser('indent',rule='indent', emit=False)
         def indent_parser(state, context):
             """
@@ -577,9 +764,9 @@ class StringParserGenerator(BaseParserGenerator):
             * If it is shorter, emit a DEDENT+ CURRENT_INDENT token sequence
             """
 
-            indent_str = re.match(r'^[ \t]*',state.value).group(0)
+            indent_str = indent_regex.match(state.s, state.pos).group(0)
             new_state = state.copy()
-            indents = new_state.store.get('indent',[''])
+            indents = new_state.store.get('indent',('',))
             current_indent = indents[-1]
             if indent_str == current_indent:
                 #yield a CURRENT_INDENT token
@@ -593,8 +780,7 @@ class StringParserGenerator(BaseParserGenerator):
                 new_indent = indent_str[len(current_indent):]
                 new_state.create_token('indent',new_indent)
                 new_state.advance(len(new_indent))
-                indents.append(indent_str)
-                new_state.store['indent'] = indents
+                new_state.store = dict(new_state.store, indent=indents+(indent_str,))
                 return new_state
             else:
                 #this should be a dedentation
@@ -604,12 +790,13 @@ class StringParserGenerator(BaseParserGenerator):
                     if not possible_indents:
                         raise ParserError("Dedentation does not match!")
                     cnt+=1
-                    possible_indent = possible_indents.pop(-1)
+                    possible_indent = possible_indents[-1]
+                    possible_indents = possible_indents[:-1]
                     if possible_indent == indent_str:
                         for i in range(cnt):
                             new_state.create_token('dedent','')
                         new_state.create_token('current_indent',possible_indent,ignore=True)
-                        new_state.store['indent'] = possible_indents+[possible_indent]
+                        new_state.store = dict(new_state.store, indent=possible_indents+(possible_indent,))
                         new_state.advance(len(indent_str))
                         return new_state
 
@@ -617,19 +804,20 @@ class StringParserGenerator(BaseParserGenerator):
 
     def compile_regex(self, rule):
 
-        regex = rule['regex']
+        regex = rule['$regex']
         #DOTALL is necessary to match newlines
-        compiled_regex = re.compile('^{}'.format(regex),re.DOTALL)
+        compiled_regex = re.compile(regex,re.DOTALL)
 
         @self.parser('regex', rule=rule)
         def regex_parser(state, context):
-            match = compiled_regex.match(state.value)
+            #match() anchors the regex at the position, so we need no ^
+            match = compiled_regex.match(state.s, state.pos)
             if match:
                 s = match.group(0)
                 context.debug("match!")
                 new_state = state.copy()
                 new_state.result = s
-                new_state.advance(len(s))
+                new_state.go_to(match.end())
                 return new_state
             else:
                 raise ParserError("Regex not matched: {}".format(regex))
@@ -638,18 +826,24 @@ class StringParserGenerator(BaseParserGenerator):
 
     def compile_literal(self, rule):
 
-        value = rule['literal']
+        value = rule['$literal']
         if isinstance(value, dict):
             value = self._compile_rule(value)
+        #a unicode value never equals the bytes of other inputs
+        encoded_value = value.encode('utf-8') if isinstance(value, unicode) else value
 
         @self.parser('literal',rule=rule)
         def literal_parser(state, context):
             if callable(value):
                 v = value(state, context)
-            else:
+                if isinstance(v, unicode) and not isinstance(state.s, unicode):
+                    v = v.encode('utf-8')
+            elif isinstance(state.s, unicode):
                 v = value
-            found_value = state.value[:len(v)]
-            if found_value != v:
+            else:
+                v = encoded_value
+            if not starts_with(state.s, v, state.pos):
+                found_value = state.s[state.pos:state.pos+len(v)]
                 raise ParserError("Expected {}, but found '{}'".format(value, found_value))
             context.debug(v)
             new_state = state.copy()
@@ -663,9 +857,11 @@ class StringParserGenerator(BaseParserGenerator):
         try:
             return super(StringParserGenerator,self).resolve_rule(name)
         except AttributeError:
+            if name.startswith('$'):
+                raise
 
             def compiler():
-                parser = self.compile_literal(rule={'literal':name})
+                parser = self.compile_literal(rule={'$literal':name})
 
                 @self.parser(name,emit=True)
                 def wrapped_parser(state, context):
@@ -674,13 +870,177 @@ class StringParserGenerator(BaseParserGenerator):
                 return wrapped_parser
             return compiler
 
+class MemoStore(object):
+
+    """
+    The memo of the token parser, which holds the outcomes of the rules by
+    the ID of the last consumed token and the fingerprint of the rule. A
+    failure is stored as its exception, a success as a compact record of the
+    current token of the stream after the rule, the tokens that it consumed
+    and the parse trees that it emitted.
+
+    This store keeps all outcomes of a parse, the subclasses evict them by
+    different policies. We count the hits, misses and evictions.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.outcomes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, p, fingerprint):
+        outcomes = self.outcomes.get(p)
+        if outcomes is not None and fingerprint in outcomes:
+            self.hits += 1
+            self.touch(p, fingerprint)
+            return outcomes[fingerprint]
+        self.misses += 1
+        return None
+
+    def put(self, p, fingerprint, outcome):
+        outcomes = self.outcomes.get(p)
+        if outcomes is None:
+            outcomes = self.outcomes[p] = {}
+            self.add_position(p)
+        if not fingerprint in outcomes:
+            self.size += 1
+        outcomes[fingerprint] = outcome
+        self.touch(p, fingerprint)
+
+    def evict(self, p, fingerprint=None):
+        """
+        Evict the outcome of a rule at a position, or all outcomes at it.
+        """
+        outcomes = self.outcomes.get(p)
+        if outcomes is None:
+            return
+        if fingerprint is None:
+            n = len(outcomes)
+            del self.outcomes[p]
+        elif fingerprint in outcomes:
+            n = 1
+            del outcomes[fingerprint]
+            if not outcomes:
+                del self.outcomes[p]
+        else:
+            return
+        self.size -= n
+        self.evictions += n
+
+    def add_position(self, p):
+        pass
+
+    def touch(self, p, fingerprint):
+        pass
+
+    def commit(self, p):
+        """
+        Tell the store that the parser will not go back before the token p.
+        """
+        pass
+
+    def stats(self):
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'size' : self.size,
+        }
+
+class LRUMemoStore(MemoStore):
+
+    """
+    Keeps at most max_size outcomes, evicting the least recently used ones.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        super(LRUMemoStore, self).__init__()
+
+    def reset(self):
+        super(LRUMemoStore, self).reset()
+        self.order = OrderedDict()
+
+    def touch(self, p, fingerprint):
+        key = (p, fingerprint)
+        if key in self.order:
+            del self.order[key]
+        self.order[key] = True
+        while len(self.order) > self.max_size:
+            (p, fingerprint), _ = self.order.popitem(last=False)
+            self.evict(p, fingerprint)
+
+class PositionMemoStore(MemoStore):
+
+    """
+    The base of the stores that evict all outcomes before a position, which
+    keeps the positions in a heap.
+    """
+
+    def reset(self):
+        super(PositionMemoStore, self).reset()
+        self.positions = []
+        self.start = 0
+
+    def put(self, p, fingerprint, outcome):
+        if p < self.start:
+            return
+        super(PositionMemoStore, self).put(p, fingerprint, outcome)
+
+    def add_position(self, p):
+        heapq.heappush(self.positions, p)
+
+    def evict_before(self, start):
+        if start <= self.start:
+            return
+        self.start = start
+        positions = self.positions
+        while positions and positions[0] < start:
+            self.evict(heapq.heappop(positions))
+
+class WindowMemoStore(PositionMemoStore):
+
+    """
+    Keeps the outcomes at the tokens that lie at most window tokens behind
+    the farthest token that was consumed.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        super(WindowMemoStore, self).__init__()
+
+    def add_position(self, p):
+        super(WindowMemoStore, self).add_position(p)
+        self.evict_before(p-self.window)
+
+class CommitMemoStore(PositionMemoStore):
+
+    """
+    Evicts the outcomes before a commit point, which the parser reaches when
+    it consumes a breakpoint token (a token name with a ! suffix in the
+    grammar, like def!).
+    """
+
+    def commit(self, p):
+        self.evict_before(p)
+
 class TokenParserGenerator(BaseParserGenerator):
 
-    def __init__(self, *args, **kwargs):
-        super(TokenParserGenerator, self).__init__(*args, **kwargs)
-        from collections import defaultdict
+    """
+    The memo (a MemoStore, which keeps everything by default) remembers the
+    outcomes of the rules during a parse. It is reset whenever a parse
+    starts.
+    """
+
+    def __init__(self, grammar, memo=None):
+        super(TokenParserGenerator, self).__init__(grammar)
         self.failures = 0
-        self.outcomes = defaultdict(dict)
+        self.memo = memo if memo is not None else MemoStore()
 
     def rule_prefix(self,rule):
         if rule.endswith('!'):
@@ -714,7 +1074,7 @@ class TokenParserGenerator(BaseParserGenerator):
             def decorated_function(state, context, *args, **kwargs):
 
                 new_context = Context(context.level+1,name,context)
-                p = state.s.consumed_tokens[-1]['token_id'] if state.s.consumed_tokens else 0
+                p = state.s.consumed[0]['token_id'] if state.s.consumed is not None else 0
 
                 def print_info():
 
@@ -733,40 +1093,58 @@ class TokenParserGenerator(BaseParserGenerator):
 
                 if False:
                     print_info()
-                if fingerprint and p in self.outcomes and fingerprint in self.outcomes[p]:
-                    result = self.outcomes[p][fingerprint]
-                    if not isinstance(result,State):
-                        raise result
+                if not context.level:
+                    #this is the root of a new parse
+                    self.memo.reset()
+                outcome = self.memo.get(p, fingerprint) if fingerprint else None
+                if outcome is not None:
+                    if not isinstance(outcome,tuple):
+                        raise outcome
+                    result = self.replay(state, outcome)
+                    _, consumed_tokens, children = outcome
                 else:
                     if prefixes is not None and not self.can_proceed(prefixes, state):
-                        self.outcomes[p][fingerprint] = ExpectedParserError
+                        self.memo.put(p, fingerprint, ExpectedParserError)
                         raise ExpectedParserError
                     try:
                         result = f(state, new_context, *args, **kwargs)
-                        self.outcomes[p][fingerprint] = result
                     except ParserError as pe:
                         if not isinstance(pe,ExpectedParserError):
                             #print "Unexpected failure,",name,rule,pe,prefixes
                             #print_info()
                             self.failures += 1
-                        self.outcomes[p][fingerprint] = pe
+                        if fingerprint:
+                            self.memo.put(p, fingerprint, pe)
                         raise
+                    consumed_tokens = chain_since(result.s.consumed, state.s.consumed)
+                    children = chain_since(result.token_chain, state.token_chain)
+                    if fingerprint:
+                        self.memo.put(p, fingerprint, (result.s.current_token, consumed_tokens, children))
 
                 if emit:
-                    i = len(state.tokens)
-                    consumed_tokens = result.s.consumed_tokens[len(state.s.consumed_tokens):]
-                    children = result.tokens[i:]
-                    result.tokens = result.tokens[:i]
                     new_token = state.create_token(name,consumed_tokens,push=False)
-                    result.tokens.append(new_token)
                     if children:
                         new_token['c'] = children
+                    if result is state:
+                        result = state.copy()
+                    result.token_chain = (new_token, state.token_chain)
 
                 return result
             return decorated_function
 
         return dec
 
+    def replay(self, state, outcome):
+        """
+        Return the state after a rule from its recorded outcome.
+        """
+        current_token, consumed_tokens, tokens = outcome
+        new_state = state.copy()
+        new_state.s.current_token = current_token
+        new_state.s.consumed = chain_tokens(state.s.consumed, consumed_tokens)
+        new_state.token_chain = chain_tokens(state.token_chain, tokens)
+        return new_state
+
     def compile_token(self, name):
         if name.endswith('!'):
             name = name[:-1]
@@ -780,6 +1158,8 @@ class TokenParserGenerator(BaseParserGenerator):
             try:
                 token,prefix = new_state.value(token_type=name)
                 new_state.advance(from_token=token,prefix=prefix)
+                if breakpoint:
+                    self.memo.commit(token['token_id'])
                 return new_state
             except ValueError:
                 token = new_state.value()
@@ -792,17 +1172,390 @@ class TokenParserGenerator(BaseParserGenerator):
         try:
             return super(TokenParserGenerator,self).resolve_rule(name)
         except AttributeError:
+            if name.startswith('$'):
+                raise
             return lambda : self.compile_token(name)
 
+#the instructions of the bytecode back end
+LITERAL, REGEX, TOKEN, EOF, INDENT, CHOICE, COMMIT, PARTIAL_COMMIT, BACK_COMMIT, \
+    FAIL_TWICE, FAIL, CALL, RETURN, OPEN, CLOSE, END = range(16)
+
+class BytecodeGenerator(object):
+
+    """
+    An alternative back end that compiles a grammar into a flat list of
+    instructions, which a single loop runs (like LPeg), instead of into a
+    tower of closures. Calls and backtracking use an explicit stack, so we
+    need neither Python recursion nor exceptions to parse, and the parse
+    trees are the same as those of the closures.
+
+    The stack holds the return addresses of calls and choice entries, which
+    store the address of the alternative and all that we need to restore
+    the state if it fails: the position, the number of tokens (and of the
+    consumed tokens of a token parser), the indentation and the number of
+    open rule nodes. The subclasses compile the terminals of their input.
+    """
+
+    directives = ('or', 'optional', 'repeat', 'and', 'not')
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+
+    def emit(self, op, arg=None, arg2=None):
+        self.code.append([op, arg, arg2])
+        return len(self.code)-1
+
+    def compile(self, debug=False):
+        self.code = []
+        self.rule_addresses = {}
+        self.calls = []
+        self.compile_rule('start')
+        self.emit(END)
+        while self.calls:
+            address, name = self.calls.pop()
+            if not name in self.rule_addresses:
+                #the body of a rule creates a node for it
+                self.rule_addresses[name] = len(self.code)
+                self.emit(OPEN, name)
+                self.compile_rule(self.grammar[name])
+                self.emit(CLOSE)
+                self.emit(RETURN)
+            self.code[address][1] = self.rule_addresses[name]
+        self.code = [tuple(instruction) for instruction in self.code]
+
+        def parser(state, context=None):
+            return self.parse(state)
+
+        return parser
+
+    def compile_rule(self, rule):
+        if isinstance(rule,(str,unicode)):
+            if rule.startswith('$'):
+                self.compile_directive(rule)
+            elif rule in self.grammar:
+                self.calls.append((self.emit(CALL), rule))
+            else:
+                self.compile_name(rule)
+        elif isinstance(rule,(list,tuple)):
+            for subrule in rule:
+                self.compile_rule(subrule)
+        elif isinstance(rule,dict) and len(rule) == 1:
+            key,value = rule.items()[0]
+            self.compile_directive(key, value)
+        else:
+            raise ParserError("Unknown rule: {}".format(rule))
+
+    def compile_directive(self, name, *args):
+        if not name.startswith('$') or not name[1:] in self.directives:
+            raise ParserError("Unknown rule: {}".format(name))
+        getattr(self,'compile_{}'.format(name[1:]))(*args)
+
+    def compile_or(self, alternatives):
+        if not alternatives:
+            self.emit(FAIL)
+            return
+        commits = []
+        for alternative in alternatives[:-1]:
+            choice = self.emit(CHOICE)
+            self.compile_rule(alternative)
+            commits.append(self.emit(COMMIT))
+            self.code[choice][1] = len(self.code)
+        self.compile_rule(alternatives[-1])
+        for commit in commits:
+            self.code[commit][1] = len(self.code)
+
+    def compile_optional(self, rule):
+        choice = self.emit(CHOICE)
+        self.compile_rule(rule)
+        commit = self.emit(COMMIT)
+        self.code[choice][1] = self.code[commit][1] = len(self.code)
+
+    def compile_repeat(self, rule):
+        #the rule has to match once, then we try it again until it fails
+        self.compile_rule(rule)
+        loop = self.emit(CHOICE)
+        self.compile_rule(rule)
+        self.emit(PARTIAL_COMMIT, loop+1)
+        self.code[loop][1] = len(self.code)
+
+    def compile_and(self, rule):
+        choice = self.emit(CHOICE)
+        self.compile_rule(rule)
+        commit = self.emit(BACK_COMMIT)
+        self.code[choice][1] = self.emit(FAIL)
+        self.code[commit][1] = len(self.code)
+
+    def compile_not(self, rule):
+        choice = self.emit(CHOICE)
+        self.compile_rule(rule)
+        self.emit(FAIL_TWICE)
+        self.code[choice][1] = len(self.code)
+
+    def run(self, s, pos, cursor, consumed, tokens, indents, line_index):
+        """
+        Run the code on the input: a string s (and its line index) for a
+        string parser, or the cursor of a token stream and the list of the
+        consumed tokens for a token parser, where pos is their number. The
+        tokens that we create are added to the given list. Returns the
+        position, the cursor and the indentation at the end.
+        """
+        code = self.code
+        binary = not isinstance(s, unicode)
+        stack = []
+        opens = []
+        pc = 0
+        while True:
+            op, arg, arg2 = code[pc]
+            if op == LITERAL:
+                if binary:
+                    arg = arg2
+                if starts_with(s, arg, pos):
+                    end = pos+len(arg)
+                    tokens.append(self.create_token('literal', s[pos:end], pos, end, line_index))
+                    pos = end
+                    pc += 1
+                    continue
+            elif op == CALL:
+                stack.append(pc+1)
+                pc = arg
+                continue
+            elif op == RETURN:
+                pc = stack.pop()
+                continue
+            elif op == OPEN:
+                opens.append((arg, len(tokens), pos))
+                pc += 1
+                continue
+            elif op == CLOSE:
+                name, i, start = opens.pop()
+                children = tokens[i:]
+                del tokens[i:]
+                if consumed is None:
+                    token = self.create_token(name, s[start:pos], start, pos, line_index)
+                else:
+                    token = {'type' : name, 'tokens' : consumed[start:pos]}
+                if children:
+                    token['c'] = children
+                tokens.append(token)
+                pc += 1
+                continue
+            elif op == CHOICE:
+                stack.append((arg, pos, cursor, len(tokens), indents, len(opens)))
+                pc += 1
+                continue
+            elif op == COMMIT:
+                stack.pop()
+                pc = arg
+                continue
+            elif op == PARTIAL_COMMIT:
+                entry = stack[-1]
+                if entry[1] == pos:
+                    #the repetition does not advance, so we end it
+                    stack.pop()
+                    pc += 1
+                else:
+                    stack[-1] = (entry[0], pos, cursor, len(tokens), indents, len(opens))
+                    pc = arg
+                continue
+            elif op == REGEX:
+                match = arg.match(s, pos)
+                if match:
+                    end = match.end()
+                    tokens.append(self.create_token('regex', match.group(0), pos, end, line_index))
+                    pos = end
+                    pc += 1
+                    continue
+            elif op == TOKEN:
+                #the next token of the type, skipping ignored tokens and
+                #descending into the children of the tokens (see TokenStream.get)
+                token = cursor
+                prefix = []
+                while token is not None:
+                    while token['value'].get('ignore') and token['next']:
+                        prefix.append(token)
+                        token = token['next']
+                    if token['value']['type'] == arg:
+                        break
+                    token = token.get('children')
+                if token is not None:
+                    prefix.append(token)
+                    consumed.extend(prefix)
+                    pos += len(prefix)
+                    cursor = token.get('next')
+                    tokens.append({'type' : arg, 'tokens' : prefix})
+                    pc += 1
+                    continue
+            elif op == BACK_COMMIT:
+                _, pos, cursor, n, indents, m = stack.pop()
+                del tokens[n:]
+                del opens[m:]
+                if consumed is not None:
+                    del consumed[pos:]
+                pc = arg
+                continue
+            elif op == EOF:
+                if pos >= len(s):
+                    tokens.append(self.create_token('eof', '', pos, pos, line_index))
+                    pc += 1
+                    continue
+            elif op == INDENT:
+                indent_str = arg.match(s, pos).group(0)
+                indent_tokens, new_indents = self.indent(indent_str, indents, pos, line_index)
+                if indent_tokens is not None:
+                    tokens.extend(indent_tokens)
+                    indents = new_indents
+                    pos += len(indent_str)
+                    pc += 1
+                    continue
+            elif op == END:
+                return pos, cursor, indents
+            #the instruction failed (a terminal that did not match, FAIL or
+            #FAIL_TWICE), so we go back to the last choice
+            if op == FAIL_TWICE:
+                stack.pop()
+            while stack and type(stack[-1]) is int:
+                stack.pop()
+            if not stack:
+                raise ParserError("The input does not match the grammar")
+            pc, pos, cursor, n, indents, m = stack.pop()
+            del tokens[n:]
+            del opens[m:]
+            if consumed is not None:
+                del consumed[pos:]
+
+class StringBytecodeGenerator(BytecodeGenerator):
+
+    """
+    Compiles the grammar of a string parser (see StringParserGenerator).
+    """
+
+    directives = BytecodeGenerator.directives+('literal', 'regex', 'eof', 'indent')
+
+    def compile_name(self, name):
+        #a name that is no rule is a literal with a node of its own
+        self.emit(OPEN, name)
+        self.emit_literal(name)
+        self.emit(CLOSE)
+
+    def compile_literal(self, value):
+        if not isinstance(value,(str,unicode)):
+            raise ParserError("The bytecode back end only supports string literals")
+        self.emit_literal(value)
+
+    def emit_literal(self, value):
+        #the second argument is the value that we match on inputs that are no
+        #unicode string, as a unicode value never equals their bytes
+        self.emit(LITERAL, value, value.encode('utf-8') if isinstance(value, unicode) else value)
+
+    def compile_regex(self, regex):
+        #DOTALL is necessary to match newlines
+        self.emit(REGEX, re.compile(regex,re.DOTALL), regex)
+
+    def compile_eof(self):
+        self.emit(EOF)
+
+    def compile_indent(self):
+        self.emit(INDENT, re.compile(r'[ \t]*'))
+
+    def create_token(self, name, s, start, end, line_index, **opts):
+        line, col = line_index.position(start)
+        token = {
+          'type' : name,
+          's' : s,
+          'from' : {'p' : start,'l' : line,'c' : col},
+        }
+        if name.startswith('__'):
+            token['ignore'] = True
+        token.update(opts)
+        line, col = line_index.position(end)
+        token['to'] = {'p' : end,'l' : line,'c' : col}
+        return token
+
+    def indent(self, indent_str, indents, pos, line_index):
+        """
+        Compare the indentation to the current one like the $indent parser
+        of StringParserGenerator. Returns the tokens and the indentation
+        after it, or None if it does not match.
+        """
+        current_indent = indents[-1]
+        if indent_str == current_indent:
+            end = pos+len(indent_str)
+            return [self.create_token('current_indent',indent_str,pos,end,line_index,ignore=True)], indents
+        elif len(indent_str) > len(current_indent) and indent_str[:len(current_indent)] == current_indent:
+            middle = pos+len(current_indent)
+            end = pos+len(indent_str)
+            return [self.create_token('current_indent',current_indent,pos,middle,line_index,ignore=True),
+                    self.create_token('indent',indent_str[len(current_indent):],middle,end,line_index)], \
+                   indents+(indent_str,)
+        possible_indents = indents[:-1]
+        cnt = 0
+        while possible_indents:
+            cnt += 1
+            possible_indent = possible_indents[-1]
+            possible_indents = possible_indents[:-1]
+            if possible_indent == indent_str:
+                tokens = [self.create_token('dedent','',pos,pos,line_index) for i in range(cnt)]
+                end = pos+len(possible_indent)
+                tokens.append(self.create_token('current_indent',possible_indent,pos,end,line_index,ignore=True))
+                return tokens, possible_indents+(possible_indent,)
+        return None, indents
+
+    def parse(self, state):
+        tokens = []
+        indents = state.store.get('indent',('',))
+        pos, cursor, new_indents = self.run(state.s, state.pos, None, None, tokens, indents, state.line_index)
+        result = StringState(state.s, pos, state.line_index)
+        result.parent = state
+        result.store = state.store
+        if new_indents is not indents:
+            result.store = dict(state.store, indent=new_indents)
+        result.token_chain = chain_tokens(state.token_chain, tokens)
+        return result
+
+class TokenBytecodeGenerator(BytecodeGenerator):
+
+    """
+    Compiles the grammar of a token parser (see TokenParserGenerator).
+    """
+
+    def compile_name(self, name):
+        #a name that is no rule is a token type, a ! suffix only matters to
+        #the memo of TokenParserGenerator
+        if name.endswith('!'):
+            name = name[:-1]
+        self.emit(TOKEN, name)
+
+    def parse(self, state):
+        stream = state.s.copy()
+        if stream.current_token is None and not stream.initialized:
+            stream.build_linked_list()
+        tokens = []
+        consumed = []
+        pos, cursor, indents = self.run(None, 0, stream.current_token, consumed, tokens, (), None)
+        stream.current_token = cursor
+        stream.consumed = chain_tokens(stream.consumed, consumed)
+        result = TokenState(stream)
+        result.parent = state
+        result.token_chain = chain_tokens(state.token_chain, tokens)
+        return result
+
 if __name__ == '__main__':
     import sys
-    sys.setrecursionlimit(10000)
 
-    if len(sys.argv) < 3:
-        sys.stderr.write("Usage: {} [grammar filename] [code filename]\n".format(os.path.basename(__file__)))
+    #with --bytecode we run the grammar on the bytecode back end, which does not recurse
+    bytecode = '--bytecode' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != '--bytecode']
+    if bytecode:
+        string_generator, token_generator = StringBytecodeGenerator, TokenBytecodeGenerator
+    else:
+        sys.setrecursionlimit(10000)
+        string_generator, token_generator = StringParserGenerator, TokenParserGenerator
+
+    if len(args) < 2:
+        sys.stderr.write("Usage: {} [--bytecode] [grammar filename] [code filename]\n".format(os.path.basename(__file__)))
         exit(-1)
-    grammar_filename = sys.argv[1]
-    code_filename = sys.argv[2]
+    grammar_filename = args[0]
+    code_filename = args[1]
 
     with open(grammar_filename,'r') as grammar_file:
         grammar = yaml.load(grammar_file.read())
@@ -812,15 +1565,15 @@ if __name__ == '__main__':
 
     if 'tokenizer' in grammar:
         #we tokenize the input, then feed it to the token-based parser
-        tokenizer_generator = StringParserGenerator(grammar['tokenizer'])
+        tokenizer_generator = string_generator(grammar['tokenizer'])
         tokenizer = tokenizer_generator.compile()
         del grammar['tokenizer']
-        parser_generator = TokenParserGenerator(grammar)
+        parser_generator = token_generator(grammar)
         parser = parser_generator.compile()
     else:
         #we directly feed the input to the string-based parser.
         tokenizer = None
-        parser_generator = StringParserGenerator(grammar)
+        parser_generator = string_generator(grammar)
         parser = parser_generator.compile()
 
 
@@ -872,5 +1625,6 @@ if __name__ == '__main__':
 
     print stop-start
 
-    print parser_generator.failures
+    if not bytecode:
+        print parser_generator.failures
 
@@ -0,0 +1,78 @@
+"""
+Helpers shared by the tests of the GLR parser.
+"""
+
+import subprocess
+import json
+import os
+
+import pytest
+import yaml
+
+from glr_parser import ForestNode
+
+examples_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                            'examples')
+
+def read_example(*path):
+    with open(os.path.join(examples_dir, *path)) as input:
+        return input.read()
+
+def feed(parser, text, size, **kwargs):
+    """
+    Parse the text with a stream, in chunks of the given size.
+    """
+    session = parser.stream(**kwargs)
+    for i in range(0, len(text), size):
+        session.feed(text[i:i+size])
+    return session.finish()
+
+def forest(accepted_stacks):
+    """
+    Describe the forest below the given accepted stacks as a set of nodes
+    with their positions and derivations, which we can compare between
+    parses.
+    """
+    def key(node):
+        if not isinstance(node, ForestNode):
+            return node
+        label = node.symbol if hasattr(node, 'symbol') else (node.rule, node.dot)
+        return (label, node.start, node.end)
+    nodes = set()
+    seen = set()
+    stack = [value for accepted in accepted_stacks for value, parent in accepted.edges]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, ForestNode) or id(node) in seen:
+            continue
+        seen.add(id(node))
+        nodes.add((key(node), frozenset((packed.rule, key(packed.left), key(packed.right))
+                                        for packed in node.packed)))
+        stack.extend(child for packed in node.packed for child in (packed.left, packed.right))
+    return nodes
+
+python_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# parser_v2 needs Python 2, which we run in a subprocess
+python2 = os.environ.get('PARSEJOY_PYTHON2', 'python2')
+
+def load_yaml_grammar(*path):
+    return yaml.safe_load(read_example(*path))
+
+def run_python2(script, **data):
+    """
+    Run a script with Python 2 in the directory of the parsers. The script
+    reads the given data as JSON from its input and writes its result as
+    JSON on the last line of its output, which we return. Skips the test if there is no Python 2, whose
+    interpreter PARSEJOY_PYTHON2 can name.
+    """
+    try:
+        process = subprocess.run([python2, '-c', script], input=json.dumps(data), cwd=python_dir,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    except OSError:
+        pytest.skip("{} is not available".format(python2))
+    # the shell (or a pyenv shim) cannot find the interpreter
+    if process.returncode == 127:
+        pytest.skip("{} is not available".format(python2))
+    assert process.returncode == 0, process.stderr
+    return json.loads(process.stdout.splitlines()[-1])
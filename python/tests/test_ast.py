@@ -0,0 +1,57 @@
+from glr_parser import AstBuilder, Parser, literal, make_ast, regex, walk_forest
+
+grammar = [['S', '{}rule', '\0'],
+           ['{}rule', ':name', literal('->'), '[]items'],
+           ['[]items', '[]items', literal(','), '(:item|:number)'],
+           ['[]items', '(:item|:number)'],
+           ['(:item|:number)', ':item'],
+           ['(:item|:number)', ':number'],
+           [':name', regex('[a-z]+')],
+           [':item', regex('[a-z]+')],
+           [':number', regex('[0-9]+')]]
+
+class Events(object):
+
+    def __init__(self):
+        self.events = []
+
+    def start_node(self, kind, name):
+        self.events.append(('start', kind, name))
+
+    def value(self, value):
+        self.events.append(('value', value))
+
+    def end_node(self):
+        self.events.append(('end',))
+
+def parse(text):
+    accepted_stacks, longest_stacks = Parser(grammar).run(text)
+    assert len(accepted_stacks) == 1
+    return accepted_stacks[0].edges[0][0]
+
+def test_events():
+    root = parse('r->a,1')
+    events = Events()
+    walk_forest(root, events)
+    # the helper nodes of the alternative group leave no events
+    assert events.events == [('start', 'sequence', 'S'), ('start', 'dict', 'rule'),
+                             ('start', 'value', 'name'), ('value', 'r'), ('end',),
+                             ('start', 'list', 'items'), ('start', 'list', 'items'),
+                             ('start', 'value', 'item'), ('value', 'a'), ('end',), ('end',),
+                             ('start', 'value', 'number'), ('value', '1'), ('end',),
+                             ('end',), ('end',), ('end',)]
+    tree_events = Events()
+    walk_forest(root.tree(), tree_events)
+    assert tree_events.events == events.events
+
+def test_make_ast():
+    root = parse('r->a,1,c')
+    builder = AstBuilder()
+    walk_forest(root, builder)
+    assert builder.result == make_ast(root) == [{'name': 'r', 'items': [{'item': 'a'}, {'number': '1'},
+                                                                         {'item': 'c'}]}]
+
+def test_deep_list():
+    # the walk does not recurse, so a long left-recursive list is no problem
+    ast = make_ast(parse('r->'+','.join(['a']*5000)))
+    assert ast[0]['items'] == [{'item': 'a'}]*5000
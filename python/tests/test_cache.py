@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from glr_parser import Parser, TableCache, compile_grammar, grammar_grammar
+
+from helpers import forest, read_example
+
+grammar_source = read_example('gospel', 'grammar.grm')
+
+# the tables that are plain data, which we can compare after a round trip
+data_attributes = ('rule_lengths', 'reduce_offsets', 'reduce_rules', 'goto_base', 'goto_next',
+                   'goto_check', 'shift_masks', 'lookaheads', 'follow_masks', 'first_sets',
+                   'follow_sets')
+
+def test_store_and_load(tmp_path):
+    cache = TableCache(str(tmp_path))
+    assert cache.load('key') is None
+    cache.store('key', {'a': [1, 2]})
+    cache.store('key', 'grammar', kind='grammar')
+    assert cache.load('key') == {'a': [1, 2]}
+    assert cache.load('key', kind='grammar') == 'grammar'
+
+def test_cached_tables(tmp_path):
+    cache = TableCache(str(tmp_path))
+    parser = Parser(grammar_grammar, cache=cache)
+    assert os.path.exists(cache.path(parser.fingerprint, 'tables'))
+    cached_parser = Parser(grammar_grammar, cache=cache)
+    # the tables were loaded, so there is no automaton yet
+    assert not 'states' in cached_parser.__dict__
+    for name in data_attributes:
+        assert getattr(cached_parser, name) == getattr(parser, name)
+    assert (forest(cached_parser.run(grammar_source)[0]) ==
+            forest(Parser(grammar_grammar).run(grammar_source)[0]))
+
+def test_cached_grammar(tmp_path):
+    cache = TableCache(str(tmp_path))
+    grammar = compile_grammar(grammar_source, cache=cache)
+    assert compile_grammar(grammar_source, cache=cache) == grammar == compile_grammar(grammar_source)
+
+def test_broken_entry_is_a_miss(tmp_path):
+    cache = TableCache(str(tmp_path))
+    parser = Parser(grammar_grammar, cache=cache)
+    with open(cache.path(parser.fingerprint, 'tables'), 'wb') as output:
+        output.write(b'not a pickle')
+    with pytest.warns(RuntimeWarning):
+        assert cache.load(parser.fingerprint) is None
+    with pytest.warns(RuntimeWarning):
+        rebuilt_parser = Parser(grammar_grammar, cache=cache)
+    assert rebuilt_parser.shift_masks == parser.shift_masks
+    assert cache.load(parser.fingerprint) is not None
@@ -0,0 +1,112 @@
+import pytest
+
+from glr_parser import GrammarError, Parser, TableCache, compile_grammar, grammar_grammar, grammar_program
+
+from helpers import read_example
+
+def test_sample_grammar_compiles():
+    rules = compile_grammar(grammar_program)
+    assert ['Sub', 'bar', {'assoc' : 'left', 'priority' : 2}] in rules
+
+def test_unknown_argument():
+    with pytest.raises(GrammarError):
+        compile_grammar('Sub(foo)->bar;')
+
+def test_layout_overlapping_next_terminal():
+    with pytest.raises(GrammarError):
+        Parser([['S', 'L', ' ', 'x', '\0'], ['L', {'layout' : True}], ['L', 'L', ' ', {'layout' : True}]])
+
+def test_layout_following_itself():
+    with pytest.raises(GrammarError):
+        Parser([['S', 'L', 'L', 'x', '\0'], ['L', ' ', {'layout' : True}], ['L', 'L', ' ', {'layout' : True}]])
+
+def test_layout():
+    parser = Parser([['S', 'L', 'x', 'L', 'y', '\0'], ['L', {'layout' : True}], ['L', 'L', ' ', {'layout' : True}]])
+    assert len(parser.run(' x  y')[0]) == 1
+
+def test_automaton_after_cache_load(tmp_path):
+    cache = TableCache(str(tmp_path))
+    parser = Parser(grammar_grammar, cache=cache)
+    states, transitions, callable_transitions = parser.generate_states_and_transitions()
+    cached = Parser(grammar_grammar, cache=cache)
+    assert cached.automaton() == (states, transitions, callable_transitions)
+    with pytest.raises(AttributeError):
+        cached.unknown_attribute
+
+def recursive_automaton(grammar):
+    """
+    The states and transitions of the recursive builder that the parser used
+    before it had a worklist, which numbers the states in the order in
+    which it finds them.
+    """
+    non_terminals = set(rule[0] for rule in grammar)
+    def get_closure(rule, pos):
+        if pos >= len(grammar[rule])-1 or not grammar[rule][pos+1] in non_terminals:
+            return []
+        rules_to_examine = [i for i, r in enumerate(grammar) if r[0] == grammar[rule][pos+1]]
+        closure = set(rules_to_examine)
+        while rules_to_examine:
+            r = rules_to_examine.pop()
+            if len(grammar[r]) > 1 and grammar[r][1] in non_terminals:
+                new_rules = [i for i, rr in enumerate(grammar) if rr[0] == grammar[r][1]]
+                rules_to_examine.extend([rr for rr in new_rules if not rr in closure])
+                closure = closure | set(new_rules)
+        return [(r, 0) for r in closure]
+    states = [set([(0, 0)]+get_closure(0, 0))]
+    transitions = {}
+    def extend_state(state):
+        j = states.index(state)
+        rules_by_symbol = {}
+        for r, p in state:
+            if len(grammar[r]) > p+1:
+                rules_by_symbol.setdefault(grammar[r][p+1], []).append((r, p+1))
+        for symbol, new_rules in rules_by_symbol.items():
+            new_state = set(new_rules)
+            for rr in new_rules:
+                new_state = new_state | set(get_closure(*rr))
+            if new_state in states:
+                i = states.index(new_state)
+            else:
+                i = len(states)
+                states.append(new_state)
+                extend_state(new_state)
+            transitions.setdefault(j, {})[symbol] = i
+    extend_state(states[0])
+    return states, transitions
+
+@pytest.mark.parametrize('name', ['grammar_grammar', 'gospel'])
+def test_automaton_numbering(name):
+    if name == 'gospel':
+        parser = Parser(compile_grammar(read_example('gospel', 'grammar.grm')))
+    else:
+        parser = Parser(grammar_grammar)
+    states, transitions = recursive_automaton(parser.grammar)
+    parser_states, parser_transitions, callable_transitions = parser.automaton()
+    assert parser_states == states
+    shifts = dict((j, dict((symbol, i) for symbol, i in t.items() if symbol != '__reduce__'))
+                  for j, t in parser_transitions.items())
+    assert dict((j, t) for j, t in shifts.items() if t) == transitions
+
+def test_quoted_argument():
+    rules = compile_grammar('separator(follow="[,;) ]", longest) -> ",";')
+    assert rules[0][-1]['longest']
+    follow, = rules[0][-1]['follow']
+    assert follow.pattern == '[,;) ]'
+
+def test_alternative_groups():
+    rules = compile_grammar(r'''
+S -> tag, $;
+tag -> "<", (a | b), ">", (a | b), "</", \1, ">";
+a -> "a";
+b -> "b";
+''')
+    # both groups share a helper non-terminal instead of expanding the rule
+    assert len([rule for rule in rules if rule[0] == 'tag']) == 1
+    assert [rule for rule in rules if rule[0] == '(a|b)'] == [['(a|b)', 'a'], ['(a|b)', 'b']]
+    parser = Parser(rules)
+    for text, accepted in [('<a>b</a>', True), ('<b>a</b>', True), ('<a>b</b>', False), ('<b>b</a>', False)]:
+        assert bool(parser.run(text)[0]) == accepted
+
+def test_unknown_reference():
+    with pytest.raises(GrammarError):
+        compile_grammar(r'tag -> (a | b), \2;')
@@ -0,0 +1,36 @@
+import pytest
+
+from glr_parser import Parser, ParseLimitExceeded, ParseLimits, ParserStats, literal
+
+def ambiguous_parser():
+    return Parser([['S', 'E', '\0'], ['E', 'E', 'E'], ['E', literal('a')]])
+
+def test_time_limit_within_level():
+    parser = ambiguous_parser()
+    stats = ParserStats(parser)
+    session = parser.stream(window=1, stats=stats, limits=ParseLimits(time_limit=3600))
+    session.feed('a'*30)
+    reductions = sum(stats.rule_reductions)
+    # the next level takes many more reductions than we check the time after
+    session.deadline = 0
+    with pytest.raises(ParseLimitExceeded) as e:
+        session.feed('a')
+    assert e.value.limit == 'time'
+    assert sum(stats.rule_reductions)-reductions <= session.time_check_interval
+
+def test_reductions_limit():
+    parser = ambiguous_parser()
+    stats = ParserStats(parser)
+    with pytest.raises(ParseLimitExceeded) as e:
+        parser.run('a'*30, stats=stats, limits=ParseLimits(max_reductions=1000))
+    assert e.value.limit == 'reductions'
+    assert sum(stats.rule_reductions) <= 1000
+
+def test_max_heads():
+    parser = ambiguous_parser()
+    stats = ParserStats(parser)
+    accepted_stacks, longest_stacks = parser.run('a'*30, stats=stats, limits=ParseLimits(max_heads=2))
+    # pruning can lose parses, but not all of them in this grammar
+    assert accepted_stacks
+    assert stats.pruned_heads > 0
+    assert max(stats.heads) <= 2
@@ -0,0 +1,15 @@
+import pytest
+
+from line_index import LineIndex
+
+text = 'first\nsecond line\n\nlast'
+
+@pytest.mark.parametrize('source', [text, text.encode('ascii'), bytearray(text.encode('ascii')),
+                                    memoryview(text.encode('ascii'))])
+def test_positions(source):
+    index = LineIndex(source)
+    assert index.starts == [0, 6, 18, 19]
+    assert index.position(0) == (1, 1)
+    assert index.position(8) == (2, 3)
+    assert index.position(18) == (3, 1)
+    assert (index.line(22), index.col(22)) == (4, 4)
@@ -0,0 +1,85 @@
+from glr_parser import Parser, compile_grammar, grammar_grammar, literal, regex
+
+from helpers import forest, read_example
+
+grammar_source = read_example('gospel', 'grammar.grm')
+program_source = read_example('gospel', 'program.gsp')
+
+def expression_grammar(plus={}, times={}, power={}):
+    return [['S', 'e', '\0'],
+            ['e', 'e', literal('+'), 'e', plus],
+            ['e', 'e', literal('*'), 'e', times],
+            ['e', 'e', literal('^'), 'e', power],
+            ['e', regex('[0-9]')]]
+
+operators = dict(plus={'priority': 1, 'assoc': 'left'}, times={'priority': 2, 'assoc': 'left'},
+                 power={'priority': 3, 'assoc': 'right'})
+
+def ambiguities(accepted_stacks):
+    return sum(1 for (symbol, start, end), derivations in forest(accepted_stacks)
+               if len(derivations) > 1 and isinstance(symbol, str))
+
+def show(tree):
+    """
+    Render the tree of an expression with a pair of parentheses around every
+    operation.
+    """
+    if isinstance(tree, str):
+        return tree
+    symbol, children = tree
+    children = [show(child) for child in children if child != '\0']
+    if symbol in ('S', 'e') and len(children) > 1:
+        return '('+' '.join(children)+')'
+    return ''.join(children)
+
+def parse(grammar, text):
+    accepted_stacks, longest_stacks = Parser(grammar).run(text)
+    if not accepted_stacks:
+        return None
+    return show(accepted_stacks[0].edges[0][0].tree())
+
+def test_deterministic_matches_generalized():
+    # without lookahead, the parser never takes the deterministic fast path
+    for grammar, text in [(grammar_grammar, grammar_source),
+                          (compile_grammar(grammar_source), program_source),
+                          (expression_grammar(), '1+2*3+4'),
+                          (expression_grammar(**operators), '1+2*3+4*5*6^7^8')]:
+        accepted_stacks, longest_stacks = Parser(grammar).run(text)
+        generalized_stacks, generalized_longest = Parser(grammar, lookahead=False).run(text)
+        assert len(accepted_stacks) == 1
+        assert forest(generalized_stacks) == forest(accepted_stacks)
+
+def test_ambiguous_expression():
+    accepted_stacks, longest_stacks = Parser(expression_grammar()).run('1+2*3+4')
+    assert ambiguities(accepted_stacks) == 3
+
+def test_priority_and_assoc():
+    grammar = expression_grammar(**operators)
+    assert parse(grammar, '1+2*3+4*5*6') == '((1 + (2 * 3)) + ((4 * 5) * 6))'
+    assert parse(grammar, '1^2^3*4') == '((1 ^ (2 ^ 3)) * 4)'
+    assert ambiguities(Parser(grammar).run('1+2*3+4*5*6')[0]) == 0
+
+def test_nonassoc():
+    grammar = expression_grammar(plus={'assoc': 'nonassoc'})
+    assert parse(grammar, '1+2') == '(1 + 2)'
+    assert parse(grammar, '1+2+3') is None
+
+def test_reject():
+    grammar = [['S', 'stmt', '\0'],
+               ['stmt', literal('if '), 'name'],
+               ['stmt', 'name'],
+               ['name', regex('[a-z]+')],
+               ['name', literal('if'), {'reject': True}]]
+    assert parse(grammar, 'if x') == 'if x'
+    assert parse(grammar, 'iff') == 'iff'
+    assert parse(grammar, 'if if') is None
+    assert parse(grammar, 'if') is None
+
+def test_filters_in_grm_source():
+    grammar = compile_grammar(r'''
+S -> e, $;
+e(left, priority=1) -> e, "+", e;
+e(left, priority=2) -> e, "*", e;
+e -> re:[0-9];
+''')
+    assert parse(grammar, '1+2*3+4') == '((1 + (2 * 3)) + 4)'
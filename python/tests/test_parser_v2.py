@@ -0,0 +1,159 @@
+from helpers import load_yaml_grammar, read_example, run_python2
+
+prelude = """
+from __future__ import print_function
+import mmap, tempfile, json, sys
+sys.setrecursionlimit(100000)
+from parser_v2 import *
+data = json.load(sys.stdin)
+def dump(result):
+    print(json.dumps(result, default=str))
+"""
+
+def test_inputs():
+    script = prelude+"""
+code = data['code'].encode('utf-8')
+output = tempfile.TemporaryFile()
+output.write(code)
+output.flush()
+results = {}
+for generator in (StringParserGenerator, StringBytecodeGenerator):
+    tokenizer = generator(data['grammar']['tokenizer']).compile()
+    for s in (code, buffer(code), bytearray(code), mmap.mmap(output.fileno(), 0, access=mmap.ACCESS_READ)):
+        result = tokenizer(StringState(s), Context(0, 'root', None))
+        results.setdefault(generator.__name__, []).append((result.pos, result.tokens))
+    results[generator.__name__+'-unicode'] = tokenizer(StringState(data['code']), Context(0, 'root', None)).pos
+try:
+    StringState(memoryview(code))
+    results['memoryview'] = None
+except TypeError as e:
+    results['memoryview'] = str(e)
+dump(results)
+"""
+    code = read_example('python', 'example.py')
+    results = run_python2(script, grammar=load_yaml_grammar('python', 'grammar.yml'), code=code)
+    assert 'memoryview' in results.pop('memoryview')
+    # the positions in a unicode string count characters, not bytes
+    assert results.pop('StringParserGenerator-unicode') == results.pop('StringBytecodeGenerator-unicode') == len(code)
+    closures, bytecode = results['StringParserGenerator'], results['StringBytecodeGenerator']
+    assert closures == bytecode
+    assert all(result == closures[0] for result in closures)
+    assert closures[0][0] == len(code.encode('utf-8'))
+
+def test_memo_per_parse():
+    script = prelude+"""
+generator = StringParserGenerator(data['grammar'], memoize=True)
+parser = generator.compile()
+results = []
+# the same input object, changed between two parses
+s = bytearray(b'(1+1)*2')
+for i in range(2):
+    results.append(parser(StringState(s), Context(0, 'root', None)).tokens)
+    results.append(len(generator.memo))
+    s[5:7] = b'+2+3'
+try:
+    parser(StringState(b'(1+'), Context(0, 'root', None))
+except ParserError:
+    pass
+results.append(len(generator.memo))
+reference = StringParserGenerator(data['grammar']).compile()
+results.append(reference(StringState(b'(1+1)+2+3'), Context(0, 'root', None)).tokens)
+dump(results)
+"""
+    first, first_memo, second, second_memo, failed_memo, reference = run_python2(
+        script, grammar=load_yaml_grammar('calculator', 'grammar.yml'))
+    assert first_memo == second_memo == failed_memo == 0
+    assert first[0]['s'] == '(1+1)*2'
+    assert second[0]['s'] == '(1+1)+2+3'
+    assert second == reference
+
+parse_python = """
+def tree(tokens):
+    return [(token['type'], [t['value']['s'] for t in token['tokens']], tree(token.get('c', [])))
+            for token in tokens]
+
+def parse(code, string_generator, token_generator, **kwargs):
+    grammar = dict(data['grammar'])
+    tokenizer = string_generator(grammar.pop('tokenizer')).compile()
+    tokens = tokenizer(StringState(code), Context(0, 'root', None)).tokens
+    stream = TokenStream(tokens)
+    stream.build_linked_list()
+    generator = token_generator(grammar, **kwargs)
+    result = generator.compile()(TokenState(stream), Context(0, 'root', None))
+    return generator, tree(result.tokens)
+"""
+
+def test_memo_stores():
+    script = prelude+parse_python+"""
+results = {}
+for name, memo in [('all', MemoStore()), ('lru', LRUMemoStore(50)), ('window', WindowMemoStore(20)),
+                   ('commit', CommitMemoStore())]:
+    generator, parse_tree = parse(data['code'], StringParserGenerator, TokenParserGenerator, memo=memo)
+    results[name] = (parse_tree, memo.stats())
+
+memo = LRUMemoStore(2)
+for p in range(3):
+    memo.put(p, 'rule', p)
+lru = [memo.get(0, 'rule'), memo.get(2, 'rule'), memo.stats()]
+
+memo = WindowMemoStore(2)
+for p in (0, 1, 5):
+    memo.put(p, 'rule', p)
+window = [memo.get(1, 'rule'), memo.get(5, 'rule'), memo.stats()]
+
+memo = CommitMemoStore()
+memo.put(1, 'rule', 1)
+memo.commit(3)
+memo.put(2, 'rule', 2)
+commit = [memo.get(1, 'rule'), memo.get(2, 'rule'), memo.stats()]
+dump([results, lru, window, commit])
+"""
+    results, lru, window, commit = run_python2(script, grammar=load_yaml_grammar('python', 'grammar.yml'),
+                                               code=read_example('python', 'example.py'))
+    tree, stats = results.pop('all')
+    assert stats['hits'] > 0 and stats['evictions'] == 0
+    for name, (other_tree, other_stats) in results.items():
+        assert other_tree == tree
+        assert other_stats['size'] < stats['size']
+    assert results['lru'][1]['size'] <= 50
+    assert lru == [None, 2, {'hits': 1, 'misses': 1, 'evictions': 1, 'size': 2}]
+    assert window == [None, 5, {'hits': 1, 'misses': 1, 'evictions': 2, 'size': 1}]
+    assert commit == [None, None, {'hits': 0, 'misses': 2, 'evictions': 1, 'size': 0}]
+
+def test_bytecode_matches_closures():
+    script = prelude+parse_python+"""
+results = []
+for generators in [(StringParserGenerator, TokenParserGenerator), (StringBytecodeGenerator, TokenBytecodeGenerator)]:
+    results.append(parse(data['code'], *generators)[1])
+# the bytecode back end does not recurse
+sys.setrecursionlimit(1000)
+depth = 5000
+calculator = StringBytecodeGenerator(data['calculator']).compile()
+result = calculator(StringState('('*depth+'1'+')'*depth), Context(0, 'root', None))
+results.append(result.pos == 2*depth+1)
+dump(results)
+"""
+    closures, bytecode, deep = run_python2(script, grammar=load_yaml_grammar('python', 'grammar.yml'),
+                                           calculator=load_yaml_grammar('calculator', 'grammar.yml'),
+                                           code=read_example('python', 'example.py'))
+    assert closures
+    assert bytecode == closures
+    assert deep
+
+def test_shared_state():
+    script = prelude+"""
+state = StringState('abc')
+state.create_token('a', 'a')
+copy = state.copy()
+copy.create_token('b', 'b')
+stream = TokenStream([{'type': 'a'}, {'type': 'b'}])
+stream.advance()
+stream_copy = stream.copy()
+stream_copy.advance()
+dump([copy.token_chain[1] is state.token_chain, copy.store is state.store,
+      [token['type'] for token in state.tokens], [token['type'] for token in copy.tokens],
+      stream_copy.consumed[1] is stream.consumed,
+      [token['value']['type'] for token in stream.consumed_tokens],
+      [token['value']['type'] for token in stream_copy.consumed_tokens]])
+"""
+    assert run_python2(script) == [True, True, ['a'], ['a', 'b'], True, ['a'], ['a', 'b']]
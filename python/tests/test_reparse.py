@@ -0,0 +1,70 @@
+from glr_parser import ForestNode, Parser, grammar_grammar
+
+from helpers import forest, read_example
+
+grammar_source = read_example('gospel', 'grammar.grm')
+
+def parse(parser, text):
+    session = parser.stream(incremental=True, window=16)
+    session.feed(text)
+    session.finish()
+    return session
+
+def test_reparse_matches_fresh_parse():
+    parser = Parser(grammar_grammar)
+    session = parse(parser, grammar_source*3)
+    middle = len(grammar_source)+grammar_source.index(';\n')+2
+    edits = [(middle, 0, 'foo -> bar;\n'), (grammar_source.index(', ')+1, 0, '  '),
+             (len(grammar_source)*2+grammar_source.index(';\n\n')+2, 1, ''), (middle+3, 0, 'x')]
+    for edit in edits:
+        previous = session
+        session = parser.reparse(previous, [edit])
+        fresh = parse(parser, session.buffer)
+        assert session.accepted_stacks
+        # the rest of the previous parse was spliced onto the new one
+        assert previous.shift.sync is not None
+        # the checkpoints between the resume and the sync point may be gone
+        positions = [checkpoint.position() for checkpoint in session.checkpoints]
+        assert positions == sorted(positions)
+        assert set(positions) <= set(checkpoint.position() for checkpoint in fresh.checkpoints)
+        assert forest(session.accepted_stacks) == forest(fresh.accepted_stacks)
+
+def test_reparse_several_edits():
+    parser = Parser(grammar_grammar)
+    text = grammar_source*2
+    session = parser.reparse(parse(parser, text), [(0, 0, 'a -> b;\n'), (20, 3, '')])
+    text = 'a -> b;\n'+text
+    text = text[:20]+text[23:]
+    assert session.buffer == text
+    assert forest(session.accepted_stacks) == forest(parse(parser, text).accepted_stacks)
+
+def current_nodes(session):
+    """
+    Count the forest nodes of the session that are up to date with its shift,
+    without reading their positions.
+    """
+    count = 0
+    seen = set()
+    nodes = [value for accepted in session.accepted_stacks for value, parent in accepted.edges]
+    while nodes:
+        node = nodes.pop()
+        if not isinstance(node, ForestNode) or id(node) in seen:
+            continue
+        seen.add(id(node))
+        if node.shift is session.shift:
+            count += 1
+        nodes.extend(child for packed in node.packed for child in (packed.left, packed.right))
+    return count
+
+def test_reparse_does_not_shift_the_rest():
+    parser = Parser(grammar_grammar)
+    edit = (grammar_source.index(';\n')+2, 0, 'foo -> bar;\n')
+    counts = []
+    for copies in (4, 16):
+        text = grammar_source*copies
+        session = parser.reparse(parse(parser, text), [edit])
+        counts.append(current_nodes(session))
+        text = text[:edit[0]]+edit[2]+text[edit[0]:]
+        assert forest(session.accepted_stacks) == forest(parse(parser, text).accepted_stacks)
+    # only the nodes around the edit were touched, however long the rest is
+    assert counts[0] == counts[1]
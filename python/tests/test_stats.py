@@ -0,0 +1,35 @@
+from glr_parser import Parser, ParserStats, literal, regex
+
+from helpers import forest
+
+def expression_grammar(plus={}):
+    return [['S', 'e', '\0'],
+            ['e', 'e', literal('+'), 'e', plus],
+            ['e', 'e', literal('*'), 'e'],
+            ['e', regex('[0-9]')]]
+
+def test_report():
+    parser = Parser(expression_grammar())
+    stats = ParserStats(parser)
+    accepted_stacks, longest_stacks = parser.run('1+2*3+4', stats=stats)
+    assert forest(accepted_stacks) == forest(parser.run('1+2*3+4')[0])
+    report = stats.report()
+    assert report['ambiguous_nodes'] == 3
+    assert report['heads']['total'] == sum(state['heads'] for state in report['states'].values())
+    assert report['reductions'] == sum(rule['reductions'] for rule in report['rules'].values())
+    assert report['reductions'] == sum(state['reductions'] for state in report['states'].values())
+    assert report['path_enumerations'] > 0 and report['paths'] >= report['path_enumerations']
+    assert report['matcher_calls'] > 0 and 0 < report['matcher_hit_rate'] <= 1
+    ambiguities = dict((rule, counts['ambiguities']) for rule, counts in report['rules'].items())
+    plus, times = parser.rule_as_str(1), parser.rule_as_str(2)
+    assert ambiguities == {parser.rule_as_str(0): 0, plus: 4, times: 3, parser.rule_as_str(3): 0}
+    heatmap = stats.heatmap().splitlines()
+    assert [line.split()[0] for line in heatmap] == ['4', '3']
+    assert heatmap[0].endswith(plus) and heatmap[1].endswith(times)
+
+def test_no_ambiguities():
+    parser = Parser(expression_grammar(plus={'priority': 1, 'assoc': 'left'}))
+    stats = ParserStats(parser)
+    parser.run('1+2+3', stats=stats)
+    assert stats.report()['ambiguous_nodes'] == 0
+    assert stats.heatmap() == 'no ambiguities\n'
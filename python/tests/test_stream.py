@@ -0,0 +1,98 @@
+import gc
+
+import pytest
+
+from glr_parser import (MemoryLimitExceeded, Parser, PrefixMatcher, compile_grammar, grammar_grammar, literal,
+                        make_ast, regex)
+
+from helpers import feed, forest, read_example
+
+grammar_source = read_example('gospel', 'grammar.grm')
+program_source = read_example('gospel', 'program.gsp')
+
+def gospel_cases():
+    return [(Parser(grammar_grammar), grammar_source),
+            (Parser(compile_grammar(grammar_source)), program_source)]
+
+def test_literal_longer_than_window():
+    parser = Parser([['S', 'A', '\0'], ['A', literal('ab')]])
+    assert len(parser.run('ab')[0]) == 1
+    assert len(feed(parser, 'ab', 1, window=1)[0]) == 1
+
+def test_regex_longer_than_window():
+    parser = Parser([['S', 'string', '\0'], ['string', regex(r'"(\\.|[^"])*"')]])
+    text = '"'+'x'*3000+'"'
+    accepted_stacks, longest_stacks = feed(parser, text, 100)
+    assert len(accepted_stacks) == 1
+    assert accepted_stacks[0].edges[0][0].tree() == parser.run(text)[0][0].edges[0][0].tree()
+
+def test_prefix_matcher():
+    matcher = PrefixMatcher(r'"(\\.|[^"])*"')
+    assert matcher.match('"abc')
+    assert matcher.match('x"ab\\', 1)
+    assert not matcher.match('"abc" ')
+
+def test_commented_layout():
+    # each comment can end with the newline or leave it to the layout, which
+    # made a backtracking prefix check take exponential time
+    layout = PrefixMatcher(r'(?:#[^\n]*(?:\n|\Z)|\n| )*')
+    assert not layout.match('# comment\n'*40+'x')
+    text = ''.join(['# comment\n'*10+'S -> a;\n']*20)
+    assert len(feed(Parser(grammar_grammar), text, 7)[0]) == 1
+
+@pytest.mark.parametrize('size', [1, 7, 100, None])
+def test_stream_matches_run(size):
+    for parser, text in gospel_cases():
+        accepted_stacks, longest_stacks = parser.run(text)
+        streamed_stacks, streamed_longest = feed(parser, text, size or len(text))
+        assert len(streamed_stacks) == len(accepted_stacks) == 1
+        assert forest(streamed_stacks) == forest(accepted_stacks)
+        assert (repr(make_ast(streamed_stacks[0].edges[0][0])) ==
+                repr(make_ast(accepted_stacks[0].edges[0][0])))
+
+def test_stream_with_small_window():
+    for parser, text in gospel_cases():
+        accepted_stacks, longest_stacks = parser.run(text)
+        assert forest(feed(parser, text, 7, window=1)[0]) == forest(accepted_stacks)
+
+def test_disable_gc():
+    states = []
+    def on_complete(node):
+        states.append(gc.isenabled())
+        raise RuntimeError
+    grammar = [['S', 'A', '\0'], ['A', literal('a')]]
+    for disable_gc in (False, True):
+        session = Parser(grammar, disable_gc=disable_gc).stream(on_complete=on_complete, symbols=['A'])
+        with pytest.raises(RuntimeError):
+            session.feed('a')
+            session.finish()
+        assert gc.isenabled()
+    assert states == [True, False]
+
+def test_release():
+    text = grammar_source*4
+    def rules(release):
+        asts = []
+        def on_complete(node):
+            asts.append(repr(make_ast(node)))
+        session = Parser(grammar_grammar).stream(on_complete=on_complete, symbols=['{}rule'], release=release)
+        for i in range(0, len(text), 100):
+            session.feed(text[i:i+100])
+        accepted_stacks, longest_stacks = session.finish()
+        assert len(accepted_stacks) == 1
+        return asts, len(forest(accepted_stacks))
+    asts, size = rules(False)
+    released_asts, released_size = rules(True)
+    assert released_asts == asts
+    assert len(asts) > 4
+    # the forest only holds the nodes on the stack and what is not committed yet
+    assert released_size*20 < size
+
+def test_memory_limit():
+    text = grammar_source*4
+    session = Parser(grammar_grammar).stream(memory_limit=1)
+    with pytest.raises(MemoryLimitExceeded):
+        session.feed(text)
+        session.finish()
+    with pytest.raises(ValueError):
+        Parser(grammar_grammar).stream(incremental=True, release=True)